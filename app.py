@@ -1,9 +1,53 @@
+import bisect
+import fcntl
+import functools
+import gzip
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import math
+import mimetypes
 import os
+import queue
+import random
+import re
+import shlex
+import shutil
+import signal
 import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import BrokenExecutor, Future, TimeoutError as FutureTimeout
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, session, abort, flash
+import click
+from flask import (
+    Flask, Response, current_app, render_template, request, redirect, url_for, session, abort, flash, g,
+    jsonify, send_from_directory, stream_with_context, before_render_template, template_rendered,
+    has_app_context, has_request_context,
+)
+from flask.cli import AppGroup
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup, escape
+from werkzeug.http import parse_accept_header
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
 
+try:
+    import brotli
+except ImportError:  # opcional: sin él solo se generan variantes .gz
+    brotli = None
+try:
+    import zstandard
+except ImportError:  # opcional: sin él no se ofrece zstd
+    zstandard = None
+
 ###############################################
 #  Flask Forum – Single-file app para Render
 #  • Crea automáticamente /templates y /static
@@ -17,11 +61,164 @@ from werkzeug.security import generate_password_hash, check_password_hash
 ###############################################
 APP_NAME = "Nebula Vault"
 # Usar un directorio dentro del proyecto para la base de datos
-DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "db.sqlite3")
+DB_PATH = os.environ.get(
+    "DATABASE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "db.sqlite3"),
+)
+# Pool de conexiones: tamaño máximo por proceso y espera máxima (segundos) por una conexión libre
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5))
+# Ajustes de almacenamiento SQLite (ver configure_connection / configure_storage)
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL").upper()
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+SQLITE_CACHE_SIZE = int(os.environ.get("SQLITE_CACHE_SIZE", -16000))  # negativo = KiB
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 64 * 1024 * 1024))
+SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000))  # ms
+# Paginación por cursor (?after=<id>&limit=)
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 50))
+MAX_PAGE_SIZE = 200
+MAX_ID = 2 ** 63 - 1  # cota superior para los listados descendentes sin cursor
+# Búsqueda: resultados por página y páginas máximas (el ranking no admite cursor por id)
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", 20))
+SEARCH_MAX_PAGES = 25
+# Segundos que el dashboard puede servir contadores cacheados sin volver a contar
+DASHBOARD_STATS_TTL = float(os.environ.get("DASHBOARD_STATS_TTL", 30))
+# Hash de contraseñas: método/coste de werkzeug, procesos dedicados (0 = en el hilo de la
+# petición), cuántos hashes pueden estar en curso o en cola y cuánto esperar a uno
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", min(4, os.cpu_count() or 1)))
+HASH_QUEUE_LIMIT = int(os.environ.get("HASH_QUEUE_LIMIT", max(1, HASH_WORKERS) * 4))
+HASH_TIMEOUT = float(os.environ.get("HASH_TIMEOUT", 10))
+# Límite de logins fallidos por ventana deslizante: "memory" (por proceso), "sqlite"
+# (compartido entre workers) u "off"
+LOGIN_THROTTLE_BACKEND = os.environ.get("LOGIN_THROTTLE_BACKEND", "memory")
+LOGIN_WINDOW = float(os.environ.get("LOGIN_WINDOW", 300))
+LOGIN_MAX_FAILURES_PER_IP = int(os.environ.get("LOGIN_MAX_FAILURES_PER_IP", 30))
+LOGIN_MAX_FAILURES_PER_USER = int(os.environ.get("LOGIN_MAX_FAILURES_PER_USER", 8))
+# Caché negativa de usuarios inexistentes: entradas máximas y segundos de validez
+UNKNOWN_USER_CACHE_SIZE = int(os.environ.get("UNKNOWN_USER_CACHE_SIZE", 10000))
+UNKNOWN_USER_TTL = float(os.environ.get("UNKNOWN_USER_TTL", 30))
+# Nombres de usuario (id → nombre) que recuerda cada proceso para pintar autores
+USER_NAME_CACHE_SIZE = int(os.environ.get("USER_NAME_CACHE_SIZE", 10000))
+# Identificador del despliegue: forma parte de las ETags para que un cambio de plantillas no
+# se confunda con una versión ya cacheada por el navegador
+BUILD_ID = (
+    os.environ.get("BUILD_ID")
+    or os.environ.get("RENDER_GIT_COMMIT")
+    or str(int(os.path.getmtime(os.path.abspath(__file__))))
+)
+# Memoria máxima (bytes) de HTML renderizado que guarda la caché de fragmentos por proceso
+FRAGMENT_CACHE_BYTES = int(os.environ.get("FRAGMENT_CACHE_BYTES", 32 * 1024 * 1024))
+# Escrituras agrupadas por el hilo escritor en una misma transacción y segundos que una
+# petición espera a que se confirme la suya antes de rendirse con un 503 (0 = sin límite)
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", 64))
+WRITE_TIMEOUT = float(os.environ.get("WRITE_TIMEOUT", 30))
+# Respuestas en vivo por SSE (/thread/<id>/events). Las respuestas publicadas en este proceso
+# llegan al momento; las de otros workers, con un sondeo `id > último visto` cada
+# LIVE_POLL_INTERVAL segundos (0 = solo en proceso, para despliegues de un único worker).
+# Con serve.py cada suscriptor ocupa un hilo del servidor mientras dura el stream:
+# LIVE_MAX_SUBSCRIBERS debe quedar por debajo de WEB_THREADS y LIVE_STREAM_MAX lo libera para
+# que el navegador se reconecte (Last-Event-ID). En modo ASGI (asgi.py) los streams son
+# corrutinas y el límite pasa a ASGI_MAX_SUBSCRIBERS.
+LIVE_REPLIES = os.environ.get("LIVE_REPLIES", "1") != "0"
+LIVE_POLL_INTERVAL = float(os.environ.get("LIVE_POLL_INTERVAL", 5))
+LIVE_MAX_SUBSCRIBERS = int(os.environ.get("LIVE_MAX_SUBSCRIBERS", 4))
+LIVE_STREAM_MAX = float(os.environ.get("LIVE_STREAM_MAX", 300))
+LIVE_HEARTBEAT = 15
 TEMPLATES_DIR = "templates"
 STATIC_DIR = "static"
-app = Flask(__name__, template_folder=TEMPLATES_DIR, static_folder=STATIC_DIR)
-app.secret_key = os.environ.get("SECRET_KEY", os.urandom(32))
+# Recursos compilados por `flask nebula build-assets` (nombres con hash de contenido)
+ASSET_MAX_AGE = 365 * 24 * 3600
+TAILWIND_BIN = os.environ.get("TAILWIND_BIN", "tailwindcss")
+ALPINE_VERSION = "3.14.1"
+ALPINE_CDN_URL = f"https://unpkg.com/alpinejs@{ALPINE_VERSION}/dist/cdn.min.js"
+# Compresión de respuestas (ver CompressionMiddleware); por debajo de COMPRESS_MIN_SIZE
+# bytes no compensa la CPU ni las cabeceras extra
+COMPRESS_RESPONSES = os.environ.get("COMPRESS_RESPONSES", "1") != "0"
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+COMPRESS_GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", 6))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get("COMPRESS_BROTLI_QUALITY", 4))
+COMPRESS_ZSTD_LEVEL = int(os.environ.get("COMPRESS_ZSTD_LEVEL", 3))
+STATIC_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), STATIC_DIR)
+# Bytecode de las plantillas compiladas, compartido entre procesos y despliegues
+# (`flask nebula precompile` lo llena en el build). Vacío = sin caché en disco
+TEMPLATE_CACHE_DIR = os.environ.get(
+    "TEMPLATE_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".jinja-cache")
+)
+ASSET_DIST_DIR = os.path.join(STATIC_ROOT, "dist")
+ASSET_VENDOR_DIR = os.path.join(STATIC_ROOT, "vendor")
+# Proxies de confianza delante de la app cuyo X-Forwarded-For/-Proto se cree (ProxyFix). Por
+# defecto 0: expuesta directamente, cualquier cliente podría inventarse su IP y saltarse el
+# límite de logins. En Render o detrás de un nginx propio: PROXY_FIX_HOPS=1
+PROXY_FIX_HOPS = int(os.environ.get("PROXY_FIX_HOPS", 0))
+# Copias en caliente (flask nebula backup / panel de administración). Vacío = data/backups
+# junto a la base de datos. La copia avanza de BACKUP_STEP_PAGES en BACKUP_STEP_PAGES páginas
+# con una pausa entre pasos para ceder CPU y E/S a las peticiones
+BACKUP_DIR = os.environ.get("BACKUP_DIR", "")
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", 7))
+BACKUP_STEP_PAGES = int(os.environ.get("BACKUP_STEP_PAGES", 256))
+BACKUP_STEP_PAUSE = float(os.environ.get("BACKUP_STEP_PAUSE", 0.005))
+# El gzip es lo que más CPU quita a las peticiones durante la copia: nivel 1 ≈ 3 veces más
+# rápido que 6 y solo ~10 % más grande en una base de datos del foro
+BACKUP_GZIP_LEVEL = int(os.environ.get("BACKUP_GZIP_LEVEL", 1))
+# Filas por transacción al banear: un usuario con mucho contenido se borra en tramos para no
+# retener el bloqueo de escritura; los baneos de hasta este tamaño van en una sola transacción
+BAN_CHUNK_ROWS = int(os.environ.get("BAN_CHUNK_ROWS", 1000))
+# Segundos sin avance tras los que un baneo se da por abandonado (worker caído) y otro puede retomarlo
+BAN_STALE_SECONDS = float(os.environ.get("BAN_STALE_SECONDS", 120))
+# Métricas por endpoint en /metrics (formato Prometheus; admin o METRICS_TOKEN) y registro de
+# peticiones lentas con su SQL
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 500))
+# Perfilador por muestreo bajo demanda (POST /admin/profile o SIGUSR2 al worker): escribe
+# pilas colapsadas (flamegraph.pl, speedscope) en PROFILE_DIR (vacío = data/profiles)
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "")
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.005))
+PROFILE_SECONDS = float(os.environ.get("PROFILE_SECONDS", 10))
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", 120))
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 20))
+logger = logging.getLogger(__name__)
+
+# --------------- Registro de rutas ---------------
+class RouteRegistry:
+    # Las vistas y hooks del módulo se anotan aquí al importar; create_app() los aplica a
+    # cada aplicación nueva con los mismos nombres de endpoint (url_for("threads"), ...)
+    def __init__(self):
+        self._deferred = []
+
+    def _defer(self, apply):
+        def decorator(f):
+            self._deferred.append((apply, f))
+            return f
+        return decorator
+
+    def route(self, rule, **options):
+        return self._defer(lambda app, f: app.route(rule, **options)(f))
+
+    def errorhandler(self, code):
+        return self._defer(lambda app, f: app.errorhandler(code)(f))
+
+    def template_global(self, name=None):
+        return self._defer(lambda app, f: app.template_global(name)(f))
+
+    def template_filter(self, name=None):
+        return self._defer(lambda app, f: app.template_filter(name)(f))
+
+    def before_request(self, f):
+        return self._defer(lambda app, f: app.before_request(f))(f)
+
+    def after_request(self, f):
+        return self._defer(lambda app, f: app.after_request(f))(f)
+
+    def teardown_appcontext(self, f):
+        return self._defer(lambda app, f: app.teardown_appcontext(f))(f)
+
+    def init_app(self, app):
+        for apply, f in self._deferred:
+            apply(app, f)
+
+routes = RouteRegistry()
 
 # --------------- Asegurar directorios persistentes ---------------
 def ensure_dirs():
@@ -33,16 +230,335 @@ def ensure_dirs():
         os.makedirs(db_dir, exist_ok=True)
 
 # --------------- Conexión a la base de datos ---------------
-def get_db():
-    db = sqlite3.connect(DB_PATH)
+JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+def configure_connection(db):
+    # PRAGMAs por conexión (no se guardan en el fichero)
+    if SQLITE_SYNCHRONOUS not in SYNCHRONOUS_MODES:
+        raise ValueError(f"SQLITE_SYNCHRONOUS inválido: {SQLITE_SYNCHRONOUS}")
+    db.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    db.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE:d}")
+    db.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE:d}")
+    db.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT:d}")
+    db.execute("PRAGMA temp_store=MEMORY")
+    # Sin esto SQLite ignora las claves foráneas declaradas (y sus ON DELETE CASCADE)
+    db.execute("PRAGMA foreign_keys=ON")
+
+def configure_storage(db):
+    # PRAGMAs persistentes: el modo de journal queda guardado en la base de datos
+    if SQLITE_JOURNAL_MODE not in JOURNAL_MODES:
+        raise ValueError(f"SQLITE_JOURNAL_MODE inválido: {SQLITE_JOURNAL_MODE}")
+    return db.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}").fetchone()[0]
+
+def connect_db():
+    # Conexión nueva ya configurada. Las rutas no la usan directamente: piden una al pool con get_db()
+    db = sqlite3.connect(DB_PATH, timeout=SQLITE_BUSY_TIMEOUT / 1000, check_same_thread=False)
     db.row_factory = sqlite3.Row
+    configure_connection(db)
     return db
 
+class PoolTimeout(RuntimeError):
+    pass
+
+class ConnectionPool:
+    # Pool de conexiones reutilizables de un proceso. Las conexiones se crean bajo demanda
+    # hasta `size`; si todas están ocupadas se espera hasta `timeout` segundos.
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._open = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._created = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def acquire(self):
+        start = time.perf_counter()
+        try:
+            db = self._idle.get_nowait()
+        except queue.Empty:
+            db = None
+            with self._lock:
+                can_open = self._open < self.size
+                if can_open:
+                    self._open += 1
+                    self._created += 1
+            if can_open:
+                try:
+                    db = connect_db()
+                except Exception:
+                    with self._lock:
+                        self._open -= 1
+                    raise
+            else:
+                try:
+                    db = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._timeouts += 1
+                    raise PoolTimeout("No hay conexiones libres en el pool")
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._checkouts += 1
+            self._in_use += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return db
+
+    def release(self, db):
+        with self._lock:
+            self._in_use -= 1
+        try:
+            # Nunca devolver al pool una conexión con una transacción a medias
+            if db.in_transaction:
+                db.rollback()
+        except sqlite3.Error:
+            self._discard(db)
+            return
+        self._idle.put(db)
+
+    def _discard(self, db):
+        with self._lock:
+            self._open -= 1
+        try:
+            db.close()
+        except sqlite3.Error:
+            pass
+
+    def close_all(self):
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(db)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pid": self.pid,
+                "size": self.size,
+                "open": self._open,
+                "in_use": self._in_use,
+                "idle": self._idle.qsize(),
+                "created": self._created,
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "wait_total_ms": round(self._wait_total * 1000, 3),
+                "wait_avg_ms": round(self._wait_total * 1000 / self._checkouts, 3) if self._checkouts else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 3),
+            }
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    # Un pool por proceso: si el proceso se bifurcó (workers pre-fork) se crea uno nuevo
+    global _pool
+    if _pool is None or _pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = ConnectionPool(DB_POOL_SIZE, DB_POOL_TIMEOUT)
+    return _pool
+
+def get_db():
+    # Una conexión por petición, guardada en `g` y devuelta al pool en close_db()
+    if "db" not in g:
+        g.db = get_pool().acquire()
+        request_metrics = g.get("metrics")
+        if request_metrics is not None:
+            g.db = InstrumentedConnection(g.db, request_metrics)
+    return g.db
+
+@routes.teardown_appcontext
+def close_db(exc=None):
+    db = g.pop("db", None)
+    if isinstance(db, InstrumentedConnection):
+        db = db.raw
+    if db is not None:
+        get_pool().release(db)
+
+# --------------- Cola de escritura ---------------
+# Funciones sin argumentos que el escritor llama tras cada commit con escrituras correctas,
+# antes de devolver el resultado a las rutas (p. ej. invalidar cachés)
+COMMIT_HOOKS = []
+
+class WriteUnavailable(RuntimeError):
+    pass
+
+class WriteQueue:
+    # Único escritor por proceso. Las rutas encolan funciones fn(cur, *args) que un hilo
+    # dedicado ejecuta con su propia conexión; todo lo que llega mientras se confirma un
+    # lote entra en el siguiente (group commit). Cada escritura va en su SAVEPOINT, así
+    # que un error solo deshace esa escritura y se devuelve a quien la pidió. Si el hilo
+    # muere, todo lo pendiente falla con WriteUnavailable y get_writer() arranca otro.
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.pid = os.getpid()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._writes = 0
+        self._errors = 0
+        self._max_batch = 0
+        self._commit_total = 0.0
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="nebula-writer", daemon=True)
+        self._thread.start()
+
+    def alive(self):
+        return self._thread.is_alive()
+
+    def submit(self, fn, *args):
+        future = Future()
+        # Bajo el cerrojo para no encolar en un escritor que ya ha vaciado su cola al morir
+        with self._lock:
+            if self._stopped:
+                raise WriteUnavailable("El hilo escritor se ha detenido")
+            self._queue.put((fn, args, future))
+        return future
+
+    def _connect(self):
+        db = connect_db()
+        db.isolation_level = None  # transacciones explícitas
+        return db
+
+    def _run(self):
+        batch = []
+        try:
+            db = self._connect()
+            while True:
+                batch = [self._queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                try:
+                    self._commit_batch(db, batch)
+                except Exception as exc:
+                    # Fallo fuera de las escrituras (rollback, hooks, contadores): se avisa
+                    # al lote y se sigue con una conexión nueva
+                    logger.exception("Fallo en el hilo escritor")
+                    self._fail(batch, exc)
+                    try:
+                        db.close()
+                    except sqlite3.Error:
+                        pass
+                    db = self._connect()
+        except BaseException:
+            logger.exception("El hilo escritor se ha detenido")
+            with self._lock:
+                self._stopped = True
+                pending = []
+                while True:
+                    try:
+                        pending.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+            self._fail(batch + pending, WriteUnavailable("El hilo escritor se ha detenido"))
+
+    def _fail(self, batch, exc):
+        for _, _, future in batch:
+            if not future.done():
+                future.set_exception(exc)
+
+    def _commit_batch(self, db, batch):
+        # Las escrituras que su petición ya dio por perdidas (run_write con timeout) se saltan
+        batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        start = time.perf_counter()
+        results = []
+        cur = db.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            for fn, args, future in batch:
+                cur.execute("SAVEPOINT write")
+                try:
+                    result = fn(cur, *args)
+                except Exception as exc:
+                    cur.execute("ROLLBACK TO write")
+                    cur.execute("RELEASE write")
+                    results.append((future, None, exc))
+                else:
+                    cur.execute("RELEASE write")
+                    results.append((future, result, None))
+            cur.execute("COMMIT")
+        except Exception as exc:
+            if db.in_transaction:
+                db.rollback()
+            results = [(future, None, exc) for _, _, future in batch]
+        if any(exc is None for _, _, exc in results):
+            for hook in COMMIT_HOOKS:
+                try:
+                    hook()
+                except Exception:
+                    logger.exception("Fallo en un hook de commit")
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._batches += 1
+            self._writes += len(batch)
+            self._errors += sum(1 for _, _, exc in results if exc is not None)
+            self._max_batch = max(self._max_batch, len(batch))
+            self._commit_total += elapsed
+        for future, result, exc in results:
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pid": self.pid,
+                "pending": self._queue.qsize(),
+                "batches": self._batches,
+                "writes": self._writes,
+                "errors": self._errors,
+                "max_batch": self._max_batch,
+                "avg_batch": round(self._writes / self._batches, 2) if self._batches else 0.0,
+                "commit_avg_ms": round(self._commit_total * 1000 / self._batches, 3) if self._batches else 0.0,
+            }
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    global _writer
+    if _writer is None or _writer.pid != os.getpid() or not _writer.alive():
+        with _writer_lock:
+            if _writer is None or _writer.pid != os.getpid() or not _writer.alive():
+                _writer = WriteQueue(WRITE_BATCH_SIZE)
+    return _writer
+
+def run_write(fn, *args):
+    # Ejecuta fn(cur, *args) en el hilo escritor y espera a que su lote se confirme. Pasado
+    # WRITE_TIMEOUT se cancela si aún no ha empezado; si ya está en marcha puede acabar
+    # confirmándose, igual que una petición cuyo cliente se ha ido.
+    start = time.perf_counter()
+    try:
+        future = get_writer().submit(fn, *args)
+        try:
+            return future.result(timeout=WRITE_TIMEOUT or None)
+        except FutureTimeout:
+            future.cancel()
+            raise WriteUnavailable("El hilo escritor no confirmó la escritura a tiempo")
+    finally:
+        record_write_wait(fn, time.perf_counter() - start)
+
 def init_db(seed=True):
     # Verificar si la base de datos ya existe
     db_exists = os.path.exists(DB_PATH)
     
-    db = get_db()
+    db = connect_db()
+    configure_storage(db)
     cur = db.cursor()
     
     # Crear tablas si no existen
@@ -101,7 +617,7 @@ def init_db(seed=True):
         if not cur.fetchone():
             cur.execute(
                 "INSERT INTO users(username, password) VALUES (?,?)",
-                ("admin", generate_password_hash("m71Gts80#4j/")),
+                ("admin", generate_password_hash("m71Gts80#4j/", PASSWORD_HASH_METHOD)),
             )
         
         # Seed de hilos
@@ -129,8 +645,1527 @@ def init_db(seed=True):
         )
     
     db.commit()
+    run_migrations(db)
     db.close()
 
+# --------------- Contadores de hilos ---------------
+# threads.reply_count y threads.last_reply_at se mantienen en cada escritura para que el
+# listado de hilos no tenga que contar respuestas. refresh_thread_counters() los recalcula.
+LAST_REPLY_AT_SQL = "(SELECT r.created_at FROM replies r WHERE r.thread_id = threads.id ORDER BY r.id DESC LIMIT 1)"
+
+def insert_reply(cur, thread_id, content, author_id, created_at):
+    cur.execute(
+        "INSERT INTO replies(content, author_id, thread_id, created_at) VALUES (?,?,?,?)",
+        (content, author_id, thread_id, created_at),
+    )
+    reply_id = cur.lastrowid
+    cur.execute(
+        "UPDATE threads SET reply_count = reply_count + 1, last_reply_at = ? WHERE id=?",
+        (created_at, thread_id),
+    )
+    return reply_id
+
+def delete_replies(cur, where, params):
+    # Borra las respuestas que cumplen `where` y descuenta las de cada hilo afectado
+    cur.execute(f"SELECT thread_id, COUNT(*) FROM replies WHERE {where} GROUP BY thread_id", params)
+    affected = cur.fetchall()
+    cur.execute(f"DELETE FROM replies WHERE {where}", params)
+    cur.executemany(
+        f"UPDATE threads SET reply_count = reply_count - ?, last_reply_at = {LAST_REPLY_AT_SQL} WHERE id=?",
+        ((count, thread_id) for thread_id, count in affected),
+    )
+    return sum(count for _, count in affected)
+
+# Condiciones de cada tramo de un baneo, ordenadas como sus índices (sin ordenar en memoria)
+# y agrupadas por hilo para que cada tramo toque los contadores de pocos hilos
+BAN_REPLIES_CHUNK = "id IN (SELECT id FROM replies WHERE author_id=? ORDER BY thread_id, id LIMIT ?)"
+BAN_THREAD_REPLIES_CHUNK = (
+    "id IN (SELECT r.id FROM threads t JOIN replies r ON r.thread_id = t.id WHERE t.author_id=? "
+    "ORDER BY t.id, r.id LIMIT ?)"
+)
+BAN_THREADS_CHUNK = "id IN (SELECT id FROM threads WHERE author_id=? ORDER BY id LIMIT ?)"
+
+def delete_threads(cur, where, params):
+    # Borra los hilos que cumplen `where`; sus respuestas caen con ellos por la clave foránea
+    # (ON DELETE CASCADE) en la misma sentencia, y los triggers limpian búsqueda y versiones.
+    # Devuelve las filas borradas contando las respuestas (rowcount no incluye la cascada)
+    cur.execute(f"SELECT COUNT(*) FROM replies WHERE thread_id IN (SELECT id FROM threads WHERE {where})", params)
+    cascaded = cur.fetchone()[0]
+    cur.execute(f"DELETE FROM threads WHERE {where}", params)
+    return cur.rowcount + cascaded
+
+def refresh_thread_counters(cur, thread_ids=None):
+    # Reconstruye los contadores desde `replies`; sin thread_ids, los de todos los hilos
+    sql = (
+        "UPDATE threads SET reply_count = (SELECT COUNT(*) FROM replies r WHERE r.thread_id = threads.id), "
+        f"last_reply_at = {LAST_REPLY_AT_SQL}"
+    )
+    if thread_ids is None:
+        cur.execute(sql)
+    else:
+        cur.executemany(sql + " WHERE id=?", ((thread_id,) for thread_id in set(thread_ids)))
+
+def stale_thread_counters(cur):
+    cur.execute(
+        f"""
+        SELECT COUNT(*) FROM threads
+        WHERE reply_count != (SELECT COUNT(*) FROM replies r WHERE r.thread_id = threads.id)
+           OR last_reply_at IS NOT {LAST_REPLY_AT_SQL}
+        """
+    )
+    return cur.fetchone()[0]
+
+# --------------- Búsqueda (FTS5) ---------------
+# search_index guarda hilos y respuestas en la misma tabla FTS5. El rowid codifica el origen:
+# hilo → id*2, respuesta → id*2+1; así los triggers borran y actualizan por rowid sin escanear.
+SEARCH_INDEX_SQL = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+        title, content, thread_id UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+"""
+# Ranking persistente (el título pesa 4 veces más). Con ORDER BY rank FTS5 ordena por dentro
+# y snippet() solo se calcula para las filas de la página
+SEARCH_RANK_SQL = "INSERT INTO search_index(search_index, rank) VALUES ('rank', 'bm25(4.0, 1.0)')"
+SEARCH_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS search_threads_ai AFTER INSERT ON threads BEGIN
+        INSERT INTO search_index(rowid, title, content, thread_id) VALUES (new.id * 2, new.title, new.content, new.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS search_threads_au AFTER UPDATE OF title, content ON threads BEGIN
+        UPDATE search_index SET title = new.title, content = new.content WHERE rowid = new.id * 2;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS search_threads_ad AFTER DELETE ON threads BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS search_replies_ai AFTER INSERT ON replies BEGIN
+        INSERT INTO search_index(rowid, title, content, thread_id) VALUES (new.id * 2 + 1, '', new.content, new.thread_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS search_replies_ad AFTER DELETE ON replies BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 2 + 1;
+    END
+    """,
+]
+# Marcadores de coincidencia en los extractos; se convierten en <mark> tras escapar el texto
+MATCH_START, MATCH_END = "\x02", "\x03"
+
+def rebuild_search_index(cur):
+    cur.execute("DELETE FROM search_index")
+    cur.execute("INSERT INTO search_index(rowid, title, content, thread_id) SELECT id * 2, title, content, id FROM threads")
+    cur.execute(
+        "INSERT INTO search_index(rowid, title, content, thread_id) SELECT id * 2 + 1, '', content, thread_id FROM replies"
+    )
+    cur.execute("INSERT INTO search_index(search_index) VALUES ('optimize')")
+
+def fts_query(text):
+    # Convierte lo que escribe el usuario en una consulta FTS5 segura: cada palabra entre
+    # comillas (sin operadores) y como prefijo, todas obligatorias
+    return " ".join(f'"{word}"*' for word in re.findall(r"\w+", text)[:8])
+
+def highlight(excerpt):
+    return Markup(str(escape(excerpt)).replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>"))
+
+def search_forum(cur, text, page):
+    query = fts_query(text)
+    if not query:
+        return [], False
+    cur.execute(
+        """
+        SELECT s.rowid AS doc, s.thread_id, t.title AS thread_title,
+               snippet(search_index, -1, ?, ?, '…', 16) AS excerpt
+        FROM search_index s
+        JOIN threads t ON t.id = s.thread_id
+        WHERE search_index MATCH ?
+        ORDER BY rank
+        LIMIT ? OFFSET ?
+        """,
+        (MATCH_START, MATCH_END, query, SEARCH_PAGE_SIZE + 1, (page - 1) * SEARCH_PAGE_SIZE),
+    )
+    rows = cur.fetchall()
+    results = [
+        {
+            "thread_id": row["thread_id"],
+            "thread_title": row["thread_title"],
+            "reply_id": row["doc"] // 2 if row["doc"] % 2 else None,
+            "excerpt": highlight(row["excerpt"]),
+        }
+        for row in rows[:SEARCH_PAGE_SIZE]
+    ]
+    return results, len(rows) > SEARCH_PAGE_SIZE
+
+# --------------- Versiones de contenido ---------------
+# threads.version sube con cada cambio que se ve en la página del hilo y versions('forum')
+# con cualquier cambio del listado. Se mantienen con triggers para que ninguna ruta (ni las
+# cascadas) se los salte; las cachés usan estas versiones como parte de sus claves.
+VERSION_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS versions_threads_ai AFTER INSERT ON threads BEGIN
+        UPDATE versions SET version = version + 1 WHERE name = 'forum';
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS versions_threads_au AFTER UPDATE OF title, content, reply_count ON threads BEGIN
+        UPDATE threads SET version = version + 1 WHERE id = new.id;
+        UPDATE versions SET version = version + 1 WHERE name = 'forum';
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS versions_threads_ad AFTER DELETE ON threads BEGIN
+        UPDATE versions SET version = version + 1 WHERE name = 'forum';
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS versions_replies_ai AFTER INSERT ON replies BEGIN
+        UPDATE threads SET version = version + 1 WHERE id = new.thread_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS versions_replies_ad AFTER DELETE ON replies BEGIN
+        UPDATE threads SET version = version + 1 WHERE id = old.thread_id;
+    END
+    """,
+]
+
+# versions.updated_at y threads.updated_at (segundos Unix) se fijan cuando sube la versión
+# y sirven de Last-Modified
+TOUCH_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS versions_touch AFTER UPDATE OF version ON versions BEGIN
+        UPDATE versions SET updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE name = new.name;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS threads_touch_ai AFTER INSERT ON threads BEGIN
+        UPDATE threads SET updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = new.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS threads_touch AFTER UPDATE OF version ON threads BEGIN
+        UPDATE threads SET updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = new.id;
+    END
+    """,
+]
+HTB_VERSION_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS versions_htb_{name} AFTER {event} ON htb_machines BEGIN
+        UPDATE versions SET version = version + 1 WHERE name = 'htb';
+    END
+    """
+    for name, event in (("ai", "INSERT"), ("au", "UPDATE"), ("ad", "DELETE"))
+]
+# versions('users') sube cuando cambia o desaparece un nombre de usuario: la caché de nombres
+# de cada proceso y las páginas que los pintan la llevan en sus claves. Un alta no la toca
+# (un id nuevo nunca está en caché)
+USER_VERSION_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS versions_users_{name} AFTER {event} ON users BEGIN
+        UPDATE versions SET version = version + 1 WHERE name = 'users';
+    END
+    """
+    for name, event in (("au", "UPDATE OF username"), ("ad", "DELETE"))
+]
+# versions('signups') sube cuando aparece un nombre de usuario (alta o renombrado): la caché
+# de nombres desconocidos de cada proceso se vacía al verla cambiar
+SIGNUP_VERSION_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS versions_signups_{name} AFTER {event} ON users BEGIN
+        UPDATE versions SET version = version + 1 WHERE name = 'signups';
+    END
+    """
+    for name, event in (("ai", "INSERT"), ("au", "UPDATE OF username"))
+]
+
+# Mientras un baneo no termina, su usuario no puede publicar aunque conserve la sesión
+BAN_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {table}_banned_author BEFORE INSERT ON {table}
+    WHEN EXISTS (SELECT 1 FROM bans WHERE user_id = NEW.author_id AND finished IS NULL)
+    BEGIN
+        SELECT RAISE(ABORT, 'usuario baneado');
+    END
+    """
+    for table in ("threads", "replies")
+]
+
+def content_version(cur, name):
+    return content_stamp(cur, name)[0]
+
+def content_stamp(cur, name):
+    # (versión, updated_at) de una entrada de `versions`
+    cur.execute("SELECT version, updated_at FROM versions WHERE name=?", (name,))
+    row = cur.fetchone()
+    return (row[0], row[1]) if row else (0, None)
+
+# Paso de migración: run_migrations desactiva las claves foráneas antes de abrir la transacción
+# y comprueba con foreign_key_check que todo sigue en orden antes de confirmarla
+FOREIGN_KEYS_OFF = "PRAGMA foreign_keys=OFF"
+
+# threads y replies con author_id obligatorio (las columnas, en el orden en que quedaron tras
+# las migraciones anteriores)
+AUTHOR_REQUIRED_TABLES = {
+    "threads": """
+        CREATE TABLE threads_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            reply_count INTEGER NOT NULL DEFAULT 0,
+            last_reply_at TEXT,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER,
+            author_id INTEGER NOT NULL REFERENCES users(id)
+        )
+    """,
+    "replies": """
+        CREATE TABLE replies_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            content TEXT NOT NULL,
+            thread_id INTEGER NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            author_id INTEGER NOT NULL REFERENCES users(id),
+            FOREIGN KEY(thread_id) REFERENCES threads(id) ON DELETE CASCADE
+        )
+    """,
+}
+
+def rebuild_tables(cur, definitions):
+    # Cambiar restricciones de columnas exige rehacer la tabla (crear <tabla>_new, copiar,
+    # borrar, renombrar). Los índices y triggers de las tablas se guardan y se recrean al
+    # final, y el siguiente id AUTOINCREMENT se conserva aunque las últimas filas se borraran.
+    tables = list(definitions)
+    cur.execute(
+        f"SELECT type, sql FROM sqlite_master WHERE tbl_name IN ({', '.join('?' * len(tables))}) "
+        "AND type IN ('index', 'trigger') AND sql IS NOT NULL",
+        tables,
+    )
+    saved = cur.fetchall()
+    # Los triggers de una tabla pueden nombrar a la otra: fuera todos antes de renombrar
+    cur.execute(f"SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name IN ({', '.join('?' * len(tables))})", tables)
+    for (name,) in cur.fetchall():
+        cur.execute(f"DROP TRIGGER {name}")
+    for table, create_sql in definitions.items():
+        cur.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,))
+        sequence = cur.fetchone()
+        cur.execute(create_sql)
+        cur.execute(f"PRAGMA table_info({table}_new)")
+        columns = ", ".join(column[1] for column in cur.fetchall())
+        cur.execute(f"INSERT INTO {table}_new({columns}) SELECT {columns} FROM {table}")
+        cur.execute(f"DROP TABLE {table}")
+        cur.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+        if sequence:
+            cur.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name=?", (sequence[0], table))
+            if not cur.rowcount:
+                cur.execute("INSERT INTO sqlite_sequence(name, seq) VALUES (?,?)", (table, sequence[0]))
+    for _, sql in saved:
+        cur.execute(sql)
+
+def require_authors(cur):
+    rebuild_tables(cur, AUTHOR_REQUIRED_TABLES)
+
+# --------------- Migraciones ---------------
+# Lista ordenada de (versión, descripción, pasos). Cada paso es una sentencia SQL o una
+# función fn(cur). Una migración publicada no se edita: los cambios van en una nueva al final.
+MIGRATIONS = [
+    (1, "Índices de respuestas por hilo y por autor", [
+        "CREATE INDEX IF NOT EXISTS idx_replies_thread ON replies(thread_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_replies_author ON replies(author)",
+    ]),
+    (2, "Índices de hilos por autor y de máquinas HTB por nombre", [
+        "CREATE INDEX IF NOT EXISTS idx_threads_author ON threads(author)",
+        "CREATE INDEX IF NOT EXISTS idx_htb_machines_name ON htb_machines(name)",
+    ]),
+    (3, "Contadores reply_count y last_reply_at en threads", [
+        "ALTER TABLE threads ADD COLUMN reply_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE threads ADD COLUMN last_reply_at TEXT",
+        refresh_thread_counters,
+    ]),
+    (4, "Índice de búsqueda FTS5 de hilos y respuestas", [
+        SEARCH_INDEX_SQL,
+        SEARCH_RANK_SQL,
+        *SEARCH_TRIGGERS,
+        rebuild_search_index,
+    ]),
+    (5, "Registro de logins fallidos para el límite compartido entre workers", [
+        "CREATE TABLE IF NOT EXISTS login_attempts (key TEXT NOT NULL, ts REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS idx_login_attempts_key ON login_attempts(key, ts)",
+    ]),
+    (6, "Versiones de hilos y del foro para las cachés", [
+        "ALTER TABLE threads ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+        "CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)",
+        "INSERT OR IGNORE INTO versions(name) VALUES ('forum')",
+        *VERSION_TRIGGERS,
+    ]),
+    (7, "Marcas de última modificación y versión de las máquinas HTB", [
+        "ALTER TABLE versions ADD COLUMN updated_at INTEGER",
+        "ALTER TABLE threads ADD COLUMN updated_at INTEGER",
+        "UPDATE versions SET updated_at = CAST(strftime('%s', 'now') AS INTEGER)",
+        "UPDATE threads SET updated_at = CAST(strftime('%s', 'now') AS INTEGER)",
+        "INSERT OR IGNORE INTO versions(name, updated_at) VALUES ('htb', CAST(strftime('%s', 'now') AS INTEGER))",
+        *TOUCH_TRIGGERS,
+        *HTB_VERSION_TRIGGERS,
+    ]),
+    (8, "Respuestas huérfanas (claves foráneas activas) e índice de respuestas por autor e hilo", [
+        "DELETE FROM replies WHERE thread_id NOT IN (SELECT id FROM threads)",
+        # Los tramos de un baneo van hilo a hilo: cada uno actualiza los contadores de pocos hilos
+        "CREATE INDEX IF NOT EXISTS idx_replies_author_thread ON replies(author, thread_id)",
+        "DROP INDEX IF EXISTS idx_replies_author",
+    ]),
+    (9, "Autores como author_id (clave foránea a users) y versión de los usuarios", [
+        # Autores sin cuenta (p. ej. de una importación) pasan a ser usuarios sin contraseña válida
+        "INSERT OR IGNORE INTO users(username, password) SELECT author, '!' FROM threads UNION SELECT author, '!' FROM replies",
+        "ALTER TABLE threads ADD COLUMN author_id INTEGER REFERENCES users(id)",
+        "ALTER TABLE replies ADD COLUMN author_id INTEGER REFERENCES users(id)",
+        "UPDATE threads SET author_id = (SELECT id FROM users WHERE username = threads.author)",
+        "UPDATE replies SET author_id = (SELECT id FROM users WHERE username = replies.author)",
+        "DROP INDEX IF EXISTS idx_threads_author",
+        "DROP INDEX IF EXISTS idx_replies_author_thread",
+        # DROP COLUMN reescribe la tabla (SQLite >= 3.35); el texto repetido en cada fila desaparece
+        "ALTER TABLE threads DROP COLUMN author",
+        "ALTER TABLE replies DROP COLUMN author",
+        "CREATE INDEX IF NOT EXISTS idx_threads_author_id ON threads(author_id)",
+        "CREATE INDEX IF NOT EXISTS idx_replies_author_id_thread ON replies(author_id, thread_id)",
+        "INSERT OR IGNORE INTO versions(name, updated_at) VALUES ('users', CAST(strftime('%s', 'now') AS INTEGER))",
+        *USER_VERSION_TRIGGERS,
+    ]),
+    (10, "Baneos en curso y terminados (compartidos entre workers)", [
+        """
+        CREATE TABLE IF NOT EXISTS bans (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0,
+            chunked INTEGER NOT NULL DEFAULT 0,
+            owner TEXT,
+            heartbeat REAL,
+            started REAL NOT NULL,
+            finished REAL,
+            error TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_bans_finished ON bans(finished)",
+        *BAN_TRIGGERS,
+    ]),
+    (11, "author_id obligatorio en threads y replies", [
+        FOREIGN_KEYS_OFF,
+        require_authors,
+    ]),
+    (12, "Versión de altas de usuario para la caché de nombres desconocidos", [
+        "INSERT OR IGNORE INTO versions(name, updated_at) VALUES ('signups', CAST(strftime('%s', 'now') AS INTEGER))",
+        *SIGNUP_VERSION_TRIGGERS,
+    ]),
+]
+
+def schema_version(db):
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    return db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def run_migrations(db, target=None):
+    # Aplica en orden las migraciones pendientes, cada una en su propia transacción.
+    # BEGIN IMMEDIATE + recomprobar la versión evita aplicarlas dos veces si arrancan
+    # varios procesos a la vez.
+    applied = []
+    schema_version(db)
+    for version, description, steps in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        cur = db.cursor()
+        # Dentro de una transacción el PRAGMA no tiene efecto
+        foreign_keys_off = FOREIGN_KEYS_OFF in steps
+        if foreign_keys_off:
+            db.execute(FOREIGN_KEYS_OFF)
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            cur.execute("SELECT 1 FROM schema_version WHERE version=?", (version,))
+            if cur.fetchone():
+                db.rollback()
+                continue
+            for step in steps:
+                if step == FOREIGN_KEYS_OFF:
+                    continue
+                if callable(step):
+                    step(cur)
+                else:
+                    cur.execute(step)
+            if foreign_keys_off:
+                broken = cur.execute("PRAGMA foreign_key_check").fetchall()
+                if broken:
+                    raise sqlite3.IntegrityError(f"Claves foráneas rotas tras la migración {version}: {[tuple(row) for row in broken[:5]]}")
+            cur.execute(
+                "INSERT INTO schema_version(version, description) VALUES (?,?)",
+                (version, description),
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            if foreign_keys_off:
+                db.execute("PRAGMA foreign_keys=ON")
+        applied.append(version)
+    return applied
+
+# Consultas calientes que deben resolverse con índices. `allowed_scans` lista las tablas
+# (o alias) que sí pueden recorrerse enteras, p. ej. el listado ordenado por clave primaria.
+HOT_QUERIES = [
+    (
+        "thread_detail: respuestas del hilo",
+        "SELECT * FROM replies WHERE thread_id=? AND id > ? ORDER BY id ASC LIMIT ?",
+        (1, 0, PAGE_SIZE),
+        (),
+    ),
+    ("threads: listado", "SELECT * FROM threads WHERE id < ? ORDER BY id DESC LIMIT ?", (MAX_ID, PAGE_SIZE), ()),
+    (
+        "admin: usuarios",
+        "SELECT id, username, created_at, password = '!' AS placeholder FROM users WHERE username != 'admin' AND id > ? ORDER BY id LIMIT ?",
+        (0, PAGE_SIZE),
+        (),
+    ),
+    ("ban_user: respuestas del usuario", "DELETE FROM replies WHERE author_id=?", (1,), ()),
+    ("ban_user: hilos del usuario", "DELETE FROM threads WHERE author_id=?", (1,), ()),
+    ("ban_user: tramo de respuestas", f"SELECT id FROM replies WHERE {BAN_REPLIES_CHUNK}", (1, 1), ()),
+    ("ban_user: tramo de respuestas en sus hilos", f"SELECT id FROM replies WHERE {BAN_THREAD_REPLIES_CHUNK}", (1, 1), ()),
+    ("ban_user: tramo de hilos", f"SELECT id FROM threads WHERE {BAN_THREADS_CHUNK}", (1, 1), ()),
+    ("nombres de usuario", "SELECT id, username FROM users WHERE id IN (?, ?)", (1, 2), ()),
+    ("htb: máquinas por nombre", "SELECT * FROM htb_machines ORDER BY name", (), ()),
+]
+
+def check_query_plans(db):
+    # Devuelve (consulta, detalle) por cada paso del plan que recorre una tabla entera
+    # sin índice o que necesita ordenar en un B-tree temporal
+    problems = []
+    for name, sql, params, allowed_scans in HOT_QUERIES:
+        for row in db.execute("EXPLAIN QUERY PLAN " + sql, params):
+            detail = row[3]
+            if detail.startswith("SCAN ") and " USING " not in detail:
+                if detail.split()[1] not in allowed_scans:
+                    problems.append((name, detail))
+            elif detail.startswith("USE TEMP B-TREE"):
+                problems.append((name, detail))
+    return problems
+
+# --------------- Exportación / importación NDJSON ---------------
+# Por cada tabla, una línea de cabecera {"table": ..., "columns": [...]} y después una línea
+# por fila con los valores en ese orden (un array JSON se lee el doble de rápido que un
+# objeto). Solo viajan las columnas de origen: contadores, versiones e índice de búsqueda se
+# recalculan al importar. El orden de las tablas respeta las referencias entre ellas.
+NDJSON_TABLES = {
+    "users": ("id", "username", "password", "created_at"),
+    "threads": ("id", "title", "content", "author_id", "created_at"),
+    "replies": ("id", "content", "author_id", "thread_id", "created_at"),
+    "htb_machines": ("id", "name", "difficulty", "os", "ip", "status", "created_at"),
+}
+# Los volcados anteriores a author_id traen el nombre del autor en la columna "author"
+NDJSON_LEGACY_AUTHOR = "author"
+IMPORT_BATCH_SIZE = 5000
+# Filas por transacción: cada una deja la base de datos completa (triggers, contadores,
+# búsqueda) y es el punto desde el que se puede reanudar con --offset. También es lo que
+# espera la cola de escritura de un servidor en marcha
+IMPORT_COMMIT_ROWS = 100000
+SINCE_FORMATS = ("%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S")
+ndjson_encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+def parse_since(value):
+    # created_at se guarda como texto 'AAAA-MM-DD HH:MM[:SS]': se compara como cadena
+    for fmt in SINCE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).strftime("%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            pass
+    raise ValueError(f"{value!r} no tiene el formato AAAA-MM-DD[ HH:MM[:SS]]")
+
+def export_ndjson(db, out, tables=None, since=None, offset=0):
+    # Escribe las tablas en `out` fila a fila desde el cursor (memoria constante) dentro de
+    # una única transacción de lectura: el volcado es una foto coherente aunque haya
+    # escrituras. `offset` omite las primeras líneas para continuar un volcado cortado.
+    counts = {}
+    line_no = 0
+    db.execute("BEGIN")
+    try:
+        for table in tables or NDJSON_TABLES:
+            columns = NDJSON_TABLES[table]
+            sql = f"SELECT {', '.join(columns)} FROM {table}"
+            params = ()
+            if since:
+                sql += " WHERE created_at >= ?"
+                params = (since,)
+                if table == "threads":
+                    # Los hilos editados desde entonces también entran en el volcado incremental
+                    sql += " OR updated_at >= CAST(strftime('%s', ?) AS INTEGER)"
+                    params = (since, since)
+            line_no += 1
+            if line_no > offset:
+                out.write(ndjson_encode({"table": table, "columns": columns}) + "\n")
+            count = 0
+            for row in db.execute(sql + " ORDER BY id", params):
+                line_no += 1
+                count += 1
+                if line_no > offset:
+                    out.write(ndjson_encode(tuple(row)) + "\n")
+            counts[table] = count
+    finally:
+        db.rollback()
+    return counts
+
+def drop_triggers(cur):
+    # Para cargas masivas dentro de una transacción: devuelve (nombre, sql) para recrearlos
+    triggers = cur.execute("SELECT name, sql FROM sqlite_master WHERE type='trigger'").fetchall()
+    for name, _ in triggers:
+        cur.execute(f'DROP TRIGGER "{name}"')
+    return triggers
+
+class NdjsonImportError(ValueError):
+    def __init__(self, message, line_no, committed):
+        super().__init__(f"línea {line_no}: {message}")
+        self.line_no = line_no
+        # Última línea ya confirmada: se reanuda con --offset committed
+        self.committed = committed
+
+class NdjsonImporter:
+    # Upsert por id con executemany en lotes de `batch_size` y una transacción cada
+    # `commit_rows` filas. Durante la transacción se retiran los triggers (por fila costarían
+    # un UPDATE de threads y una inserción FTS cada una); al confirmar se recrean y lo que
+    # mantenían (búsqueda, contadores, versiones) se recalcula en bloque para las filas
+    # importadas, que se recuerdan como rangos de ids consecutivos.
+    def __init__(self, db, batch_size=IMPORT_BATCH_SIZE, commit_rows=IMPORT_COMMIT_ROWS):
+        self.db = db
+        self.cur = db.cursor()
+        self.batch_size = batch_size
+        self.commit_rows = commit_rows
+        self.table = None
+        self.lines = []
+        self.first_line = 0
+        self.pending = 0
+        self.triggers = None
+        self.ranges = {}
+        self.line_no = 0
+        self.committed = 0
+        self.counts = dict.fromkeys(NDJSON_TABLES, 0)
+        self.author_ids = {}
+        self.cur.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS import_ranges (kind TEXT NOT NULL, lo INTEGER NOT NULL, hi INTEGER NOT NULL)"
+        )
+
+    def header(self, header):
+        self.flush()
+        table, columns = header.get("table"), header.get("columns")
+        if table not in NDJSON_TABLES:
+            raise ValueError(f"tabla desconocida: {table!r}")
+        self.author_index = None
+        if columns and "author_id" in NDJSON_TABLES[table] and NDJSON_LEGACY_AUTHOR in columns:
+            self.author_index = columns.index(NDJSON_LEGACY_AUTHOR)
+            columns = [*columns[:self.author_index], "author_id", *columns[self.author_index + 1:]]
+        if not columns or "id" not in columns or not set(columns) <= set(NDJSON_TABLES[table]):
+            raise ValueError(f"columnas inválidas para {table}: {columns!r}")
+        self.table = table
+        self.width = len(columns)
+        self.id_index = columns.index("id")
+        self.thread_index = columns.index("thread_id") if table == "replies" and "thread_id" in columns else None
+        updates = ", ".join(f"{column}=excluded.{column}" for column in columns if column != "id")
+        self.sql = (
+            f"INSERT INTO {table}({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+            f"ON CONFLICT(id) DO {'UPDATE SET ' + updates if updates else 'NOTHING'}"
+        )
+
+    def add(self, line):
+        if self.table is None:
+            raise ValueError("fila antes de la primera cabecera de tabla")
+        if not self.lines:
+            self.first_line = self.line_no
+        self.lines.append(line)
+        if len(self.lines) >= self.batch_size:
+            self.flush()
+
+    def decode(self):
+        # Un json.loads por lote cuesta la mitad que uno por línea; si falla, se decodifica
+        # línea a línea para señalar la culpable
+        try:
+            rows = json.loads("[" + ",".join(self.lines) + "]")
+        except ValueError:
+            rows = None
+        for offset, line in enumerate(self.lines):
+            values = rows[offset] if rows is not None else None
+            if values is None:
+                self.line_no = self.first_line + offset
+                values = json.loads(line.rstrip("\n"))
+            if not isinstance(values, list) or len(values) != self.width:
+                self.line_no = self.first_line + offset
+                raise ValueError(f"se esperaban {self.width} valores para {self.table}")
+        return rows
+
+    def resolve_authors(self, rows):
+        # Volcado antiguo: nombre de autor → id, con los usuarios ya importados en esta transacción
+        index = self.author_index
+        missing = list({values[index] for values in rows} - self.author_ids.keys())
+        for start in range(0, len(missing), 500):
+            names = missing[start:start + 500]
+            self.cur.execute(f"SELECT username, id FROM users WHERE username IN ({', '.join('?' * len(names))})", names)
+            self.author_ids.update(self.cur.fetchall())
+        for values in rows:
+            author_id = self.author_ids.get(values[index])
+            if author_id is None:
+                raise ValueError(f"autor sin usuario: {values[index]!r}")
+            values[index] = author_id
+
+    def record_moves(self, rows):
+        # Una respuesta que el upsert cambia de hilo deja de contar en el anterior: su id se
+        # guarda como "moved_from" para recalcular también ese hilo al confirmar
+        new_threads = {values[self.id_index]: values[self.thread_index] for values in rows}
+        ids = list(new_threads)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            self.cur.execute(f"SELECT id, thread_id FROM replies WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+            moved = [[thread_id, thread_id] for reply_id, thread_id in self.cur.fetchall() if thread_id != new_threads[reply_id]]
+            if moved:
+                self.ranges.setdefault("moved_from", []).extend(moved)
+
+    def flush(self):
+        if not self.lines:
+            return
+        line_no = self.line_no
+        rows = self.decode()
+        if self.triggers is None:
+            self.begin()
+        if self.author_index is not None:
+            self.resolve_authors(rows)
+        if self.thread_index is not None:
+            self.record_moves(rows)
+        self.cur.executemany(self.sql, rows)
+        ranges = self.ranges.setdefault(self.table, [])
+        for values in rows:
+            row_id = values[self.id_index]
+            if ranges and ranges[-1][1] == row_id - 1:
+                ranges[-1][1] = row_id
+            else:
+                ranges.append([row_id, row_id])
+        self.counts[self.table] += len(rows)
+        self.pending += len(rows)
+        self.lines = []
+        self.line_no = line_no
+        if self.pending >= self.commit_rows:
+            self.commit()
+
+    def begin(self):
+        self.cur.execute("BEGIN IMMEDIATE")
+        self.triggers = drop_triggers(self.cur)
+
+    def commit(self):
+        if self.triggers is None:
+            return
+        cur = self.cur
+        for kind, ranges in self.ranges.items():
+            # Sin solapes (ids repetidos o desordenados en el fichero) cada fila sale una sola vez
+            merged = []
+            for lo, hi in sorted(ranges):
+                if merged and lo <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], hi)
+                else:
+                    merged.append([lo, hi])
+            self.ranges[kind] = merged
+        cur.executemany(
+            "INSERT INTO import_ranges(kind, lo, hi) VALUES (?, ?, ?)",
+            ((kind, lo, hi) for kind, ranges in self.ranges.items() for lo, hi in ranges),
+        )
+        # Índice de búsqueda: fuera la versión anterior de las filas importadas (rowid par =
+        # hilo, impar = respuesta) y dentro la nueva
+        cur.executemany(
+            "DELETE FROM search_index WHERE rowid BETWEEN ? AND ? AND rowid % 2 = ?",
+            [(lo * 2, hi * 2, 0) for lo, hi in self.ranges.get("threads", ())]
+            + [(lo * 2 + 1, hi * 2 + 1, 1) for lo, hi in self.ranges.get("replies", ())],
+        )
+        cur.execute(
+            "INSERT INTO search_index(rowid, title, content, thread_id) "
+            "SELECT t.id * 2, t.title, t.content, t.id FROM import_ranges i "
+            "JOIN threads t ON t.id BETWEEN i.lo AND i.hi WHERE i.kind = 'threads'"
+        )
+        cur.execute(
+            "INSERT INTO search_index(rowid, title, content, thread_id) "
+            "SELECT r.id * 2 + 1, '', r.content, r.thread_id FROM import_ranges i "
+            "JOIN replies r ON r.id BETWEEN i.lo AND i.hi WHERE i.kind = 'replies'"
+        )
+        for _, sql in self.triggers:
+            cur.execute(sql)
+        cur.execute(
+            "SELECT t.id FROM import_ranges i JOIN threads t ON t.id BETWEEN i.lo AND i.hi WHERE i.kind = 'threads' "
+            "UNION SELECT r.thread_id FROM import_ranges i JOIN replies r ON r.id BETWEEN i.lo AND i.hi "
+            "WHERE i.kind = 'replies' "
+            "UNION SELECT t.id FROM import_ranges i JOIN threads t ON t.id BETWEEN i.lo AND i.hi WHERE i.kind = 'moved_from'"
+        )
+        # Con los triggers ya recreados, cada hilo recalculado sube su versión, la del foro
+        # y su updated_at (versions_threads_au → threads_touch)
+        refresh_thread_counters(cur, [row[0] for row in cur.fetchall()])
+        if self.ranges.get("htb_machines"):
+            cur.execute("UPDATE versions SET version = version + 1 WHERE name = 'htb'")
+        if self.ranges.get("users"):
+            # Sin triggers un renombrado no subiría la versión de los nombres de usuario
+            cur.execute("UPDATE versions SET version = version + 1 WHERE name = 'users'")
+        cur.execute("DELETE FROM import_ranges")
+        self.db.commit()
+        self.triggers = None
+        self.ranges = {}
+        self.pending = 0
+        self.committed = self.line_no
+
+    def run(self, lines, offset=0):
+        # Las cabeceras se leen siempre (dicen a qué tabla van las filas siguientes); las
+        # filas de las primeras `offset` líneas se saltan sin decodificarlas
+        self.committed = offset
+        try:
+            for self.line_no, line in enumerate(lines, 1):
+                if line.startswith("{"):
+                    self.header(json.loads(line))
+                elif self.line_no > offset and line.strip():
+                    self.add(line)
+            self.flush()
+            self.commit()
+        except (ValueError, sqlite3.Error) as exc:
+            if self.db.in_transaction:
+                self.db.rollback()
+            raise NdjsonImportError(str(exc), self.line_no, self.committed) from exc
+        return self.counts
+
+# --------------- Datos sintéticos ---------------
+# Un foro grande y con el sesgo de uno real para pruebas de carga: pocos usuarios escriben
+# casi todo (Zipf), unos pocos hilos se llevan la mayoría de respuestas (Pareto), los textos
+# siguen una frecuencia de palabras tipo Zipf y las respuestas de hilos distintos se
+# intercalan en el tiempo (y en la tabla) como en producción. Todos los usuarios generados
+# comparten la contraseña SYNTHETIC_PASSWORD: un hash por usuario costaría horas.
+SYNTHETIC_PASSWORD = "nebula-bench"
+SYNTHETIC_WORDS = (
+    "de la que el en y a los se del las un por con no una su para es al lo como más pero sus le ya "
+    "hilo respuesta máquina shell root usuario puerto servicio exploit payload flag writeup escaneo "
+    "nmap burp reverse privesc kernel sudo cron ssh smb ldap kerberos hash john hashcat sql inyección "
+    "xss csrf ssrf lfi rce buffer overflow stack heap ret2libc rop gdb pwntools python bash powershell "
+    "windows linux docker apache nginx tomcat jenkins wordpress plugin versión parche cve enumeración "
+    "credenciales contraseña token cookie sesión api endpoint json proxy vpn túnel pivoting chisel"
+).split()
+
+def synthetic_words(rng, size=5000, sample=1 << 20):
+    # Palabras reales del foro al principio (las más frecuentes) y una cola de palabras
+    # inventadas, con pesos 1/rango. Devuelve una muestra larga de esa distribución: cada
+    # texto es un tramo al azar de ella (elegir palabra a palabra cuesta 10 veces más)
+    syllables = ["ka", "ra", "to", "mi", "ne", "lo", "su", "ve", "di", "po", "xe", "qu", "an", "or", "es"]
+    words = list(SYNTHETIC_WORDS)
+    seen = set(words)
+    while len(words) < size:
+        word = "".join(rng.choice(syllables) for _ in range(rng.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return rng.choices(words, cum_weights=list(itertools.accumulate(1 / rank for rank in range(1, size + 1))), k=sample)
+
+def synthetic_text(rng, sample, median_words):
+    length = min(max(3, int(rng.lognormvariate(math.log(median_words), 0.8))), 2000)
+    offset = rng.randrange(len(sample) - length)
+    return " ".join(sample[offset:offset + length])
+
+def generate_forum(db, users, threads, replies, days=365, seed=None, batch_size=IMPORT_BATCH_SIZE,
+                   password=SYNTHETIC_PASSWORD, on_progress=None):
+    # Añade usuarios, hilos y respuestas a los que ya haya (ids a continuación de los actuales).
+    # Cada lote es una transacción con los triggers retirados; al final, en otra, se indexan
+    # las filas nuevas en search_index y se recalculan sus contadores. Si se interrumpe a
+    # medias: flask nebula repair-counters && flask nebula rebuild-search. Con users=0 los
+    # autores salen de los usuarios que ya existen.
+    if replies and not threads:
+        raise ValueError("Las respuestas necesitan hilos nuevos en los que publicarse (threads > 0)")
+    rng = random.Random(seed)
+    cur = db.cursor()
+    words = synthetic_words(rng)
+    end = time.time()
+    start = end - days * 86400
+    first = {
+        table: cur.execute(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}").fetchone()[0]
+        for table in ("users", "threads", "replies")
+    }
+    password_hash = generate_password_hash(password, PASSWORD_HASH_METHOD)
+
+    def stamp(ts, seconds=True):
+        return time.strftime("%Y-%m-%d %H:%M:%S" if seconds else "%Y-%m-%d %H:%M", time.gmtime(ts))
+
+    def arrival_times(count):
+        # Instantes ordenados repartidos por [start, end) como llegadas de Poisson
+        ts, rate = start, count / (end - start)
+        for _ in range(count):
+            ts = min(ts + rng.expovariate(rate), end)
+            yield ts
+
+    def insert(table, sql, rows, total):
+        done = 0
+        for chunk in iter(lambda: list(itertools.islice(rows, batch_size)), []):
+            cur.execute("BEGIN IMMEDIATE")
+            triggers = drop_triggers(cur)
+            cur.executemany(sql, chunk)
+            for _, trigger_sql in triggers:
+                cur.execute(trigger_sql)
+            db.commit()
+            done += len(chunk)
+            if on_progress:
+                on_progress(table, done, total)
+
+    # Usuarios: los primeros registrados son los que más escriben
+    user_ids = range(first["users"], first["users"] + users)
+    user_times = arrival_times(users)
+    insert(
+        "users", "INSERT INTO users(id, username, password, created_at) VALUES (?,?,?,?)",
+        ((user_id, f"user{user_id}", password_hash, stamp(next(user_times))) for user_id in user_ids), users,
+    )
+    author_ids = user_ids
+    if not users and threads:
+        author_ids = [row[0] for row in cur.execute("SELECT id FROM users WHERE password != '!' ORDER BY id")]
+        if not author_ids:
+            raise ValueError("No hay usuarios a los que atribuir los hilos: genera alguno con users > 0")
+    author_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(author_ids) + 1)))
+
+    def authors():
+        while True:
+            yield from rng.choices(author_ids, cum_weights=author_weights, k=batch_size)
+
+    # Hilos: cada uno recibe una popularidad de cola pesada que decide cuántas respuestas atrae
+    thread_times = array("d")
+    thread_weights = array("d")
+
+    def thread_rows():
+        author, total_weight = authors(), 0.0
+        for i, ts in enumerate(arrival_times(threads)):
+            thread_times.append(ts)
+            total_weight += rng.paretovariate(1.2)
+            thread_weights.append(total_weight)
+            title = synthetic_text(rng, words, 6).capitalize()[:120]
+            content = synthetic_text(rng, words, 60)
+            yield first["threads"] + i, title, content, next(author), stamp(ts), int(ts)
+
+    insert(
+        "threads",
+        "INSERT INTO threads(id, title, content, author_id, created_at, updated_at) VALUES (?,?,?,?,?,?)",
+        thread_rows(), threads,
+    )
+
+    def reply_rows():
+        # Cada respuesta va a uno de los hilos ya creados en su instante, según su popularidad
+        author = authors()
+        for i, ts in enumerate(arrival_times(replies)):
+            available = max(1, bisect.bisect_right(thread_times, ts))
+            index = bisect.bisect_right(thread_weights, rng.random() * thread_weights[available - 1], 0, available - 1)
+            ts = max(ts, thread_times[index])
+            content = synthetic_text(rng, words, 20)
+            yield first["replies"] + i, content, next(author), first["threads"] + index, stamp(ts, seconds=False)
+
+    if threads:
+        insert(
+            "replies", "INSERT INTO replies(id, content, author_id, thread_id, created_at) VALUES (?,?,?,?,?)",
+            reply_rows(), replies,
+        )
+    cur.execute("BEGIN IMMEDIATE")
+    triggers = drop_triggers(cur)
+    cur.execute(
+        "INSERT INTO search_index(rowid, title, content, thread_id) SELECT id * 2, title, content, id FROM threads WHERE id >= ?",
+        (first["threads"],),
+    )
+    cur.execute(
+        "INSERT INTO search_index(rowid, title, content, thread_id) "
+        "SELECT id * 2 + 1, '', content, thread_id FROM replies WHERE id >= ?",
+        (first["replies"],),
+    )
+    refresh_thread_counters(cur, range(first["threads"], first["threads"] + threads))
+    for _, trigger_sql in triggers:
+        cur.execute(trigger_sql)
+    cur.execute("UPDATE versions SET version = version + 1 WHERE name = 'forum'")
+    db.commit()
+    if on_progress:
+        on_progress("search_index", 1, 1)
+    return {"users": users, "threads": threads, "replies": replies, "first_ids": first}
+
+# --------------- Copias de seguridad ---------------
+# Copia con la API de backup de SQLite a un fichero temporal, quick_check de la copia,
+# gzip y .sha256 al lado (comprobable con `sha256sum -c`). Restaurar: descomprimir sobre
+# DB_PATH con la app parada. Se conservan las BACKUP_KEEP más recientes.
+BACKUP_PREFIX = "nebula-"
+BACKUP_SUFFIX = ".sqlite3.gz"
+
+class BackupBusy(RuntimeError):
+    pass
+
+def backup_dir():
+    return BACKUP_DIR or os.path.join(os.path.dirname(DB_PATH), "backups")
+
+def backup_lock(directory):
+    # flock sobre el directorio de destino: una sola copia a la vez entre workers y CLI.
+    # Se libera al cerrar el descriptor (también si el proceso muere)
+    os.makedirs(directory, exist_ok=True)
+    fd = os.open(os.path.join(directory, ".lock"), os.O_CREAT | os.O_RDWR, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        raise BackupBusy("Ya hay una copia de seguridad en curso")
+    return fd
+
+def list_backups(directory=None):
+    directory = directory or backup_dir()
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    backups = []
+    for name in sorted(names, reverse=True):
+        if name.startswith(BACKUP_PREFIX) and name.endswith(BACKUP_SUFFIX):
+            stat = os.stat(os.path.join(directory, name))
+            backups.append({
+                "name": name,
+                "size": stat.st_size,
+                "created_at": datetime.utcfromtimestamp(stat.st_mtime).strftime("%Y-%m-%d %H:%M"),
+            })
+    return backups
+
+def prune_backups(directory, keep):
+    removed = []
+    for backup in list_backups(directory)[keep:]:
+        for path in (backup["name"], backup["name"] + ".sha256"):
+            try:
+                os.remove(os.path.join(directory, path))
+            except FileNotFoundError:
+                pass
+        removed.append(backup["name"])
+    return removed
+
+def copy_database(target_path, on_progress=None):
+    # Copia paginada de DB_PATH. En WAL la conexión de origen mantiene abierta una
+    # transacción de lectura: los escritores siguen confirmando en el WAL y la copia ve una
+    # foto fija. Sin ella, cada commit ajeno reinicia la copia desde la primera página (con
+    # escrituras frecuentes, nunca termina). En los modos con journal, ese bloqueo compartido
+    # frenaría a los escritores durante toda la copia: ahí se copia sin él y se cuentan los
+    # reinicios.
+    src = connect_db()
+    dst = sqlite3.connect(target_path)
+    progress = {"steps": 0, "restarts": 0, "pages": 0, "remaining": None}
+
+    def step(status, remaining, total):
+        if progress["remaining"] is not None and remaining > progress["remaining"]:
+            progress["restarts"] += 1
+        progress.update(steps=progress["steps"] + 1, pages=total, remaining=remaining)
+        if on_progress:
+            on_progress(total - remaining, total)
+        if remaining and BACKUP_STEP_PAUSE:
+            time.sleep(BACKUP_STEP_PAUSE)
+
+    try:
+        if src.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+            src.execute("BEGIN")
+            src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone()
+        src.backup(dst, pages=BACKUP_STEP_PAGES, progress=step)
+        src.rollback()
+        check = dst.execute("PRAGMA quick_check").fetchone()[0]
+    finally:
+        dst.close()
+        src.close()
+    if check != "ok":
+        raise sqlite3.DatabaseError(f"La copia no supera quick_check: {check}")
+    return progress
+
+def compress_backup(source_path, target_path, name):
+    # gzip por bloques con la misma pausa que la copia; devuelve el sha256 del .gz
+    digest = hashlib.sha256()
+    with open(source_path, "rb") as raw, open(target_path, "wb") as out:
+        with gzip.GzipFile(filename=name, mode="wb", compresslevel=BACKUP_GZIP_LEVEL, fileobj=out) as gz:
+            for chunk in iter(lambda: raw.read(1024 * 1024), b""):
+                gz.write(chunk)
+                if BACKUP_STEP_PAUSE:
+                    time.sleep(BACKUP_STEP_PAUSE)
+    with open(target_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def create_backup(directory=None, keep=None, on_progress=None):
+    directory = directory or backup_dir()
+    keep = BACKUP_KEEP if keep is None else keep
+    lock = backup_lock(directory)
+    try:
+        # Con microsegundos dos copias seguidas (una por CLI y otra desde el panel) no comparten
+        # nombre; si aun así existe (reloj atrasado) se falla en vez de sobrescribir
+        name = f"{BACKUP_PREFIX}{datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')}{BACKUP_SUFFIX}"
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            raise FileExistsError(f"La copia {name} ya existe")
+        # Los temporales empiezan por "." y no cuentan como copias hasta el os.replace final
+        snapshot = os.path.join(directory, f".{name}.sqlite3.tmp")
+        partial = os.path.join(directory, f".{name}.part")
+        start = time.perf_counter()
+        try:
+            progress = copy_database(snapshot, on_progress)
+            copied = time.perf_counter()
+            database_size = os.path.getsize(snapshot)
+            sha256 = compress_backup(snapshot, partial, name[: -len(".gz")])
+            os.replace(partial, path)
+        finally:
+            for temporary in (snapshot, partial):
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+        with open(path + ".sha256", "w", encoding="utf-8") as f:
+            f.write(f"{sha256}  {name}\n")
+        finished = time.perf_counter()
+        return {
+            "name": name,
+            "size": os.path.getsize(path),
+            "database_size": database_size,
+            "sha256": sha256,
+            "pages": progress["pages"],
+            "steps": progress["steps"],
+            "restarts": progress["restarts"],
+            "copy_s": round(copied - start, 3),
+            "compress_s": round(finished - copied, 3),
+            "pruned": prune_backups(directory, keep),
+        }
+    finally:
+        os.close(lock)
+
+class BackupManager:
+    # Copias lanzadas desde el panel: corren en un hilo del worker que recibe la petición
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._progress = None
+        self._last = None
+        self._error = None
+        self._runs = 0
+        self._failures = 0
+
+    def running(self):
+        with self._lock:
+            return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                raise BackupBusy("Ya hay una copia de seguridad en curso")
+            # Otro worker o la CLI: el flock lo detecta antes de lanzar el hilo
+            os.close(backup_lock(backup_dir()))
+            self._progress = (0, 0)
+            self._thread = threading.Thread(target=self._run, name="nebula-backup", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        try:
+            result = create_backup(on_progress=self._record_progress)
+        except Exception as exc:
+            logger.exception("Copia de seguridad fallida")
+            with self._lock:
+                self._failures += 1
+                self._error = str(exc)
+        else:
+            logger.info("Copia de seguridad %s (%s bytes)", result["name"], result["size"])
+            with self._lock:
+                self._runs += 1
+                self._last = result
+                self._error = None
+
+    def _record_progress(self, done, total):
+        with self._lock:
+            self._progress = (done, total)
+
+    def status(self):
+        with self._lock:
+            running = self._thread is not None and self._thread.is_alive()
+            done, total = self._progress or (0, 0)
+            return {
+                "running": running,
+                "percent": round(done * 100 / total) if running and total else None,
+                "last": self._last,
+                "error": self._error,
+            }
+
+    def stats(self):
+        status = self.status()
+        with self._lock:
+            status.update(runs=self._runs, failures=self._failures)
+        return status
+
+backups = BackupManager()
+
+# --------------- Baneos ---------------
+# Un baneo borra las respuestas del usuario, sus hilos (con las respuestas de otros en ellos)
+# y el usuario. Hasta BAN_CHUNK_ROWS filas es una única transacción; si no, se borra en
+# tramos de ese tamaño (cada uno su transacción en la cola de escritura, con los contadores
+# al día entre tramos) y la última transacción borra lo publicado mientras tanto y al usuario.
+# El estado vive en la tabla bans: la primera transacción crea la fila (desde ahí el usuario
+# no puede entrar ni publicar), cada tramo suma su avance y renueva el latido del worker
+# dueño, y la última la marca como terminada. Un baneo sin terminar y sin latido reciente
+# (fallido o de un worker caído) se retoma con BanManager.resume().
+def ban_counts(cur, user_id):
+    cur.execute(
+        """
+        SELECT (SELECT COUNT(*) FROM replies WHERE author_id = ?1)
+             + (SELECT COUNT(*) FROM threads t JOIN replies r ON r.thread_id = t.id WHERE t.author_id = ?1 AND r.author_id != ?1)
+             + (SELECT COUNT(*) FROM threads WHERE author_id = ?1)
+        """,
+        (user_id,),
+    )
+    return cur.fetchone()[0]
+
+def is_banned(cur, user_id):
+    cur.execute("SELECT 1 FROM bans WHERE user_id=? AND finished IS NULL", (user_id,))
+    return cur.fetchone() is not None
+
+def ban_claim(cur, user_id, username, remaining, chunked, owner):
+    # Crea o retoma la fila del baneo; falla si otro worker lo está haciendo ahora mismo
+    now = time.time()
+    cur.execute("SELECT owner, heartbeat FROM bans WHERE user_id=? AND finished IS NULL", (user_id,))
+    row = cur.fetchone()
+    if row and row[0] is not None and now - row[1] < BAN_STALE_SECONDS:
+        raise BanBusy(f"El baneo de '{username}' ya está en curso")
+    cur.execute(
+        """
+        INSERT INTO bans(user_id, username, total, chunked, owner, heartbeat, started)
+        VALUES (?,?,?,?,?,?,?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            total = done + excluded.total, chunked = excluded.chunked, owner = excluded.owner,
+            heartbeat = excluded.heartbeat, error = NULL
+        """,
+        (user_id, username, remaining, int(chunked), owner, now, now),
+    )
+
+def ban_progress(cur, user_id, owner, deleted):
+    if owner is None:
+        return
+    cur.execute(
+        "UPDATE bans SET done = done + ?, heartbeat = ? WHERE user_id=? AND owner=?",
+        (deleted, time.time(), user_id, owner),
+    )
+    if not cur.rowcount:
+        # Otro worker lo dio por abandonado y lo retomó: este tramo se deshace
+        raise BanBusy("El baneo lo ha retomado otro proceso")
+
+def ban_step(cur, step, user_id, limit, owner):
+    deleted = step(cur, user_id, limit)
+    ban_progress(cur, user_id, owner, deleted)
+    return deleted
+
+def ban_chunk_replies(cur, user_id, limit):
+    return delete_replies(cur, BAN_REPLIES_CHUNK, (user_id, limit))
+
+def ban_chunk_thread_replies(cur, user_id, limit):
+    # Respuestas de otros en los hilos del usuario: así el borrado de cada hilo es pequeño
+    return delete_replies(cur, BAN_THREAD_REPLIES_CHUNK, (user_id, limit))
+
+def ban_chunk_threads(cur, user_id, limit):
+    return delete_threads(cur, BAN_THREADS_CHUNK, (user_id, limit))
+
+def ban_finish(cur, user_id, owner=None):
+    removed = delete_replies(cur, "author_id=?", (user_id,))
+    removed += delete_threads(cur, "author_id=?", (user_id,))
+    ban_progress(cur, user_id, owner, removed)
+    cur.execute("DELETE FROM users WHERE id=?", (user_id,))
+    cur.execute(
+        "UPDATE bans SET finished = ?, heartbeat = ?, owner = NULL WHERE user_id=?",
+        (time.time(), time.time(), user_id),
+    )
+    return removed
+
+def ban_fail(cur, user_id, owner, error):
+    # Sin dueño se puede reintentar (desde el panel o con resume) en lugar de esperar al latido
+    cur.execute(
+        "UPDATE bans SET owner = NULL, heartbeat = ?, error = ? WHERE user_id=? AND owner=?",
+        (time.time(), error, user_id, owner),
+    )
+
+def ban_user_content(user_id, chunk_rows=BAN_CHUNK_ROWS, owner=None):
+    done = 0
+    for step in (ban_chunk_replies, ban_chunk_thread_replies, ban_chunk_threads):
+        while True:
+            deleted = run_write(ban_step, step, user_id, chunk_rows, owner)
+            done += deleted
+            if deleted < chunk_rows:
+                break
+    done += run_write(ban_finish, user_id, owner)
+    invalidate_thread_fragments()
+    return done
+
+class BanBusy(RuntimeError):
+    pass
+
+class BanManager:
+    # Baneos grandes en un hilo del worker que los empieza (o retoma); el progreso que ve el
+    # panel sale de la tabla bans, así que cualquier worker lo muestra
+    def __init__(self, chunk_rows=BAN_CHUNK_ROWS):
+        self.chunk_rows = chunk_rows
+        self._lock = threading.Lock()
+        self._running = set()
+        self._bans = 0
+        self._chunked = 0
+        self._failures = 0
+        self._resumed = 0
+        self._rows = 0
+
+    def ban(self, user_id, username, remaining, background=True):
+        # Los pequeños (y todos con background=False) se hacen aquí mismo; devuelve el trabajo
+        # con "error" si falló. BanBusy si otro hilo o worker ya lo está haciendo
+        job = {
+            "user_id": user_id, "username": username, "total": remaining,
+            "chunked": remaining > self.chunk_rows, "owner": os.urandom(8).hex(),
+        }
+        run_write(ban_claim, user_id, username, remaining, job["chunked"], job["owner"])
+        with self._lock:
+            self._running.add(user_id)
+        if job["chunked"] and background:
+            threading.Thread(target=self._run, args=(job,), name=f"nebula-ban-{user_id}", daemon=True).start()
+        else:
+            self._run(job)
+        return job
+
+    def resume(self, background=True):
+        # Retoma los baneos sin terminar que nadie está haciendo: al arrancar un worker
+        # (serve.py) o con `flask nebula resume-bans`. Varios workers a la vez no chocan:
+        # ban_claim deja pasar a uno
+        db = connect_db()
+        try:
+            cur = db.cursor()
+            cur.execute("SELECT user_id, username, owner, heartbeat FROM bans WHERE finished IS NULL")
+            pending = [
+                (user_id, username) for user_id, username, owner, heartbeat in cur.fetchall()
+                if owner is None or time.time() - heartbeat >= BAN_STALE_SECONDS
+            ]
+            jobs = []
+            for user_id, username in pending:
+                try:
+                    jobs.append(self.ban(user_id, username, ban_counts(cur, user_id), background))
+                except BanBusy:
+                    continue
+                with self._lock:
+                    self._resumed += 1
+                logger.info("Baneo de %s retomado", username)
+            return jobs
+        finally:
+            db.close()
+
+    def _run(self, job):
+        try:
+            if job["chunked"]:
+                removed = ban_user_content(job["user_id"], self.chunk_rows, job["owner"])
+            else:
+                removed = run_write(ban_finish, job["user_id"], job["owner"])
+                invalidate_thread_fragments()
+            user_names.discard(job["user_id"])
+        except Exception as exc:
+            logger.exception("Baneo de %s fallido", job["username"])
+            job["error"] = str(exc)
+            try:
+                run_write(ban_fail, job["user_id"], job["owner"], job["error"])
+            except Exception:
+                logger.exception("No se pudo guardar el fallo del baneo de %s", job["username"])
+            with self._lock:
+                self._failures += 1
+        else:
+            job["done"] = removed
+            with self._lock:
+                self._bans += 1
+                self._chunked += job["chunked"]
+                self._rows += removed
+            if job["chunked"]:
+                logger.info("Usuario %s baneado: %d filas", job["username"], removed)
+        finally:
+            with self._lock:
+                self._running.discard(job["user_id"])
+
+    def status(self, cur, limit=10):
+        # En curso (de cualquier worker) y los últimos terminados o fallidos
+        columns = "user_id, username, total, done, chunked, error, started, finished, heartbeat"
+        cur.execute(f"SELECT {columns} FROM bans WHERE finished IS NULL")
+        pending = [dict(row) for row in cur.fetchall()]
+        cur.execute(f"SELECT {columns} FROM bans WHERE finished IS NOT NULL ORDER BY finished DESC LIMIT ?", (limit,))
+        running = [job for job in pending if job["error"] is None]
+        for job in running:
+            job["percent"] = min(100, job["done"] * 100 // job["total"]) if job["total"] else 100
+        finished = [job for job in pending if job["error"] is not None] + [dict(row) for row in cur.fetchall()]
+        finished.sort(key=lambda job: job["heartbeat"], reverse=True)
+        for job in finished:
+            job["seconds"] = round(job["heartbeat"] - job["started"], 2)
+        return {"running": running, "finished": finished[:limit]}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": len(self._running),
+                "bans": self._bans,
+                "chunked": self._chunked,
+                "failures": self._failures,
+                "resumed": self._resumed,
+                "rows_deleted": self._rows,
+                "chunk_rows": self.chunk_rows,
+            }
+
+bans = BanManager()
+
+# --------------- Perfilador por muestreo ---------------
+# Un hilo que, mientras dura la sesión, lee sys._current_frames() cada PROFILE_INTERVAL y
+# cuenta las pilas de los hilos que están atendiendo una petición (tienen Flask.wsgi_app en
+# la pila; con all_threads, todos). Parado no existe ni el hilo ni ningún hook: coste cero.
+# Las pilas van de la raíz a la hoja, "modulo:funcion" separadas por ';', con su número de
+# muestras: flamegraph.pl perfil.folded > perfil.svg
+PROFILE_SUFFIX = ".folded"
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+def profile_dir():
+    return PROFILE_DIR or os.path.join(os.path.dirname(DB_PATH), "profiles")
+
+class SamplingProfiler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._current = None
+        self._last = None
+        self._runs = 0
+        self._labels = {}
+
+    def running(self):
+        with self._lock:
+            return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds=None, all_threads=False, exclude=()):
+        # Devuelve el nombre del fichero que se escribirá al terminar
+        seconds = min(seconds or PROFILE_SECONDS, PROFILE_MAX_SECONDS)
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                raise ProfilerBusy("Ya hay un perfil en curso en este worker")
+            name = f"profile-{os.getpid()}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}{PROFILE_SUFFIX}"
+            self._current = {"name": name, "seconds": seconds, "started": time.time(), "pid": os.getpid()}
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, args=(name, seconds, all_threads, set(exclude)), name="nebula-profiler", daemon=True
+            )
+            self._thread.start()
+        return name
+
+    def stop(self):
+        self._stop.set()
+
+    def wait(self, timeout=None):
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _label(self, code, module):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{module}:{getattr(code, 'co_qualname', code.co_name)}"
+        return label
+
+    def _run(self, name, seconds, all_threads, exclude):
+        request_code = Flask.wsgi_app.__code__
+        exclude.add(threading.get_ident())
+        counts = {}
+        samples = 0
+        sampling = 0.0
+        deadline = time.monotonic() + seconds
+        started = time.perf_counter()
+        while not self._stop.wait(PROFILE_INTERVAL) and time.monotonic() < deadline:
+            tick = time.perf_counter()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in exclude:
+                    continue
+                stack = []
+                in_request = all_threads
+                while frame is not None:
+                    code = frame.f_code
+                    in_request = in_request or code is request_code
+                    stack.append(self._label(code, frame.f_globals.get("__name__", "?")))
+                    frame = frame.f_back
+                if in_request:
+                    key = ";".join(reversed(stack))
+                    counts[key] = counts.get(key, 0) + 1
+            samples += 1
+            sampling += time.perf_counter() - tick
+        elapsed = time.perf_counter() - started
+        directory = profile_dir()
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = os.path.join(directory, name + ".part")
+        with open(tmp_path, "w", encoding="utf-8") as out:
+            for key, count in sorted(counts.items(), key=lambda item: -item[1]):
+                out.write(f"{key} {count}\n")
+        os.replace(tmp_path, os.path.join(directory, name))
+        try:
+            for old in list_profiles(directory)[PROFILE_KEEP:]:
+                try:
+                    os.remove(os.path.join(directory, old["name"]))
+                except FileNotFoundError:
+                    pass
+        except OSError:
+            # El perfil ya está escrito: una poda fallida no debe dejar el perfilador a medias
+            logger.exception("No se pudieron podar los perfiles antiguos de %s", directory)
+        result = {
+            "name": name, "pid": os.getpid(), "seconds": round(elapsed, 2), "samples": samples,
+            "stacks": sum(counts.values()), "sample_avg_ms": round(sampling * 1000 / samples, 3) if samples else 0.0,
+        }
+        logger.info("Perfil %s: %d muestras, %d pilas en peticiones", name, samples, result["stacks"])
+        with self._lock:
+            self._runs += 1
+            self._last = result
+            self._current = None
+
+    def status(self):
+        with self._lock:
+            running = self._thread is not None and self._thread.is_alive()
+            return {"running": running, "current": self._current if running else None, "last": self._last}
+
+    def stats(self):
+        status = self.status()
+        with self._lock:
+            status.update(runs=self._runs, interval_ms=PROFILE_INTERVAL * 1000)
+        return status
+
+def list_profiles(directory=None):
+    # Del más reciente al más antiguo según la fecha del nombre (profile-<pid>-<fecha>.folded);
+    # el resto de ficheros del directorio se ignora
+    directory = directory or profile_dir()
+    try:
+        names = [
+            name for name in os.listdir(directory)
+            if name.startswith("profile-") and name.endswith(PROFILE_SUFFIX)
+        ]
+    except FileNotFoundError:
+        return []
+    profiles = []
+    # Un nombre sin <pid>-<fecha> va al final, el primero en podarse
+    for name in sorted(names, key=lambda name: (name.split("-", 2) + [""])[2], reverse=True):
+        try:
+            size = os.path.getsize(os.path.join(directory, name))
+        except FileNotFoundError:
+            continue  # podado mientras tanto por otro worker
+        profiles.append({"name": name, "size": size})
+    return profiles
+
+profiler = SamplingProfiler()
+
+def install_profile_signal(signum=signal.SIGUSR2):
+    # kill -USR2 <pid del worker> → perfil de PROFILE_SECONDS. Solo desde el hilo principal;
+    # el manejador apenas lanza el hilo del perfilador
+    def handle(signum, frame):
+        try:
+            name = profiler.start()
+        except ProfilerBusy:
+            return
+        logger.warning("Perfil por señal en marcha: %s", os.path.join(profile_dir(), name))
+
+    signal.signal(signum, handle)
+
 # --------------- Template & Asset Writers ---------------
 def write_file(path: str, content: str):
     with open(path, "w", encoding="utf-8") as f:
@@ -168,9 +2203,12 @@ body { transition: background-color .4s ease, color .4s ease; }
   <meta charset="utf-8" />
   <meta name="viewport" content="width=device-width, initial-scale=1" />
   <title>{{ title or '""" + APP_NAME + r"""' }}</title>
+  {% if asset_url('app.css') %}
+  <link rel="stylesheet" href="{{ asset_url('app.css') }}">
+  {% else %}
+  {# Sin `flask nebula build-assets`: Tailwind se compila en el navegador #}
   <script src="https://cdn.tailwindcss.com"></script>
-  <script defer src="https://unpkg.com/alpinejs@3.x.x/dist/cdn.min.js"></script>
-  <link rel="stylesheet" href="{{ url_for('static', filename='style.css') }}">
+  <link rel="stylesheet" href="{{ asset_url('style.css') or url_for('static', filename='style.css') }}">
   <link rel="preconnect" href="https://fonts.googleapis.com">
   <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
   <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;600;800&display=swap" rel="stylesheet">
@@ -184,6 +2222,8 @@ body { transition: background-color .4s ease, color .4s ease; }
       }
     }
   </script>
+  {% endif %}
+  <script defer src="{{ asset_url('alpine.js') or '""" + ALPINE_CDN_URL + r"""' }}"></script>
   <style> body{font-family:Inter,ui-sans-serif,system-ui;} </style>
 </head>
 <body class="min-h-screen bg-gradient-to-br from-slate-50 via-slate-100 to-slate-200 dark:from-gray-900 dark:via-slate-900 dark:to-black text-slate-800 dark:text-slate-100">
@@ -197,6 +2237,7 @@ body { transition: background-color .4s ease, color .4s ease; }
         {% if session.get('user') %}
           <a class="px-3 py-2 rounded-xl lift hover:bg-indigo-50 dark:hover:bg-white/10" href="{{ url_for('threads') }}">Hilos</a>
           <a class="px-3 py-2 rounded-xl lift hover:bg-indigo-50 dark:hover:bg-white/10" href="{{ url_for('htb') }}">HTB</a>
+          <a class="px-3 py-2 rounded-xl lift hover:bg-indigo-50 dark:hover:bg-white/10" href="{{ url_for('search') }}">Buscar</a>
           <a class="px-3 py-2 rounded-xl lift hover:bg-indigo-50 dark:hover:bg-white/10" href="{{ url_for('profile') }}">
             {{ session['user'] }}
             {% if session['user'] == 'admin' %}
@@ -339,13 +2380,18 @@ body { transition: background-color .4s ease, color .4s ease; }
   <h2 class="text-2xl md:text-3xl font-extrabold">Hilos del Foro</h2>
   <a href="{{ url_for('create_thread') }}" class="px-5 py-3 rounded-xl font-bold text-white bg-gradient-to-r from-indigo-600 to-purple-600 lift">Nuevo hilo</a>
 </div>
+{{ thread_list }}
+{% endblock %}
+"""
+    # Fragmentos cacheados (ver FragmentCache): no pueden depender de la sesión
+    thread_list_html = r"""
 <div class="grid gap-4">
   {% for thread in threads %}
     <a href="{{ url_for('thread_detail', id=thread['id']) }}" class="glass rounded-2xl p-5 border border-white/20 lift block">
       <h3 class="text-lg md:text-xl font-bold mb-1">{{ thread['title'] }}</h3>
       <p class="text-sm text-slate-600 dark:text-slate-300 clamp-2">{{ thread['content'] }}</p>
       <div class="mt-3 flex items-center justify-between text-xs text-slate-500 dark:text-slate-400">
-        <span>Autor: <strong>{{ thread['author'] }}</strong></span>
+        <span>Autor: <strong>{{ thread['author_id'] | username }}</strong></span>
         <span>Respuestas: {{ thread['reply_count'] }}</span>
       </div>
     </a>
@@ -353,21 +2399,25 @@ body { transition: background-color .4s ease, color .4s ease; }
     <div class="text-slate-600 dark:text-slate-300">Aún no hay hilos. ¡Crea el primero!</div>
   {% endfor %}
 </div>
-{% endblock %}
+{% if after or next_after %}
+  <div class="mt-6 flex items-center justify-between">
+    {% if after %}<a href="{{ url_for('threads', limit=limit) }}" class="px-4 py-2 rounded-xl glass border border-white/20 lift">« Más recientes</a>{% else %}<span></span>{% endif %}
+    {% if next_after %}<a href="{{ url_for('threads', after=next_after, limit=limit) }}" class="px-4 py-2 rounded-xl glass border border-white/20 lift">Página siguiente »</a>{% endif %}
+  </div>
+{% endif %}
 """
     thread_detail_html = r"""
 {% extends 'base.html' %}
 {% block content %}
 <article class="glass rounded-3xl p-8 border border-white/20 mb-8">
-  <h1 class="text-2xl md:text-3xl font-extrabold mb-2">{{ thread['title'] }}</h1>
-  <p class="text-sm text-slate-500 dark:text-slate-400 mb-6">Por <strong>{{ thread['author'] }}</strong> · {{ thread['created_at'] }}</p>
-  <div class="prose dark:prose-invert max-w-none">{{ thread['content'] }}</div>
-  {% if session['user'] == thread['author'] or session['user'] == 'admin' %}
+  {{ thread_body }}
+  {% set is_author = session['user'] == thread['author_id'] | username %}
+  {% if is_author or session['user'] == 'admin' %}
     <div class="mt-6 flex gap-2">
-      {% if session['user'] == thread['author'] %}
+      {% if is_author %}
         <a href="{{ url_for('edit_thread', id=thread['id']) }}" class="px-4 py-2 rounded-xl bg-amber-500 text-white lift">Editar</a>
       {% endif %}
-      <a href="{{ url_for('delete_thread', id=thread['id']) if session['user'] == thread['author'] else url_for('admin_delete_thread', thread_id=thread['id']) }}" 
+      <a href="{{ url_for('delete_thread', id=thread['id']) if is_author else url_for('admin_delete_thread', thread_id=thread['id']) }}" 
          class="px-4 py-2 rounded-xl bg-rose-600 text-white lift" 
          onclick="return confirm('¿Eliminar este hilo y todas sus respuestas?');">Eliminar</a>
     </div>
@@ -375,32 +2425,103 @@ body { transition: background-color .4s ease, color .4s ease; }
 </article>
 <section class="mb-8">
   <h2 class="text-xl font-bold mb-3">Respuestas</h2>
-  <div class="space-y-3">
-    {% for reply in replies %}
-      <div class="glass rounded-xl p-4 border border-white/20 flex items-start justify-between">
-        <div>
-          <p class="text-sm text-slate-500 dark:text-slate-400 mb-1">{{ reply['author'] }} · {{ reply['created_at'] }}</p>
-          <p>{{ reply['content'] }}</p>
-        </div>
-        {% if session['user'] == reply['author'] %}
-          <a href="{{ url_for('delete_reply', id=reply['id']) }}" class="text-rose-500 hover:underline" onclick="return confirm('¿Eliminar respuesta?');">Eliminar</a>
-        {% endif %}
-      </div>
-    {% else %}
-      <p class="text-slate-600 dark:text-slate-300">No hay respuestas todavía.</p>
-    {% endfor %}
-  </div>
+  {{ reply_list }}
 </section>
 <form method="post" class="glass rounded-2xl p-6 border border-white/20 space-y-3" data-hotkey="submit">
   <label class="block text-sm">Nueva respuesta</label>
   <textarea name="content" rows="4" required class="w-full px-4 py-3 rounded-xl border border-slate-300/70 dark:border-white/10 bg-white/80 dark:bg-white/5 focus-glow" placeholder="Escribe tu respuesta..."></textarea>
   <button class="px-5 py-3 rounded-xl font-bold text-white bg-gradient-to-r from-indigo-600 to-purple-600 lift">Responder (Ctrl+Enter)</button>
 </form>
+<script>
+  // Las respuestas llegan cacheadas para todos; aquí se muestran los enlaces del usuario actual
+  function showOwnActions(root){
+    root.querySelectorAll('[data-owner]').forEach((el)=>{ if(el.dataset.owner === {{ session['user']|tojson }}) el.hidden = false; });
+  }
+  showOwnActions(document);
+  // Respuestas nuevas en directo (solo en la última página)
+  (function(){
+    const list = document.getElementById('replies');
+    if(!list || !window.EventSource || list.dataset.live !== 'on') return;
+    function connect(){
+      const source = new EventSource({{ url_for('thread_events', id=thread['id'])|tojson }} + '?after=' + list.dataset.last);
+      source.addEventListener('reply', (e)=>{
+        list.dataset.last = e.lastEventId;
+        if(document.getElementById('reply-' + e.lastEventId)) return;
+        const empty = list.querySelector('[data-empty]');
+        if(empty) empty.remove();
+        list.insertAdjacentHTML('beforeend', e.data);
+        showOwnActions(list.lastElementChild);
+      });
+      // Sin hueco en el servidor (503) EventSource no reintenta: se vuelve a probar más tarde
+      source.onerror = ()=>{ if(source.readyState === EventSource.CLOSED) setTimeout(connect, 30000); };
+    }
+    connect();
+  })();
+</script>
 {% endblock %}
 """
-    create_thread_html = r"""
-{% extends 'base.html' %}
-{% block content %}
+    thread_body_html = r"""
+<h1 class="text-2xl md:text-3xl font-extrabold mb-2">{{ thread['title'] }}</h1>
+<p class="text-sm text-slate-500 dark:text-slate-400 mb-6">Por <strong>{{ thread['author_id'] | username }}</strong> · {{ thread['created_at'] }}</p>
+<div class="prose dark:prose-invert max-w-none">{{ thread['content'] }}</div>
+"""
+    reply_list_html = r"""
+<div id="replies" class="space-y-3" data-live="{{ 'off' if next_after else 'on' }}" data-last="{{ replies[-1]['id'] if replies else (after or 0) }}">
+  {% for reply in replies %}
+    {% include '_reply.html' %}
+  {% else %}
+    <p data-empty class="text-slate-600 dark:text-slate-300">No hay respuestas todavía.</p>
+  {% endfor %}
+</div>
+{% if after or next_after %}
+  <div class="mt-4 flex items-center justify-between">
+    {% if after %}<a href="{{ url_for('thread_detail', id=thread['id'], limit=limit) }}" class="px-4 py-2 rounded-xl glass border border-white/20 lift">« Primeras respuestas</a>{% else %}<span></span>{% endif %}
+    {% if next_after %}<a href="{{ url_for('thread_detail', id=thread['id'], after=next_after, limit=limit) }}" class="px-4 py-2 rounded-xl glass border border-white/20 lift">Más respuestas »</a>{% endif %}
+  </div>
+{% endif %}
+"""
+    reply_html = r"""
+<div id="reply-{{ reply['id'] }}" class="glass rounded-xl p-4 border border-white/20 flex items-start justify-between">
+  <div>
+    <p class="text-sm text-slate-500 dark:text-slate-400 mb-1">{{ reply['author_id'] | username }} · {{ reply['created_at'] }}</p>
+    <p>{{ reply['content'] }}</p>
+  </div>
+  <a href="{{ url_for('delete_reply', id=reply['id']) }}" data-owner="{{ reply['author_id'] | username }}" hidden class="text-rose-500 hover:underline" onclick="return confirm('¿Eliminar respuesta?');">Eliminar</a>
+</div>
+"""
+    search_html = r"""
+{% extends 'base.html' %}
+{% block content %}
+<form method="get" class="glass rounded-2xl p-4 border border-white/20 flex gap-3 mb-6">
+  <input name="q" value="{{ q }}" autofocus class="flex-1 px-4 py-3 rounded-xl border border-slate-300/70 dark:border-white/10 bg-white/80 dark:bg-white/5 focus-glow" placeholder="Buscar en hilos y respuestas..." />
+  <button class="px-5 py-3 rounded-xl font-bold text-white bg-gradient-to-r from-indigo-600 to-purple-600 lift">Buscar</button>
+</form>
+{% if q %}
+  <div class="grid gap-4">
+    {% for result in results %}
+      <a href="{{ url_for('thread_detail', id=result.thread_id, after=result.reply_id - 1, _anchor='reply-%d' % result.reply_id) if result.reply_id else url_for('thread_detail', id=result.thread_id) }}" class="glass rounded-2xl p-5 border border-white/20 lift block">
+        <div class="flex items-center gap-2 mb-1">
+          <span class="px-2 py-0.5 rounded-full text-xs font-medium {{ 'bg-indigo-100 text-indigo-800' if not result.reply_id else 'bg-slate-200 text-slate-700' }}">{{ 'Respuesta' if result.reply_id else 'Hilo' }}</span>
+          <h3 class="font-bold">{{ result.thread_title }}</h3>
+        </div>
+        <p class="text-sm text-slate-600 dark:text-slate-300 [&_mark]:bg-amber-200 [&_mark]:rounded [&_mark]:px-0.5">{{ result.excerpt }}</p>
+      </a>
+    {% else %}
+      <div class="text-slate-600 dark:text-slate-300">Sin resultados para «{{ q }}».</div>
+    {% endfor %}
+  </div>
+  {% if page > 1 or has_next %}
+    <div class="mt-6 flex items-center justify-between">
+      {% if page > 1 %}<a href="{{ url_for('search', q=q, page=page - 1) }}" class="px-4 py-2 rounded-xl glass border border-white/20 lift">« Anterior</a>{% else %}<span></span>{% endif %}
+      {% if has_next %}<a href="{{ url_for('search', q=q, page=page + 1) }}" class="px-4 py-2 rounded-xl glass border border-white/20 lift">Siguiente »</a>{% endif %}
+    </div>
+  {% endif %}
+{% endif %}
+{% endblock %}
+"""
+    create_thread_html = r"""
+{% extends 'base.html' %}
+{% block content %}
 <div class="max-w-3xl mx-auto glass rounded-3xl p-8 border border-white/20">
   <h2 class="text-2xl md:text-3xl font-extrabold mb-6">Crear nuevo hilo</h2>
   <form method="post" class="space-y-5" data-hotkey="submit">
@@ -631,14 +2752,21 @@ body { transition: background-color .4s ease, color .4s ease; }
           {% for user in users %}
           <tr class="border-b border-white/10">
             <td class="py-3 px-4">{{ user['id'] }}</td>
-            <td class="py-3 px-4 font-medium">{{ user['username'] }}</td>
+            <td class="py-3 px-4 font-medium">
+              {{ user['username'] }}
+              {% if user['placeholder'] %}<span class="ml-2 px-2 py-0.5 rounded-md bg-slate-500/20 text-xs text-slate-600 dark:text-slate-300" title="Autor importado sin cuenta: no puede iniciar sesión">sin cuenta</span>{% endif %}
+            </td>
             <td class="py-3 px-4 text-sm text-slate-600 dark:text-slate-300">{{ user['created_at'] }}</td>
             <td class="py-3 px-4">
+              {% if user['id'] in banning %}
+              <span class="px-3 py-1 rounded-lg bg-rose-600/60 text-white text-sm">Baneando… {{ banning[user['id']].percent }}%</span>
+              {% else %}
               <a href="{{ url_for('ban_user', user_id=user['id']) }}" 
                  class="px-3 py-1 rounded-lg bg-rose-600 text-white text-sm lift"
                  onclick="return confirm('¿Estás seguro de que quieres banear a este usuario? Se eliminarán todas sus publicaciones y respuestas.');">
                 Banear
               </a>
+              {% endif %}
             </td>
           </tr>
           {% else %}
@@ -651,6 +2779,20 @@ body { transition: background-color .4s ease, color .4s ease; }
         </tbody>
       </table>
     </div>
+    {% for job in ban_status.finished if job.chunked %}
+      {% if loop.first %}<ul class="mt-4 space-y-1 text-sm text-slate-600 dark:text-slate-300">{% endif %}
+        <li>
+          {% if job.error %}<span class="text-rose-500">Baneo de {{ job.username }} fallido: {{ job.error }}</span>
+          {% else %}{{ job.username }} baneado: {{ job.done }} filas en {{ job.seconds }} s{% endif %}
+        </li>
+      {% if loop.last %}</ul>{% endif %}
+    {% endfor %}
+    {% if users_after or users_next %}
+      <div class="mt-4 flex items-center justify-between text-sm">
+        {% if users_after %}<a href="{{ url_for('admin_panel', threads_after=threads_after, users_limit=users_limit, threads_limit=threads_limit) }}" class="px-3 py-1 rounded-lg glass border border-white/20 lift">« Primeros usuarios</a>{% else %}<span></span>{% endif %}
+        {% if users_next %}<a href="{{ url_for('admin_panel', users_after=users_next, threads_after=threads_after, users_limit=users_limit, threads_limit=threads_limit) }}" class="px-3 py-1 rounded-lg glass border border-white/20 lift">Más usuarios »</a>{% endif %}
+      </div>
+    {% endif %}
   </div>
   
   <!-- Sección de hilos -->
@@ -672,7 +2814,7 @@ body { transition: background-color .4s ease, color .4s ease; }
           <tr class="border-b border-white/10">
             <td class="py-3 px-4">{{ thread['id'] }}</td>
             <td class="py-3 px-4 font-medium">{{ thread['title'] }}</td>
-            <td class="py-3 px-4">{{ thread['author'] }}</td>
+            <td class="py-3 px-4">{{ thread['author_id'] | username }}</td>
             <td class="py-3 px-4 text-sm text-slate-600 dark:text-slate-300">{{ thread['created_at'] }}</td>
             <td class="py-3 px-4">
               <a href="{{ url_for('admin_delete_thread', thread_id=thread['id']) }}" 
@@ -692,6 +2834,53 @@ body { transition: background-color .4s ease, color .4s ease; }
         </tbody>
       </table>
     </div>
+    {% if threads_after or threads_next %}
+      <div class="mt-4 flex items-center justify-between text-sm">
+        {% if threads_after %}<a href="{{ url_for('admin_panel', users_after=users_after, users_limit=users_limit, threads_limit=threads_limit) }}" class="px-3 py-1 rounded-lg glass border border-white/20 lift">« Hilos más recientes</a>{% else %}<span></span>{% endif %}
+        {% if threads_next %}<a href="{{ url_for('admin_panel', users_after=users_after, threads_after=threads_next, users_limit=users_limit, threads_limit=threads_limit) }}" class="px-3 py-1 rounded-lg glass border border-white/20 lift">Más hilos »</a>{% endif %}
+      </div>
+    {% endif %}
+  </div>
+  
+  <!-- Copias de seguridad -->
+  <div class="glass rounded-3xl p-8 border border-white/20 mt-8">
+    <div class="flex items-center justify-between mb-4">
+      <h3 class="text-xl font-bold">Copias de seguridad</h3>
+      <form method="post" action="{{ url_for('admin_backup') }}">
+        <button class="px-4 py-2 rounded-xl bg-indigo-600 text-white text-sm lift" {% if backup_status.running %}disabled{% endif %}>
+          {% if backup_status.running %}Copiando… {{ backup_status.percent or 0 }}%{% else %}Crear copia ahora{% endif %}
+        </button>
+      </form>
+    </div>
+    {% if backup_status.error %}
+      <p class="mb-4 text-sm text-rose-500">Última copia fallida: {{ backup_status.error }}</p>
+    {% endif %}
+    <div class="overflow-x-auto">
+      <table class="w-full">
+        <thead>
+          <tr class="border-b border-white/20">
+            <th class="text-left py-3 px-4">Fichero</th>
+            <th class="text-left py-3 px-4">Tamaño</th>
+            <th class="text-left py-3 px-4">Fecha (UTC)</th>
+          </tr>
+        </thead>
+        <tbody>
+          {% for backup in backups %}
+          <tr class="border-b border-white/10">
+            <td class="py-3 px-4 font-mono text-sm">{{ backup['name'] }}</td>
+            <td class="py-3 px-4 text-sm">{{ (backup['size'] / 1048576) | round(2) }} MiB</td>
+            <td class="py-3 px-4 text-sm text-slate-600 dark:text-slate-300">{{ backup['created_at'] }}</td>
+          </tr>
+          {% else %}
+          <tr>
+            <td colspan="3" class="py-4 px-4 text-center text-slate-600 dark:text-slate-300">
+              Todavía no hay copias.
+            </td>
+          </tr>
+          {% endfor %}
+        </tbody>
+      </table>
+    </div>
   </div>
 </div>
 {% endblock %}
@@ -722,6 +2911,20 @@ body { transition: background-color .4s ease, color .4s ease; }
   </div>
 </div>
 {% endblock %}
+"""
+    
+    unavailable_html = r"""
+{% extends 'base.html' %}
+{% block content %}
+<div class="min-h-[60vh] grid place-items-center text-center">
+  <div>
+    <div class="text-7xl font-black text-amber-500 mb-2">503</div>
+    <h2 class="text-2xl md:text-3xl font-extrabold mb-2">Servicio saturado</h2>
+    <p class="text-slate-600 dark:text-slate-300 mb-6">Hay demasiadas peticiones en este momento. Vuelve a intentarlo en unos segundos.</p>
+    <a href="{{ url_for('login') }}" class="px-5 py-3 rounded-xl font-bold text-white bg-gradient-to-r from-indigo-600 to-purple-600 lift">Volver</a>
+  </div>
+</div>
+{% endblock %}
 """
     
     # Asegurar que los directorios existan
@@ -736,7 +2939,12 @@ body { transition: background-color .4s ease, color .4s ease; }
     write_file(os.path.join(TEMPLATES_DIR, "dashboard.html"), dashboard_html)
     write_file(os.path.join(TEMPLATES_DIR, "threads.html"), threads_html)
     write_file(os.path.join(TEMPLATES_DIR, "thread_detail.html"), thread_detail_html)
+    write_file(os.path.join(TEMPLATES_DIR, "_thread_list.html"), thread_list_html)
+    write_file(os.path.join(TEMPLATES_DIR, "_thread_body.html"), thread_body_html)
+    write_file(os.path.join(TEMPLATES_DIR, "_reply_list.html"), reply_list_html)
+    write_file(os.path.join(TEMPLATES_DIR, "_reply.html"), reply_html)
     write_file(os.path.join(TEMPLATES_DIR, "create_thread.html"), create_thread_html)
+    write_file(os.path.join(TEMPLATES_DIR, "search.html"), search_html)
     write_file(os.path.join(TEMPLATES_DIR, "edit_thread.html"), edit_thread_html)
     write_file(os.path.join(TEMPLATES_DIR, "profile.html"), profile_html)
     write_file(os.path.join(TEMPLATES_DIR, "htb.html"), htb_html)
@@ -745,33 +2953,1485 @@ body { transition: background-color .4s ease, color .4s ease; }
     write_file(os.path.join(TEMPLATES_DIR, "admin.html"), admin_html)  # Nueva plantilla
     write_file(os.path.join(TEMPLATES_DIR, "404.html"), not_found_html)
     write_file(os.path.join(TEMPLATES_DIR, "500.html"), error_html)
+    write_file(os.path.join(TEMPLATES_DIR, "503.html"), unavailable_html)
     
     print("Plantillas y archivos estáticos generados correctamente.")
 
+# --------------- Recursos estáticos ---------------
+# Misma configuración que el bloque tailwind.config de base.html (modo CDN)
+TAILWIND_CONFIG = """
+module.exports = {
+  content: [%(content)s],
+  theme: {
+    extend: {
+      fontFamily: { sans: ['Inter', 'ui-sans-serif', 'system-ui'] },
+      colors: { brand: { 50:'#eef2ff', 400:'#818cf8', 500:'#6366f1', 600:'#4f46e5', 700:'#4338ca' } }
+    }
+  }
+}
+"""
+TAILWIND_INPUT = """
+@tailwind base;
+@tailwind components;
+@tailwind utilities;
+"""
+_manifest = {"mtime": None, "assets": {}}
+
+def asset_manifest():
+    # manifest.json se relee solo cuando cambia en disco (p. ej. tras un build en caliente)
+    path = os.path.join(ASSET_DIST_DIR, "manifest.json")
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if mtime != _manifest["mtime"]:
+        assets = {}
+        if mtime is not None:
+            with open(path, encoding="utf-8") as f:
+                assets = json.load(f)
+        _manifest.update(mtime=mtime, assets=assets)
+    return _manifest["assets"]
+
+@routes.template_global()
+def asset_url(name):
+    # URL del recurso con hash de contenido, o None si no se ha compilado (la plantilla usa la CDN)
+    hashed = asset_manifest().get(name)
+    return url_for("asset", filename=hashed) if hashed else None
+
+def minify_css(css):
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{}:;,>])\s*", r"\1", css)
+    return css.replace(";}", "}").strip()
+
+def compile_tailwind(extra_css):
+    # Ejecuta el CLI de Tailwind (binario standalone o `npx tailwindcss`) purgando contra las
+    # plantillas y el propio app.py. Devuelve None si el CLI no está disponible.
+    command = shlex.split(TAILWIND_BIN)
+    if not command or not shutil.which(command[0]):
+        return None
+    root = os.path.dirname(os.path.abspath(__file__))
+    content = ", ".join(
+        json.dumps(os.path.join(root, pattern)) for pattern in (os.path.join(TEMPLATES_DIR, "**", "*.html"), "app.py")
+    )
+    build_dir = os.path.join(ASSET_DIST_DIR, ".build")
+    os.makedirs(build_dir, exist_ok=True)
+    config_path = os.path.join(build_dir, "tailwind.config.js")
+    input_path = os.path.join(build_dir, "input.css")
+    output_path = os.path.join(build_dir, "output.css")
+    try:
+        with open(config_path, "w", encoding="utf-8") as f:
+            f.write(TAILWIND_CONFIG % {"content": content})
+        with open(input_path, "w", encoding="utf-8") as f:
+            f.write(TAILWIND_INPUT + extra_css)
+        subprocess.run(
+            [*command, "-c", config_path, "-i", input_path, "-o", output_path, "--minify"],
+            check=True, capture_output=True,
+        )
+        with open(output_path, encoding="utf-8") as f:
+            return f.read()
+    except (OSError, subprocess.CalledProcessError) as e:
+        click.echo(f"Tailwind falló: {getattr(e, 'stderr', b'').decode(errors='replace') or e}", err=True)
+        return None
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+def vendor_alpine(fetch=True):
+    # Alpine se versiona en static/vendor; si falta se descarga una vez (versión fijada)
+    path = os.path.join(ASSET_VENDOR_DIR, f"alpine-{ALPINE_VERSION}.min.js")
+    if not os.path.exists(path) and fetch:
+        import urllib.request  # solo en el build; no pesa en el arranque de la app
+
+        try:
+            with urllib.request.urlopen(ALPINE_CDN_URL, timeout=15) as response:
+                body = response.read()
+        except OSError as e:
+            click.echo(f"No se pudo descargar Alpine ({e}); se seguirá usando la CDN.", err=True)
+            return None
+        os.makedirs(ASSET_VENDOR_DIR, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(body)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+def write_precompressed(path, body):
+    # Variantes .gz y .br junto al original, a compresión máxima (se hace una vez por build)
+    with open(path + ".gz", "wb") as f:
+        # mtime=0: el mismo contenido produce siempre los mismos bytes
+        f.write(gzip.compress(body, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(path + ".br", "wb") as f:
+            f.write(brotli.compress(body, quality=11))
+
+def write_asset(name, body):
+    # Escribe dist/<base>.<hash>.<ext> con sus variantes comprimidas; devuelve el nombre final
+    base, ext = os.path.splitext(name)
+    hashed = f"{base}.{hashlib.sha256(body).hexdigest()[:12]}{ext}"
+    path = os.path.join(ASSET_DIST_DIR, hashed)
+    with open(path, "wb") as f:
+        f.write(body)
+    write_precompressed(path, body)
+    return hashed
+
+def precompress_static():
+    # Hermanos .gz/.br de los ficheros de texto de static/ (fuera de dist/) para que la vista
+    # static no tenga que comprimir en cada petición
+    written = []
+    for root, dirs, files in os.walk(STATIC_ROOT):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != ASSET_DIST_DIR]
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.splitext(name)[1] in (".css", ".js", ".svg", ".json", ".txt", ".html"):
+                with open(path, "rb") as f:
+                    write_precompressed(path, f.read())
+                written.append(os.path.relpath(path, STATIC_ROOT))
+    return written
+
+def build_assets(fetch=True):
+    os.makedirs(ASSET_DIST_DIR, exist_ok=True)
+    with open(os.path.join(STATIC_ROOT, "style.css"), encoding="utf-8") as f:
+        style_css = f.read()
+    assets = {"style.css": minify_css(style_css).encode("utf-8")}
+    tailwind_css = compile_tailwind(style_css)
+    if tailwind_css is not None:
+        assets["app.css"] = tailwind_css.encode("utf-8")
+    alpine = vendor_alpine(fetch=fetch)
+    if alpine is not None:
+        assets["alpine.js"] = alpine
+    manifest = {name: write_asset(name, body) for name, body in assets.items()}
+    precompress_static()
+    # Se conservan los ficheros del build anterior para las páginas ya servidas
+    keep = set(manifest.values()) | set(asset_manifest().values())
+    for entry in os.listdir(ASSET_DIST_DIR):
+        if entry != "manifest.json" and entry.removesuffix(".gz").removesuffix(".br") not in keep:
+            os.remove(os.path.join(ASSET_DIST_DIR, entry))
+    tmp_path = os.path.join(ASSET_DIST_DIR, "manifest.json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, os.path.join(ASSET_DIST_DIR, "manifest.json"))
+    return manifest, {name: len(body) for name, body in assets.items()}
+
+def send_precompressed(directory, filename, max_age=None):
+    # Si el cliente acepta br/gzip y existe una variante precomprimida al día (no más antigua
+    # que el original), se envía esa con Content-Encoding en lugar del fichero plano
+    mimetype = mimetypes.guess_type(filename)[0]
+    encodings = request.accept_encodings
+    path = os.path.join(directory, filename)
+    for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if not encodings[encoding]:
+            continue
+        try:
+            fresh = os.path.getmtime(path + suffix) >= os.path.getmtime(path)
+        except OSError:
+            continue
+        if fresh:
+            response = send_from_directory(directory, filename + suffix, mimetype=mimetype, max_age=max_age)
+            response.content_encoding = encoding
+            del response.headers["Content-Disposition"]
+            compression = current_app.extensions.get("compression")
+            if compression:
+                compression.record_precompressed(encoding, os.path.getsize(path), response.content_length)
+            break
+    else:
+        response = send_from_directory(directory, filename, mimetype=mimetype, max_age=max_age)
+    response.vary.add("Accept-Encoding")
+    return response
+
+@routes.route("/static/dist/<path:filename>")
+def asset(filename):
+    # Los nombres llevan hash de contenido: se cachean un año sin revalidar
+    response = send_precompressed(ASSET_DIST_DIR, filename, max_age=ASSET_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+def static_file(filename):
+    # Sustituye a la vista `static` de Flask (mismo endpoint, mismas URLs); ver create_app()
+    return send_precompressed(
+        current_app.static_folder, filename, max_age=current_app.get_send_file_max_age(filename)
+    )
+
+# --------------- Compresión de respuestas ---------------
+COMPRESSIBLE_TYPES = (
+    "text/", "application/json", "application/javascript", "application/xml", "image/svg+xml",
+)
+
+class CompressionMiddleware:
+    # Middleware WSGI: comprime en streaming las respuestas de texto con la mejor codificación
+    # que acepte el cliente (br > zstd > gzip). Los cuerpos menores que min_size, los SSE y
+    # las respuestas que ya traen Content-Encoding (estáticos precomprimidos) salen tal cual.
+    def __init__(self, wsgi_app, min_size=COMPRESS_MIN_SIZE):
+        self.wsgi_app = wsgi_app
+        self.min_size = min_size
+        self.encodings = [
+            name for name, available in (("br", brotli), ("zstd", zstandard), ("gzip", True)) if available
+        ]
+        # Plantilla gzip: copy() evita reinicializar el estado de zlib en cada respuesta
+        self._gzip = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)
+        # ZstdCompressor no es seguro entre hilos: uno por hilo, reutilizado entre respuestas
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._encoded = {name: [0, 0, 0, 0.0] for name in self.encodings}  # respuestas, in, out, cpu
+        self._precompressed = {"br": [0, 0, 0], "gzip": [0, 0, 0]}  # respuestas, original, enviado
+        self._skipped = {"small": 0, "status": 0, "type": 0, "encoded": 0}
+
+    def negotiate(self, environ):
+        accept = parse_accept_header(environ.get("HTTP_ACCEPT_ENCODING"))
+        best, best_quality = None, 0
+        for name in self.encodings:
+            if accept[name] > best_quality:
+                best, best_quality = name, accept[name]
+        return best
+
+    def compressor(self, encoding):
+        # Devuelve (compress, flush) para una respuesta
+        if encoding == "gzip":
+            obj = self._gzip.copy()
+            return obj.compress, obj.flush
+        if encoding == "zstd":
+            cctx = getattr(self._local, "zstd", None)
+            if cctx is None:
+                cctx = self._local.zstd = zstandard.ZstdCompressor(level=COMPRESS_ZSTD_LEVEL)
+            obj = cctx.compressobj()
+            return obj.compress, obj.flush
+        obj = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+        return obj.process, obj.finish
+
+    def skip_reason(self, status, headers):
+        code = int(status.split(" ", 1)[0])
+        if code < 200 or code in (204, 206, 304):
+            return "status"
+        values = {key.lower(): value for key, value in headers}
+        if "content-encoding" in values:
+            return "encoded"
+        content_type = values.get("content-type", "").split(";", 1)[0].strip().lower()
+        if (
+            not content_type.startswith(COMPRESSIBLE_TYPES)
+            or content_type == "text/event-stream"
+            or "no-transform" in values.get("cache-control", "")
+        ):
+            return "type"
+        length = values.get("content-length")
+        if length is not None and length.isdigit() and int(length) < self.min_size:
+            return "small"
+        return None
+
+    def __call__(self, environ, start_response):
+        encoding = self.negotiate(environ) if environ.get("REQUEST_METHOD") != "HEAD" else None
+        if encoding is None:
+            return self.wsgi_app(environ, start_response)
+        captured = []
+
+        def capture(status, headers, exc_info=None):
+            # start_response se difiere hasta decidir si se comprime
+            captured[:] = [status, headers, exc_info]
+            return self.unsupported_write
+
+        body = self.wsgi_app(environ, capture)
+        return self.respond(body, captured, encoding, start_response)
+
+    @staticmethod
+    def unsupported_write(data):
+        # El write() de WSGI 1.0 no se puede diferir; Flask no lo usa
+        raise RuntimeError("CompressionMiddleware no admite write()")
+
+    def respond(self, body, captured, encoding, start_response):
+        try:
+            chunks = iter(body)
+            buffered = []
+            if not captured:
+                # Aplicación perezosa: start_response llega con el primer bloque
+                buffered.append(next(chunks, b""))
+            if not captured:
+                # Ni así: sin estado ni cabeceras no hay nada que decidir, el cuerpo sale tal cual
+                # y el servidor reacciona como lo haría sin este middleware
+                yield from buffered
+                yield from chunks
+                return
+            status, headers, exc_info = captured
+            reason = self.skip_reason(status, headers)
+            if reason is None:
+                # Sin Content-Length se acumula hasta min_size para decidir
+                size = sum(len(chunk) for chunk in buffered)
+                while size < self.min_size:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        reason = "small"
+                        break
+                    buffered.append(chunk)
+                    size += len(chunk)
+            if reason is not None:
+                with self._lock:
+                    self._skipped[reason] += 1
+                start_response(status, headers, exc_info)
+                yield from buffered
+                yield from chunks
+                return
+            start_response(status, self.encoded_headers(headers, encoding), exc_info)
+            compress, flush = self.compressor(encoding)
+            bytes_in = bytes_out = 0
+            cpu = 0.0
+            for chunk in itertools.chain(buffered, chunks):
+                started = time.thread_time()
+                out = compress(chunk)
+                cpu += time.thread_time() - started
+                bytes_in += len(chunk)
+                if out:
+                    bytes_out += len(out)
+                    yield out
+            started = time.thread_time()
+            out = flush()
+            cpu += time.thread_time() - started
+            bytes_out += len(out)
+            with self._lock:
+                counters = self._encoded[encoding]
+                counters[0] += 1
+                counters[1] += bytes_in
+                counters[2] += bytes_out
+                counters[3] += cpu
+            yield out
+        finally:
+            close = getattr(body, "close", None)
+            if close is not None:
+                close()
+
+    @staticmethod
+    def encoded_headers(headers, encoding):
+        result = []
+        vary = None
+        for key, value in headers:
+            lower = key.lower()
+            if lower == "content-length":
+                continue
+            if lower == "vary":
+                vary = value
+                continue
+            if lower == "etag" and not value.startswith("W/"):
+                # La representación comprimida no es idéntica byte a byte: ETag débil
+                value = "W/" + value
+            result.append((key, value))
+        if vary and "accept-encoding" not in vary.lower():
+            vary = f"{vary}, Accept-Encoding"
+        result.append(("Vary", vary or "Accept-Encoding"))
+        result.append(("Content-Encoding", encoding))
+        return result
+
+    def record_precompressed(self, encoding, original_size, sent_size):
+        with self._lock:
+            counters = self._precompressed[encoding]
+            counters[0] += 1
+            counters[1] += original_size
+            counters[2] += sent_size or 0
+
+    def stats(self):
+        with self._lock:
+            encoded = {
+                name: {
+                    "responses": responses,
+                    "bytes_in": bytes_in,
+                    "bytes_out": bytes_out,
+                    "saved_ratio": round(1 - bytes_out / bytes_in, 4) if bytes_in else 0.0,
+                    "cpu_ms": round(cpu * 1000, 3),
+                    "cpu_ms_per_mb": round(cpu * 1000 / (bytes_in / 2**20), 3) if bytes_in else 0.0,
+                }
+                for name, (responses, bytes_in, bytes_out, cpu) in self._encoded.items()
+            }
+            precompressed = {
+                name: {"responses": responses, "bytes_saved": original - sent}
+                for name, (responses, original, sent) in self._precompressed.items()
+            }
+            return {
+                "min_size": self.min_size,
+                "encodings": self.encodings,
+                "encoded": encoded,
+                "precompressed": precompressed,
+                "skipped": dict(self._skipped),
+            }
+
+# --------------- Estadísticas del dashboard ---------------
+class StatsCache:
+    # Caché en proceso de los contadores del dashboard. Cualquier commit del escritor de este
+    # proceso la invalida; las escrituras de otros workers se ven como mucho tras `ttl` segundos.
+    # Una carga que se cruza con una invalidación (cambia la generación) no se guarda: podría
+    # haber leído los contadores de antes del commit.
+    def __init__(self, ttl, loader):
+        self.ttl = ttl
+        self.loader = loader
+        self._lock = threading.Lock()
+        self._value = None
+        self._expires = 0.0
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._hit_time = 0.0
+        self._miss_time = 0.0
+
+    def get(self):
+        start = time.perf_counter()
+        with self._lock:
+            value = self._value if time.monotonic() < self._expires else None
+            if value is not None:
+                self._hits += 1
+                self._hit_time += time.perf_counter() - start
+                return value
+            generation = self._generation
+        value = self.loader()
+        with self._lock:
+            if generation == self._generation:
+                self._value = value
+                self._expires = time.monotonic() + self.ttl
+            self._misses += 1
+            self._miss_time += time.perf_counter() - start
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+            self._generation += 1
+            self._invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "ttl": self.ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "invalidations": self._invalidations,
+                "hit_ratio": round(self._hits / lookups, 4) if lookups else 0.0,
+                "hit_avg_ms": round(self._hit_time * 1000 / self._hits, 4) if self._hits else 0.0,
+                "live_avg_ms": round(self._miss_time * 1000 / self._misses, 4) if self._misses else 0.0,
+            }
+
+def load_dashboard_stats():
+    # Los cuatro contadores en una sola consulta; los autores sin cuenta (password '!', de
+    # importaciones antiguas) no cuentan como usuarios
+    row = get_db().execute(
+        """
+        SELECT (SELECT COUNT(*) FROM users WHERE password != '!'),
+               (SELECT COUNT(*) FROM threads),
+               (SELECT COUNT(*) FROM replies),
+               (SELECT COUNT(*) FROM htb_machines)
+        """
+    ).fetchone()
+    return {"users": row[0], "threads": row[1], "replies": row[2], "htb_machines": row[3]}
+
+dashboard_stats = StatsCache(DASHBOARD_STATS_TTL, load_dashboard_stats)
+COMMIT_HOOKS.append(dashboard_stats.invalidate)
+
+# --------------- Hash de contraseñas ---------------
+class HashPoolSaturated(RuntimeError):
+    pass
+
+class PasswordHasher:
+    # Ejecuta generate/check_password_hash en un pool de procesos para que un pico de logins
+    # no bloquee los hilos que sirven el resto de páginas. Si ya hay HASH_QUEUE_LIMIT hashes
+    # en curso se rechaza al momento (HashPoolSaturated → 503) en lugar de encolar sin límite.
+    # Un hash cuenta como en curso hasta que el pool lo termina, aunque quien lo pidió se haya
+    # cansado de esperar; si un proceso del pool muere, el pool se rehace.
+    def __init__(self, workers, queue_limit, timeout):
+        self.pid = os.getpid()
+        self.workers = workers
+        self.timeout = timeout
+        self._executor = self._new_executor() if workers else None
+        self._slots = threading.BoundedSemaphore(queue_limit)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._restarts = 0
+        self._total_time = 0.0
+        self._max_time = 0.0
+
+    def _new_executor(self):
+        # Importación diferida: multiprocessing encarece el arranque y solo se usa aquí
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # spawn: los hijos no heredan hilos ni conexiones abiertas del worker web
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _replace_broken(self, executor):
+        # Solo el primero que ve el pool roto lo sustituye; el resto ya usará el nuevo
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = self._new_executor()
+            self._restarts += 1
+        logger.warning("El pool de hash se ha roto; se crea uno nuevo")
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _done(self, start):
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._in_flight -= 1
+            self._completed += 1
+            self._total_time += elapsed
+            self._max_time = max(self._max_time, elapsed)
+        self._slots.release()
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise HashPoolSaturated("Demasiados hashes de contraseña en curso")
+        start = time.perf_counter()
+        with self._lock:
+            self._in_flight += 1
+        executor = self._executor
+        if executor is None:
+            try:
+                return fn(*args)
+            finally:
+                self._done(start)
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenExecutor:
+            self._done(start)
+            self._replace_broken(executor)
+            raise HashPoolSaturated("El pool de hash se ha caído")
+        # El hueco se libera cuando el pool termina el hash, no cuando se deja de esperar
+        future.add_done_callback(lambda _: self._done(start))
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            raise HashPoolSaturated("El pool de hash no respondió a tiempo")
+        except BrokenExecutor:
+            self._replace_broken(executor)
+            raise HashPoolSaturated("El pool de hash se ha caído")
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pid": self.pid,
+                "workers": self.workers,
+                "method": PASSWORD_HASH_METHOD,
+                "in_flight": self._in_flight,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "restarts": self._restarts,
+                "avg_ms": round(self._total_time * 1000 / self._completed, 3) if self._completed else 0.0,
+                "max_ms": round(self._max_time * 1000, 3),
+            }
+
+_hasher = None
+_hasher_lock = threading.Lock()
+
+def get_hasher():
+    global _hasher
+    if _hasher is None or _hasher.pid != os.getpid():
+        with _hasher_lock:
+            if _hasher is None or _hasher.pid != os.getpid():
+                _hasher = PasswordHasher(HASH_WORKERS, HASH_QUEUE_LIMIT, HASH_TIMEOUT)
+    return _hasher
+
+@functools.lru_cache(maxsize=None)
+def hash_method_prefix(method):
+    # werkzeug completa los parámetros por defecto ("scrypt" → "scrypt:32768:8:1"); el prefijo
+    # real sale de generar un hash una vez
+    return generate_password_hash("", method).split("$", 1)[0]
+
+def needs_rehash(pwhash):
+    return pwhash.split("$", 1)[0] != hash_method_prefix(PASSWORD_HASH_METHOD)
+
+# --------------- Caché de fragmentos ---------------
+class FragmentCache:
+    # LRU de HTML ya renderizado, acotada por bytes. Las claves llevan la versión del
+    # contenido que pintan, así que tras un cambio nunca se sirve HTML viejo; discard() solo
+    # libera antes la memoria de las versiones superadas. Cada entrada tiene una etiqueta
+    # ("threads" o ("thread", id)) para poder descartarlas en grupo.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_render(self, key, tag, render):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        html = Markup(render())
+        size = len(html.encode("utf-8"))
+        with self._lock:
+            self.misses += 1
+            if size <= self.max_bytes and key not in self._entries:
+                self._entries[key] = (html, size, tag)
+                self._tags.setdefault(tag, set()).add(key)
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    self._remove(next(iter(self._entries)))
+                    self.evictions += 1
+        return html
+
+    def _remove(self, key):
+        _, size, tag = self._entries.pop(key)
+        self._bytes -= size
+        keys = self._tags.get(tag)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+    def discard(self, tag):
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+fragment_cache = FragmentCache(FRAGMENT_CACHE_BYTES)
+
+def invalidate_thread_fragments(thread_id=None):
+    # El listado cambia con cualquier escritura del foro; sin thread_id (p. ej. un baneo que
+    # toca muchos hilos) se vacía todo
+    if thread_id is None:
+        fragment_cache.clear()
+        return
+    fragment_cache.discard("threads")
+    fragment_cache.discard(("thread", thread_id))
+
+# --------------- Nombres de usuario ---------------
+# Hilos y respuestas guardan author_id; el nombre se pinta con el filtro `username` desde una
+# LRU id → nombre por proceso. Las rutas que pintan autores llaman a sync() (compara
+# versions('users'), que los triggers suben al renombrar o borrar un usuario, y vacía la caché
+# si cambió, también por cambios de otros workers) y prefetch() trae en una sola consulta los
+# autores de la página que falten. La versión va además en las claves de fragmentos y ETags.
+DELETED_USER = "[eliminado]"
+
+class UserNameCache:
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.loaded = 0
+        self.invalidations = 0
+
+    def sync(self, cur):
+        # Devuelve (versión, updated_at) de versions('users')
+        stamp = content_stamp(cur, "users")
+        with self._lock:
+            if stamp[0] != self.version:
+                if self.version is not None:
+                    self.invalidations += 1
+                self._entries.clear()
+                self.version = stamp[0]
+        return stamp
+
+    def prefetch(self, cur, user_ids):
+        with self._lock:
+            version = self.version
+            missing = [user_id for user_id in set(user_ids) if user_id not in self._entries]
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+            cur.execute(f"SELECT id, username FROM users WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+            self._store(version, dict(cur.fetchall()), chunk)
+
+    def name(self, user_id):
+        with self._lock:
+            version = self.version
+            name = self._entries.get(user_id)
+            if name is not None:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return name
+            self.misses += 1
+        # Sin prefetch (p. ej. una respuesta en vivo): la conexión de la petición si ya la
+        # tiene; si no (los streams SSE la devuelven al pool), una del pool un instante
+        if has_app_context() and "db" in g:
+            row = g.db.execute("SELECT username FROM users WHERE id=?", (user_id,)).fetchone()
+        else:
+            pool = get_pool()
+            db = pool.acquire()
+            try:
+                row = db.execute("SELECT username FROM users WHERE id=?", (user_id,)).fetchone()
+            finally:
+                pool.release(db)
+        name = row[0] if row else DELETED_USER
+        self._store(version, {user_id: name}, [user_id])
+        return name
+
+    def _store(self, version, names, user_ids):
+        with self._lock:
+            # Si sync() vació la caché mientras se consultaba, lo leído puede ser anterior al cambio
+            if version != self.version:
+                return
+            for user_id in user_ids:
+                self._entries[user_id] = names.get(user_id, DELETED_USER)
+                self._entries.move_to_end(user_id)
+            self.loaded += len(user_ids)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.size,
+                "version": self.version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "loaded": self.loaded,
+                "invalidations": self.invalidations,
+            }
+
+user_names = UserNameCache(USER_NAME_CACHE_SIZE)
+
+@routes.template_filter("username")
+def username_filter(user_id):
+    return user_names.name(user_id)
+
+# --------------- Respuestas en vivo (SSE) ---------------
+class Subscription:
+    QUEUE_SIZE = 100
+
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.queue = queue.Queue(maxsize=self.QUEUE_SIZE)
+        # La cola se llenó y se perdieron avisos: el stream se pone al día con la base de datos
+        self.lagged = False
+
+    def deliver(self, item):
+        # Lo llama publish() con el lock del broker tomado: nunca debe bloquear
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            return False
+        return True
+
+class ReplyBroker:
+    # Fan-out en proceso: la ruta que inserta una respuesta la publica ya confirmada y cada
+    # suscriptor del hilo la recibe en su cola, sin consultar la base de datos
+    def __init__(self, max_subscribers):
+        self.max_subscribers = max_subscribers
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._connections = 0
+        self._peak = 0
+        self._total = 0
+        self._rejected = 0
+        self._published = 0
+        self._delivered = 0
+        self._dropped = 0
+        self._fanout_total = 0.0
+        self._fanout_max = 0.0
+        self._polls = 0
+        self._poll_time = 0.0
+
+    def subscribe(self, thread_id, factory=Subscription):
+        # None si ya no quedan huecos en este proceso. `factory` permite otras colas (asgi.py
+        # usa una asyncio.Queue despertada desde el hilo que publica)
+        with self._lock:
+            if self._connections >= self.max_subscribers:
+                self._rejected += 1
+                return None
+            subscription = factory(thread_id)
+            self._subscribers.setdefault(thread_id, set()).add(subscription)
+            self._connections += 1
+            self._total += 1
+            self._peak = max(self._peak, self._connections)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.thread_id)
+            if subscribers and subscription in subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.thread_id]
+                self._connections -= 1
+
+    def publish(self, thread_id, reply):
+        published_at = time.perf_counter()
+        with self._lock:
+            self._published += 1
+            for subscription in self._subscribers.get(thread_id, ()):
+                if not subscription.deliver((published_at, reply)):
+                    subscription.lagged = True
+                    self._dropped += 1
+
+    def record_delivery(self, published_at):
+        elapsed = time.perf_counter() - published_at
+        with self._lock:
+            self._delivered += 1
+            self._fanout_total += elapsed
+            self._fanout_max = max(self._fanout_max, elapsed)
+
+    def record_poll(self, elapsed):
+        with self._lock:
+            self._polls += 1
+            self._poll_time += elapsed
+
+    def stats(self):
+        with self._lock:
+            return {
+                "connections": self._connections,
+                "peak": self._peak,
+                "total": self._total,
+                "rejected": self._rejected,
+                "max_subscribers": self.max_subscribers,
+                "published": self._published,
+                "delivered": self._delivered,
+                "dropped": self._dropped,
+                "fanout_avg_ms": round(self._fanout_total * 1000 / self._delivered, 3) if self._delivered else 0.0,
+                "fanout_max_ms": round(self._fanout_max * 1000, 3),
+                "polls": self._polls,
+                "poll_avg_ms": round(self._poll_time * 1000 / self._polls, 3) if self._polls else 0.0,
+            }
+
+live_replies = ReplyBroker(LIVE_MAX_SUBSCRIBERS)
+
+def fetch_new_replies(thread_id, last_seen):
+    # Sondeo barato por el índice (thread_id, id); la conexión vuelve al pool enseguida para
+    # que los suscriptores no retengan una cada uno
+    start = time.perf_counter()
+    pool = get_pool()
+    db = pool.acquire()
+    try:
+        rows = db.execute(
+            "SELECT * FROM replies WHERE thread_id=? AND id > ? ORDER BY id ASC LIMIT ?",
+            (thread_id, last_seen, PAGE_SIZE),
+        ).fetchall()
+        user_names.prefetch(db.cursor(), [row["author_id"] for row in rows])
+    finally:
+        pool.release(db)
+    live_replies.record_poll(time.perf_counter() - start)
+    return rows
+
+def reply_event(thread_id, reply):
+    # El fragmento de cada respuesta se renderiza una vez y lo comparten todos los suscriptores
+    html = fragment_cache.get_or_render(
+        ("live_reply", reply["id"], user_names.version), ("thread", thread_id),
+        lambda: render_template("_reply.html", reply=reply),
+    )
+    data = "".join(f"data: {line}\n" for line in str(html).splitlines())
+    return f"id: {reply['id']}\nevent: reply\n{data}\n"
+
+def reply_events(subscription, last_seen):
+    # La vista ya tiene la suscripción; si el stream nunca llega a iterarse, este finally no
+    # se ejecuta y la suelta el call_on_close de la respuesta (unsubscribe admite repetirse)
+    try:
+        yield f"retry: {LIVE_HEARTBEAT * 1000}\n\n"
+        started = time.monotonic()
+        next_poll = started + LIVE_POLL_INTERVAL if LIVE_POLL_INTERVAL else None
+        next_heartbeat = started + LIVE_HEARTBEAT
+        while time.monotonic() - started < LIVE_STREAM_MAX:
+            wake = min(t for t in (next_poll, next_heartbeat) if t is not None)
+            try:
+                published_at, reply = subscription.queue.get(timeout=max(0.0, wake - time.monotonic()))
+            except queue.Empty:
+                published_at = reply = None
+            now = time.monotonic()
+            if reply is not None and reply["id"] > last_seen and not subscription.lagged:
+                yield reply_event(subscription.thread_id, reply)
+                last_seen = reply["id"]
+                live_replies.record_delivery(published_at)
+                next_heartbeat = now + LIVE_HEARTBEAT
+            elif subscription.lagged or (next_poll is not None and now >= next_poll):
+                subscription.lagged = False
+                for row in fetch_new_replies(subscription.thread_id, last_seen):
+                    yield reply_event(subscription.thread_id, row)
+                    last_seen = row["id"]
+                    next_heartbeat = now + LIVE_HEARTBEAT
+                if next_poll is not None:
+                    next_poll = now + LIVE_POLL_INTERVAL
+            if now >= next_heartbeat:
+                # Comentario SSE: mantiene viva la conexión en los proxies y detecta cierres
+                yield ": ping\n\n"
+                next_heartbeat = now + LIVE_HEARTBEAT
+    finally:
+        live_replies.unsubscribe(subscription)
+
+# --------------- Límite de intentos de login ---------------
+class MemoryAttemptLog:
+    # Ventana deslizante en memoria: marcas de tiempo de los fallos recientes por clave
+    def __init__(self, window):
+        self.window = window
+        self._lock = threading.Lock()
+        self._attempts = {}
+        self._since_sweep = 0
+
+    def count(self, key, now):
+        with self._lock:
+            attempts = self._attempts.get(key)
+            if not attempts:
+                return 0
+            while attempts and attempts[0] <= now - self.window:
+                attempts.popleft()
+            if not attempts:
+                del self._attempts[key]
+            return len(attempts)
+
+    def record(self, key, now):
+        with self._lock:
+            self._attempts.setdefault(key, deque()).append(now)
+            self._since_sweep += 1
+            if self._since_sweep >= 1000:
+                self._sweep(now)
+
+    def reset(self, key):
+        with self._lock:
+            self._attempts.pop(key, None)
+
+    def _sweep(self, now):
+        # Olvidar las claves cuyos fallos ya salieron de la ventana
+        self._since_sweep = 0
+        cutoff = now - self.window
+        for key in [k for k, v in self._attempts.items() if not v or v[-1] <= cutoff]:
+            del self._attempts[key]
+
+    def keys(self):
+        with self._lock:
+            return len(self._attempts)
+
+class SQLiteAttemptLog:
+    # La misma ventana guardada en login_attempts para que la compartan todos los workers
+    def __init__(self, window):
+        self.window = window
+        self._since_sweep = 0
+
+    def count(self, key, now):
+        return get_db().execute(
+            "SELECT COUNT(*) FROM login_attempts WHERE key=? AND ts > ?", (key, now - self.window)
+        ).fetchone()[0]
+
+    def record(self, key, now):
+        self._since_sweep += 1
+        sweep = self._since_sweep >= 1000
+        if sweep:
+            self._since_sweep = 0
+        def write(cur):
+            cur.execute("INSERT INTO login_attempts(key, ts) VALUES (?,?)", (key, now))
+            cur.execute("DELETE FROM login_attempts WHERE key=? AND ts <= ?", (key, now - self.window))
+            if sweep:
+                cur.execute("DELETE FROM login_attempts WHERE ts <= ?", (now - self.window,))
+        run_write(write)
+
+    def reset(self, key):
+        run_write(lambda cur: cur.execute("DELETE FROM login_attempts WHERE key=?", (key,)))
+
+    def keys(self):
+        return None
+
+class LoginThrottle:
+    # Cuenta logins fallidos por IP y por usuario; bloquea mientras cualquiera de los dos
+    # supere su límite dentro de la ventana
+    def __init__(self, log, max_per_ip, max_per_user):
+        self.log = log
+        self.max_per_ip = max_per_ip
+        self.max_per_user = max_per_user
+        self._lock = threading.Lock()
+        self.blocked = 0
+
+    def allowed(self, ip, username):
+        now = time.time()
+        if self.log.count("ip:" + ip, now) >= self.max_per_ip or (
+            username and self.log.count("user:" + username.lower(), now) >= self.max_per_user
+        ):
+            with self._lock:
+                self.blocked += 1
+            return False
+        return True
+
+    def failure(self, ip, username):
+        now = time.time()
+        self.log.record("ip:" + ip, now)
+        if username:
+            self.log.record("user:" + username.lower(), now)
+
+    def success(self, username):
+        self.log.reset("user:" + username.lower())
+
+    def stats(self):
+        with self._lock:
+            blocked = self.blocked
+        return {"backend": LOGIN_THROTTLE_BACKEND, "blocked": blocked, "tracked_keys": self.log.keys()}
+
+class UnknownUserCache:
+    # LRU acotada de nombres que sabemos que no existen, para rechazar sin buscar en users.
+    # Sigue versions('signups') como UserNameCache sigue versions('users'): un alta en
+    # cualquier worker la vacía en todos. Las entradas caducan además a los `ttl` segundos.
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def sync(self, cur):
+        version = content_version(cur, "signups")
+        with self._lock:
+            if version != self.version:
+                if self.version is not None:
+                    self.invalidations += 1
+                self._entries.clear()
+                self.version = version
+        return version
+
+    def __contains__(self, username):
+        with self._lock:
+            expires = self._entries.get(username)
+            if expires is not None and expires > time.monotonic():
+                self._entries.move_to_end(username)
+                self.hits += 1
+                return True
+            if expires is not None:
+                del self._entries[username]
+            self.misses += 1
+            return False
+
+    def add(self, username, version):
+        with self._lock:
+            # Si sync() vio un alta mientras se consultaba, el nombre puede existir ya
+            if version != self.version:
+                return
+            self._entries[username] = time.monotonic() + self.ttl
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, username):
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "version": self.version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+if LOGIN_THROTTLE_BACKEND == "sqlite":
+    login_throttle = LoginThrottle(SQLiteAttemptLog(LOGIN_WINDOW), LOGIN_MAX_FAILURES_PER_IP, LOGIN_MAX_FAILURES_PER_USER)
+elif LOGIN_THROTTLE_BACKEND == "memory":
+    login_throttle = LoginThrottle(MemoryAttemptLog(LOGIN_WINDOW), LOGIN_MAX_FAILURES_PER_IP, LOGIN_MAX_FAILURES_PER_USER)
+else:
+    login_throttle = None
+unknown_users = UnknownUserCache(UNKNOWN_USER_CACHE_SIZE, UNKNOWN_USER_TTL)
+
+# --------------- Métricas ---------------
+# Histogramas por endpoint (latencia total, tiempo en SQL, consultas por petición) y por
+# plantilla (render), en memoria de cada proceso: con varios workers cada scrape de /metrics
+# ve el proceso que lo atiende. El SQL se mide envolviendo la conexión de get_db(); las
+# esperas a la cola de escritura (run_write) cuentan como SQL de la petición.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SLOW_LOG_QUERIES = 3
+# Sentencias guardadas por petición para el registro de lentas (los streams SSE hacen muchas)
+MAX_RECORDED_STATEMENTS = 500
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def render(self, gauges=()):
+        # Formato de texto de Prometheus 0.0.4
+        def label_text(labels, extra=()):
+            pairs = [*labels, *extra]
+            if not pairs:
+                return ""
+            escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+            return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+        lines = []
+        with self._lock:
+            series = sorted(self._histograms.items()) + sorted(self._counters.items())
+            snapshot = [
+                (key, (list(value.buckets), list(value.counts), value.sum, value.count) if isinstance(value, Histogram) else value)
+                for key, value in series
+            ]
+        described = set()
+        for (name, labels), value in [*snapshot, *sorted(gauges)]:
+            if name not in described:
+                described.add(name)
+                kind, text = self._help.get(name, ("gauge", ""))
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+            if isinstance(value, tuple):
+                buckets, counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip([*buckets, "+Inf"], counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{label_text(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{label_text(labels)} {total:.6f}")
+                lines.append(f"{name}_count{label_text(labels)} {count}")
+            else:
+                lines.append(f"{name}{label_text(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+metrics.describe("nebula_request_duration_seconds", "histogram", "Latencia de las peticiones por endpoint")
+metrics.describe("nebula_request_sql_seconds", "histogram", "Tiempo en SQLite por petición")
+metrics.describe("nebula_request_queries", "histogram", "Consultas SQL por petición")
+metrics.describe("nebula_request_render_seconds", "histogram", "Tiempo renderizando plantillas por petición")
+metrics.describe("nebula_template_render_seconds", "histogram", "Render de cada plantilla")
+metrics.describe("nebula_requests_total", "counter", "Peticiones por endpoint, método y estado")
+metrics.describe("nebula_slow_requests_total", "counter", "Peticiones por encima de SLOW_REQUEST_MS")
+
+class RequestMetrics:
+    __slots__ = ("started", "sql_time", "queries", "render_time", "renders", "statements")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_time = 0.0
+        self.queries = 0
+        self.render_time = 0.0
+        self.renders = []
+        self.statements = []
+
+    def record_query(self, sql, elapsed):
+        # Devuelve la posición de la sentencia en statements (None si ya no se guardan)
+        self.queries += 1
+        self.sql_time += elapsed
+        if len(self.statements) >= MAX_RECORDED_STATEMENTS:
+            return None
+        self.statements.append((elapsed, sql))
+        return len(self.statements) - 1
+
+class InstrumentedCursor:
+    # Envuelve un sqlite3.Cursor: execute() solo avanza hasta la primera fila, así que
+    # también se cronometran los fetch
+    __slots__ = ("raw", "metrics", "last")
+
+    def __init__(self, cursor, metrics):
+        self.raw = cursor
+        self.metrics = metrics
+        self.last = None
+
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        try:
+            self.raw.execute(sql, params)
+        finally:
+            self.last = self.metrics.record_query(sql, time.perf_counter() - start)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        start = time.perf_counter()
+        try:
+            self.raw.executemany(sql, seq_of_params)
+        finally:
+            self.last = self.metrics.record_query(sql, time.perf_counter() - start)
+        return self
+
+    def _fetched(self, start):
+        # El tiempo de lectura de filas se suma a la consulta que las produjo
+        elapsed = time.perf_counter() - start
+        self.metrics.sql_time += elapsed
+        if self.last is not None:
+            spent, sql = self.metrics.statements[self.last]
+            self.metrics.statements[self.last] = (spent + elapsed, sql)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return self.raw.fetchone()
+        finally:
+            self._fetched(start)
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        try:
+            return self.raw.fetchmany(size) if size is not None else self.raw.fetchmany()
+        finally:
+            self._fetched(start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return self.raw.fetchall()
+        finally:
+            self._fetched(start)
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+class InstrumentedConnection:
+    # Lo que devuelve get_db() mientras hay métricas: mismo uso que la conexión del pool
+    __slots__ = ("raw", "metrics")
+
+    def __init__(self, db, metrics):
+        self.raw = db
+        self.metrics = metrics
+
+    def cursor(self):
+        return InstrumentedCursor(self.raw.cursor(), self.metrics)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+def record_write_wait(fn, elapsed):
+    request_metrics = g.get("metrics") if has_request_context() else None
+    if request_metrics is not None:
+        request_metrics.record_query(f"-- cola de escritura: {getattr(fn, '__name__', fn)}", elapsed)
+
+def template_render_started(sender, template, context, **extra):
+    request_metrics = g.get("metrics") if has_request_context() else None
+    if request_metrics is not None:
+        request_metrics.renders.append(time.perf_counter())
+
+def template_render_finished(sender, template, context, **extra):
+    request_metrics = g.get("metrics") if has_request_context() else None
+    if request_metrics is not None and request_metrics.renders:
+        elapsed = time.perf_counter() - request_metrics.renders.pop()
+        # Las plantillas anidadas (un render dentro de otro) solo cuentan una vez en el total
+        if not request_metrics.renders:
+            request_metrics.render_time += elapsed
+        metrics.observe("nebula_template_render_seconds", (("template", template.name),), elapsed)
+
+before_render_template.connect(template_render_started)
+template_rendered.connect(template_render_finished)
+
+@routes.before_request
+def start_request_metrics():
+    if METRICS_ENABLED:
+        g.metrics = RequestMetrics()
+
+@routes.after_request
+def record_request_metrics(response):
+    request_metrics = g.pop("metrics", None)
+    if request_metrics is None:
+        return response
+    elapsed = time.perf_counter() - request_metrics.started
+    endpoint = request.endpoint or "none"
+    labels = (("endpoint", endpoint), ("method", request.method))
+    metrics.observe("nebula_request_duration_seconds", labels, elapsed)
+    metrics.observe("nebula_request_sql_seconds", labels, request_metrics.sql_time)
+    metrics.observe("nebula_request_queries", labels, request_metrics.queries, QUERY_BUCKETS)
+    metrics.observe("nebula_request_render_seconds", labels, request_metrics.render_time)
+    metrics.inc("nebula_requests_total", (*labels, ("status", str(response.status_code))))
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        metrics.inc("nebula_slow_requests_total", labels)
+        slowest = sorted(request_metrics.statements, reverse=True)[:SLOW_LOG_QUERIES]
+        logger.warning(
+            "Petición lenta %s %s (%s) %.1f ms: SQL %.1f ms en %d consultas, render %.1f ms%s",
+            request.method, request.path, endpoint, elapsed * 1000, request_metrics.sql_time * 1000,
+            request_metrics.queries, request_metrics.render_time * 1000,
+            "".join(f"\n  {spent * 1000:.1f} ms  {' '.join(sql.split())[:300]}" for spent, sql in slowest),
+        )
+    return response
+
+def stats_gauges(stats, prefix="nebula"):
+    # Los valores numéricos de /admin/stats como gauges: nebula_<sección>_<clave>
+    gauges = []
+    for key, value in stats.items():
+        name = f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', key)}"
+        if isinstance(value, bool):
+            gauges.append(((name, ()), int(value)))
+        elif isinstance(value, (int, float)):
+            gauges.append(((name, ()), value))
+        elif isinstance(value, dict):
+            gauges.extend(stats_gauges(value, name))
+    return gauges
+
+# --------------- GET condicional ---------------
+def not_modified(*parts, last_modified=None):
+    # Calcula la ETag de la página a partir de datos baratos (versiones, cursor, usuario) y
+    # devuelve una respuesta 304 si el navegador ya la tiene; si no, la deja en `g` para
+    # que conditional_headers() la añada a la respuesta completa. Con mensajes flash
+    # pendientes no se valida nada: la página lleva contenido de un solo uso.
+    if session.get("_flashes"):
+        return None
+    etag = hashlib.sha1(
+        repr((BUILD_ID, sorted(asset_manifest().values()), session.get("user"), *parts)).encode("utf-8")
+    ).hexdigest()
+    g.etag = etag
+    g.last_modified = last_modified
+    if request.if_none_match:
+        # Comparación débil: CompressionMiddleware debilita la ETag de las respuestas comprimidas
+        fresh = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified:
+        fresh = request.if_modified_since.timestamp() >= last_modified
+    else:
+        fresh = False
+    if not fresh:
+        return None
+    response = Response(status=304)
+    conditional_headers(response)
+    return response
+
+def newest(*timestamps):
+    # Last-Modified de una página que depende de varias versiones
+    return max((ts for ts in timestamps if ts), default=None)
+
+@routes.after_request
+def conditional_headers(response):
+    etag = g.pop("etag", None)
+    if etag and response.status_code in (200, 304):
+        response.set_etag(etag)
+        last_modified = g.pop("last_modified", None)
+        if last_modified:
+            response.last_modified = last_modified
+        # Revalidar siempre: la página es por usuario y cambia con cada escritura
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add("Cookie")
+    return response
+
+# --------------- Paginación ---------------
+def page_args(prefix=""):
+    # Lee ?<prefix>after=<id>&<prefix>limit=n. `after` es el último id de la página anterior
+    after = request.args.get(prefix + "after", type=int)
+    limit = request.args.get(prefix + "limit", PAGE_SIZE, type=int)
+    return after, max(1, min(limit, MAX_PAGE_SIZE))
+
+def fetch_page(cur, sql, params, limit):
+    # `sql` acaba en "LIMIT ?". Se pide una fila de más para saber si hay página siguiente;
+    # devuelve (filas, cursor de la siguiente página o None)
+    cur.execute(sql, (*params, limit + 1))
+    rows = cur.fetchall()
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1]["id"]
+    return rows, None
+
 # --------------- Routes ---------------
-@app.route("/")
+@routes.route("/")
 def index():
     return redirect(url_for("dashboard") if session.get("user") else url_for("login"))
 
-@app.route("/login", methods=["GET", "POST"])
+@routes.route("/login", methods=["GET", "POST"])
 def login():
     error = None
     if request.method == "POST":
         username = request.form.get("username", "").strip()
         password = request.form.get("password", "")
-        db = get_db()
-        cur = db.cursor()
-        cur.execute("SELECT * FROM users WHERE username=?", (username,))
-        user = cur.fetchone()
-        if user and check_password_hash(user[2], password):
+        ip = request.remote_addr or "-"
+        if login_throttle and not login_throttle.allowed(ip, username):
+            error = "Demasiados intentos fallidos. Espera unos minutos antes de volver a intentarlo."
+            return render_template("login.html", error=error, title="Login"), 429, {"Retry-After": str(int(LOGIN_WINDOW))}
+        cur = get_db().cursor()
+        version = unknown_users.sync(cur)
+        cached_unknown = username in unknown_users
+        if cached_unknown:
+            user = None
+        else:
+            cur.execute("SELECT * FROM users WHERE username=?", (username,))
+            user = cur.fetchone()
+            if user is None:
+                unknown_users.add(username, version)
+        try:
+            valid = user is not None and get_hasher().check(user[2], password)
+        except HashPoolSaturated:
+            abort(503)
+        if login_throttle:
+            if valid:
+                login_throttle.success(username)
+            else:
+                # Un rechazo que solo viene de la caché no cuenta contra el usuario: si la
+                # entrada fuese vieja, el recién registrado se bloquearía a sí mismo
+                login_throttle.failure(ip, None if cached_unknown else username)
+        if valid and needs_rehash(user[2]):
+            # El coste configurado cambió: guardar el hash nuevo aprovechando la contraseña en claro.
+            # Si el pool está saturado se deja para el próximo login
+            try:
+                new_hash = get_hasher().hash(password)
+            except HashPoolSaturated:
+                new_hash = None
+            if new_hash:
+                run_write(lambda cur: cur.execute(
+                    "UPDATE users SET password=? WHERE id=? AND password=?",
+                    (new_hash, user[0], user[2]),
+                ))
+        if valid and is_banned(get_db().cursor(), user[0]):
+            error = "Esta cuenta ha sido suspendida"
+        elif valid:
             session["user"] = username
+            session["user_id"] = user[0]
             flash("Has iniciado sesión.", "success")
             return redirect(url_for("dashboard"))
         else:
             error = "Credenciales incorrectas"
     return render_template("login.html", error=error, title="Login")
 
-@app.route("/register", methods=["GET", "POST"])
+@routes.route("/register", methods=["GET", "POST"])
 def register():
     error = None
     if request.method == "POST":
@@ -783,52 +4443,48 @@ def register():
             error = "El usuario es obligatorio"
         else:
             try:
-                db = get_db()
-                cur = db.cursor()
-                cur.execute(
+                password_hash = get_hasher().hash(raw_pass)
+                run_write(lambda cur: cur.execute(
                     "INSERT INTO users(username, password) VALUES (?,?)",
-                    (username, generate_password_hash(raw_pass)),
-                )
-                db.commit()
+                    (username, password_hash),
+                ))
+                unknown_users.discard(username)
                 flash("Cuenta creada. Ya puedes iniciar sesión.", "success")
                 return redirect(url_for("login"))
             except sqlite3.IntegrityError:
                 error = "El usuario ya existe"
+            except HashPoolSaturated:
+                abort(503)
     return render_template("register.html", error=error, title="Registro")
 
-@app.route("/logout")
+def current_user_id():
+    # Las sesiones iniciadas antes de author_id solo guardan el nombre: se completa una vez
+    user_id = session.get("user_id")
+    if user_id is None and session.get("user"):
+        row = get_db().execute("SELECT id FROM users WHERE username=?", (session["user"],)).fetchone()
+        if row:
+            session["user_id"] = user_id = row[0]
+    return user_id
+
+@routes.route("/logout")
 def logout():
     session.pop("user", None)
+    session.pop("user_id", None)
     flash("Sesión cerrada.", "success")
     return redirect(url_for("login"))
 
-@app.route("/dashboard")
+@routes.route("/dashboard")
 def dashboard():
     if not session.get("user"):
         return redirect(url_for("login"))
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("SELECT COUNT(*) FROM users")
-    users = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM threads")
-    threads = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM replies")
-    replies = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM htb_machines")
-    htb_machines = cur.fetchone()[0]
     return render_template(
         "dashboard.html", 
         user=session["user"], 
-        stats={
-            "users": users, 
-            "threads": threads, 
-            "replies": replies,
-            "htb_machines": htb_machines
-        }, 
+        stats=dashboard_stats.get(),
         title="Dashboard"
     )
 
-@app.route("/profile", methods=["GET", "POST"])
+@routes.route("/profile", methods=["GET", "POST"])
 def profile():
     user = session.get("user")
     if not user:
@@ -846,13 +4502,14 @@ def profile():
         elif len(new_password) < 6:
             error = "La contraseña debe tener al menos 6 caracteres"
         else:
-            db = get_db()
-            cur = db.cursor()
-            cur.execute(
+            try:
+                password_hash = get_hasher().hash(new_password)
+            except HashPoolSaturated:
+                abort(503)
+            run_write(lambda cur: cur.execute(
                 "UPDATE users SET password=? WHERE username=?",
-                (generate_password_hash(new_password), user)
-            )
-            db.commit()
+                (password_hash, user)
+            ))
             success = "Contraseña actualizada correctamente"
     
     return render_template(
@@ -863,25 +4520,37 @@ def profile():
         title="Perfil"
     )
 
-@app.route("/threads")
+@routes.route("/threads")
 def threads():
     if not session.get("user"):
         return redirect(url_for("login"))
+    after, limit = page_args()
     db = get_db()
     cur = db.cursor()
-    cur.execute(
-        """
-        SELECT t.*, COUNT(r.id) AS reply_count
-        FROM threads t
-        LEFT JOIN replies r ON r.thread_id = t.id
-        GROUP BY t.id
-        ORDER BY t.id DESC
-        """
+    forum_version, updated_at = content_stamp(cur, "forum")
+    users_version, users_updated_at = user_names.sync(cur)
+    cached = not_modified(
+        "threads", forum_version, users_version, after, limit, last_modified=newest(updated_at, users_updated_at)
     )
-    rows = cur.fetchall()
-    return render_template("threads.html", threads=rows, title="Hilos")
+    if cached:
+        return cached
+    
+    def render_list():
+        rows, next_after = fetch_page(
+            cur,
+            "SELECT * FROM threads WHERE id < ? ORDER BY id DESC LIMIT ?",
+            (after if after is not None else MAX_ID,),
+            limit,
+        )
+        user_names.prefetch(cur, [row["author_id"] for row in rows])
+        return render_template("_thread_list.html", threads=rows, after=after, next_after=next_after, limit=limit)
+    
+    thread_list = fragment_cache.get_or_render(
+        ("threads", forum_version, users_version, after, limit), "threads", render_list
+    )
+    return render_template("threads.html", thread_list=thread_list, title="Hilos")
 
-@app.route("/thread/<int:id>", methods=["GET", "POST"])
+@routes.route("/thread/<int:id>", methods=["GET", "POST"])
 def thread_detail(id: int):
     if not session.get("user"):
         return redirect(url_for("login"))
@@ -890,22 +4559,89 @@ def thread_detail(id: int):
     if request.method == "POST":
         content = (request.form.get("content") or "").strip()
         if content:
-            cur.execute(
-                "INSERT INTO replies(content, author, thread_id, created_at) VALUES (?,?,?,?)",
-                (content, session["user"], id, datetime.utcnow().strftime("%Y-%m-%d %H:%M")),
+            author_id = current_user_id()
+            if author_id is None:
+                return redirect(url_for("login"))
+            created_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M")
+            try:
+                reply_id = run_write(insert_reply, id, content, author_id, created_at)
+            except sqlite3.IntegrityError:
+                # Clave foránea: el hilo no existe (o se acaba de borrar) o el autor fue (o
+                # está siendo) baneado
+                abort(404)
+            invalidate_thread_fragments(id)
+            live_replies.publish(
+                id, {"id": reply_id, "content": content, "author_id": author_id, "created_at": created_at}
             )
-            db.commit()
             flash("Respuesta publicada.", "success")
-            return redirect(url_for("thread_detail", id=id))
+            # Abrir la página que empieza en la respuesta recién publicada
+            return redirect(url_for("thread_detail", id=id, after=reply_id - 1, _anchor=f"reply-{reply_id}"))
     cur.execute("SELECT * FROM threads WHERE id=?", (id,))
     thread = cur.fetchone()
     if not thread:
         abort(404)
-    cur.execute("SELECT * FROM replies WHERE thread_id=? ORDER BY id ASC", (id,))
-    replies = cur.fetchall()
-    return render_template("thread_detail.html", thread=thread, replies=replies, title=thread[1])
+    after, limit = page_args()
+    users_version, users_updated_at = user_names.sync(cur)
+    cached = not_modified(
+        "thread", id, thread["version"], users_version, after, limit,
+        last_modified=newest(thread["updated_at"], users_updated_at),
+    )
+    if cached:
+        return cached
+    # El autor del hilo se pinta también fuera de los fragmentos (enlaces de edición)
+    user_names.prefetch(cur, [thread["author_id"]])
+    
+    def render_replies():
+        replies, next_after = fetch_page(
+            cur,
+            "SELECT * FROM replies WHERE thread_id=? AND id > ? ORDER BY id ASC LIMIT ?",
+            (id, after or 0),
+            limit,
+        )
+        user_names.prefetch(cur, [reply["author_id"] for reply in replies])
+        return render_template(
+            "_reply_list.html", thread=thread, replies=replies, after=after, next_after=next_after, limit=limit
+        )
+    
+    tag = ("thread", id)
+    thread_body = fragment_cache.get_or_render(
+        ("thread_body", id, thread["version"], users_version), tag,
+        lambda: render_template("_thread_body.html", thread=thread),
+    )
+    reply_list = fragment_cache.get_or_render(
+        ("replies", id, thread["version"], users_version, after, limit), tag, render_replies
+    )
+    return render_template(
+        "thread_detail.html",
+        thread=thread,
+        thread_body=thread_body,
+        reply_list=reply_list,
+        title=thread["title"],
+    )
+
+@routes.route("/thread/<int:id>/events")
+def thread_events(id: int):
+    # Stream SSE con las respuestas nuevas del hilo a partir de Last-Event-ID / ?after=
+    if not session.get("user"):
+        abort(401)
+    if not LIVE_REPLIES:
+        abort(404)
+    if not get_db().execute("SELECT 1 FROM threads WHERE id=?", (id,)).fetchone():
+        abort(404)
+    # El stream dura minutos: la conexión de la petición vuelve ya al pool
+    close_db()
+    last_seen = max(0, request.headers.get("Last-Event-ID", type=int) or request.args.get("after", 0, type=int))
+    subscription = live_replies.subscribe(id)
+    if subscription is None:
+        return Response("", status=503, headers={"Retry-After": "30"})
+    response = Response(stream_with_context(reply_events(subscription, last_seen)), mimetype="text/event-stream")
+    response.call_on_close(lambda: live_replies.unsubscribe(subscription))
+    response.headers["Cache-Control"] = "no-cache"
+    # Evita que proxies intermedios (nginx) acumulen el stream
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
-@app.route("/create_thread", methods=["GET", "POST"])
+@routes.route("/create_thread", methods=["GET", "POST"])
 def create_thread():
     if not session.get("user"):
         return redirect(url_for("login"))
@@ -913,20 +4649,26 @@ def create_thread():
         title = (request.form.get("title") or "").strip()
         content = (request.form.get("content") or "").strip()
         if title and content:
-            db = get_db()
-            cur = db.cursor()
-            cur.execute(
-                "INSERT INTO threads(title, content, author, created_at) VALUES (?,?,?,?)",
-                (title, content, session["user"], datetime.utcnow().strftime("%Y-%m-%d %H:%M")),
-            )
-            db.commit()
+            author_id = current_user_id()
+            if author_id is None:
+                return redirect(url_for("login"))
+            created_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M")
+            try:
+                run_write(lambda cur: cur.execute(
+                    "INSERT INTO threads(title, content, author_id, created_at) VALUES (?,?,?,?)",
+                    (title, content, author_id, created_at),
+                ))
+            except sqlite3.IntegrityError:
+                # Clave foránea o BAN_TRIGGERS: el autor fue (o está siendo) baneado con la sesión abierta
+                abort(403)
+            fragment_cache.discard("threads")
             flash("Hilo creado.", "success")
             return redirect(url_for("threads"))
         else:
             flash("El título y el contenido no pueden estar vacíos.", "error")
     return render_template("create_thread.html", title="Nuevo hilo")
 
-@app.route("/edit_thread/<int:id>", methods=["GET", "POST"])
+@routes.route("/edit_thread/<int:id>", methods=["GET", "POST"])
 def edit_thread(id: int):
     if not session.get("user"):
         return redirect(url_for("login"))
@@ -934,22 +4676,22 @@ def edit_thread(id: int):
     cur = db.cursor()
     cur.execute("SELECT * FROM threads WHERE id=?", (id,))
     thread = cur.fetchone()
-    if not thread or thread[3] != session["user"]:
+    if not thread or thread["author_id"] != current_user_id():
         abort(404)
     error = None
     if request.method == "POST":
         title = (request.form.get("title") or "").strip()
         content = (request.form.get("content") or "").strip()
         if title and content:
-            cur.execute("UPDATE threads SET title=?, content=? WHERE id=?", (title, content, id))
-            db.commit()
+            run_write(lambda cur: cur.execute("UPDATE threads SET title=?, content=? WHERE id=?", (title, content, id)))
+            invalidate_thread_fragments(id)
             flash("Cambios guardados.", "success")
             return redirect(url_for("thread_detail", id=id))
         else:
             error = "El título y el contenido no pueden estar vacíos."
     return render_template("edit_thread.html", thread=thread, error=error, title="Editar hilo")
 
-@app.route("/delete_thread/<int:id>")
+@routes.route("/delete_thread/<int:id>")
 def delete_thread(id: int):
     if not session.get("user"):
         return redirect(url_for("login"))
@@ -957,15 +4699,14 @@ def delete_thread(id: int):
     cur = db.cursor()
     cur.execute("SELECT * FROM threads WHERE id=?", (id,))
     thread = cur.fetchone()
-    if not thread or thread[3] != session["user"]:
+    if not thread or thread["author_id"] != current_user_id():
         abort(404)
-    cur.execute("DELETE FROM replies WHERE thread_id=?", (id,))
-    cur.execute("DELETE FROM threads WHERE id=?", (id,))
-    db.commit()
+    run_write(delete_threads, "id=?", (id,))
+    invalidate_thread_fragments(id)
     flash("Hilo eliminado.", "success")
     return redirect(url_for("threads"))
 
-@app.route("/delete_reply/<int:id>")
+@routes.route("/delete_reply/<int:id>")
 def delete_reply(id: int):
     if not session.get("user"):
         return redirect(url_for("login"))
@@ -973,26 +4714,46 @@ def delete_reply(id: int):
     cur = db.cursor()
     cur.execute("SELECT * FROM replies WHERE id=?", (id,))
     reply = cur.fetchone()
-    if not reply or reply[2] != session["user"]:
+    if not reply or reply["author_id"] != current_user_id():
         abort(404)
-    thread_id = reply[3]
-    cur.execute("DELETE FROM replies WHERE id=?", (id,))
-    db.commit()
+    thread_id = reply["thread_id"]
+    run_write(delete_replies, "id=?", (id,))
+    invalidate_thread_fragments(thread_id)
     flash("Respuesta eliminada.", "success")
     return redirect(url_for("thread_detail", id=thread_id))
 
+@routes.route("/search")
+def search():
+    if not session.get("user"):
+        return redirect(url_for("login"))
+    q = (request.args.get("q") or "").strip()
+    page = max(1, min(request.args.get("page", 1, type=int), SEARCH_MAX_PAGES))
+    results, has_next = search_forum(get_db().cursor(), q, page) if q else ([], False)
+    return render_template(
+        "search.html",
+        q=q,
+        results=results,
+        page=page,
+        has_next=has_next and page < SEARCH_MAX_PAGES,
+        title="Buscar",
+    )
+
 # --- Rutas para HTB ---
-@app.route("/htb")
+@routes.route("/htb")
 def htb():
     if not session.get("user"):
         return redirect(url_for("login"))
     db = get_db()
     cur = db.cursor()
+    htb_version, updated_at = content_stamp(cur, "htb")
+    cached = not_modified("htb", htb_version, last_modified=updated_at)
+    if cached:
+        return cached
     cur.execute("SELECT * FROM htb_machines ORDER BY name")
     machines = cur.fetchall()
     return render_template("htb.html", machines=machines, title="Máquinas HTB")
 
-@app.route("/add_htb", methods=["GET", "POST"])
+@routes.route("/add_htb", methods=["GET", "POST"])
 def add_htb():
     if not session.get("user"):
         return redirect(url_for("login"))
@@ -1010,13 +4771,10 @@ def add_htb():
         status = request.form.get("status")
         
         if name and difficulty and os and status:
-            db = get_db()
-            cur = db.cursor()
-            cur.execute(
+            run_write(lambda cur: cur.execute(
                 "INSERT INTO htb_machines(name, difficulty, os, ip, status) VALUES (?,?,?,?,?)",
                 (name, difficulty, os, ip if ip else None, status)
-            )
-            db.commit()
+            ))
             flash("Máquina añadida correctamente.", "success")
             return redirect(url_for("htb"))
         else:
@@ -1024,7 +4782,7 @@ def add_htb():
     
     return render_template("add_htb.html", title="Añadir máquina HTB")
 
-@app.route("/edit_htb/<int:id>", methods=["GET", "POST"])
+@routes.route("/edit_htb/<int:id>", methods=["GET", "POST"])
 def edit_htb(id: int):
     if not session.get("user"):
         return redirect(url_for("login"))
@@ -1050,11 +4808,10 @@ def edit_htb(id: int):
         status = request.form.get("status")
         
         if name and difficulty and os and status:
-            cur.execute(
+            run_write(lambda cur: cur.execute(
                 "UPDATE htb_machines SET name=?, difficulty=?, os=?, ip=?, status=? WHERE id=?",
                 (name, difficulty, os, ip if ip else None, status, id)
-            )
-            db.commit()
+            ))
             flash("Máquina actualizada correctamente.", "success")
             return redirect(url_for("htb"))
         else:
@@ -1062,7 +4819,7 @@ def edit_htb(id: int):
     
     return render_template("edit_htb.html", machine=machine, title="Editar máquina HTB")
 
-@app.route("/delete_htb/<int:id>")
+@routes.route("/delete_htb/<int:id>")
 def delete_htb(id: int):
     if not session.get("user"):
         return redirect(url_for("login"))
@@ -1072,15 +4829,12 @@ def delete_htb(id: int):
         flash("Solo el administrador puede eliminar máquinas.", "error")
         return redirect(url_for("htb"))
     
-    db = get_db()
-    cur = db.cursor()
-    cur.execute("DELETE FROM htb_machines WHERE id=?", (id,))
-    db.commit()
+    run_write(lambda cur: cur.execute("DELETE FROM htb_machines WHERE id=?", (id,)))
     flash("Máquina eliminada correctamente.", "success")
     return redirect(url_for("htb"))
 
 # --- Rutas para el panel de administrador ---
-@app.route("/admin")
+@routes.route("/admin")
 def admin_panel():
     if not session.get("user") or session.get("user") != "admin":
         flash("Acceso denegado. Solo el administrador puede acceder a este panel.", "error")
@@ -1088,18 +4842,96 @@ def admin_panel():
     
     db = get_db()
     cur = db.cursor()
+    users_after, users_limit = page_args("users_")
+    threads_after, threads_limit = page_args("threads_")
     
-    # Obtener todos los usuarios excepto el admin
-    cur.execute("SELECT id, username, created_at FROM users WHERE username != 'admin' ORDER BY id")
-    users = cur.fetchall()
+    # Usuarios excepto el admin, por orden de registro
+    users, users_next = fetch_page(
+        cur,
+        "SELECT id, username, created_at, password = '!' AS placeholder FROM users WHERE username != 'admin' AND id > ? ORDER BY id LIMIT ?",
+        (users_after or 0,),
+        users_limit,
+    )
     
-    # Obtener todos los hilos
-    cur.execute("SELECT id, title, author, created_at FROM threads ORDER BY id DESC")
-    threads = cur.fetchall()
+    # Hilos, del más reciente al más antiguo
+    threads, threads_next = fetch_page(
+        cur,
+        "SELECT id, title, author_id, created_at FROM threads WHERE id < ? ORDER BY id DESC LIMIT ?",
+        (threads_after if threads_after is not None else MAX_ID,),
+        threads_limit,
+    )
+    user_names.sync(cur)
+    user_names.prefetch(cur, [thread["author_id"] for thread in threads])
     
-    return render_template("admin.html", users=users, threads=threads, title="Panel de Administrador")
+    ban_status = bans.status(cur)
+    return render_template(
+        "admin.html",
+        users=users,
+        threads=threads,
+        users_after=users_after,
+        users_next=users_next,
+        threads_after=threads_after,
+        threads_next=threads_next,
+        # Solo se propagan si vinieron en la URL, así los enlaces por defecto quedan limpios
+        users_limit=users_limit if "users_limit" in request.args else None,
+        threads_limit=threads_limit if "threads_limit" in request.args else None,
+        backups=list_backups(),
+        backup_status=backups.status(),
+        ban_status=ban_status,
+        banning={job["user_id"]: job for job in ban_status["running"]},
+        title="Panel de Administrador",
+    )
+
+@routes.route("/admin/backup", methods=["POST"])
+def admin_backup():
+    if session.get("user") != "admin":
+        flash("Acceso denegado. Solo el administrador puede realizar esta acción.", "error")
+        return redirect(url_for("dashboard"))
+    try:
+        backups.start()
+    except BackupBusy as exc:
+        flash(str(exc), "error")
+    else:
+        flash("Copia de seguridad iniciada. Recarga el panel para ver el progreso.", "success")
+    return redirect(url_for("admin_panel"))
 
-@app.route("/admin/ban_user/<int:user_id>")
+@routes.route("/admin/profile", methods=["POST"])
+def admin_profile():
+    # Perfila el worker que atiende esta petición. Con wait=1 responde al terminar con el
+    # fichero .folded (curl -X POST ... > perfil.folded); si no, 202 y se descarga después
+    if session.get("user") != "admin":
+        abort(403)
+    seconds = request.values.get("seconds", type=float) or PROFILE_SECONDS
+    wait = request.values.get("wait") == "1"
+    try:
+        name = profiler.start(
+            seconds, all_threads=request.values.get("threads") == "all", exclude=[threading.get_ident()] if wait else ()
+        )
+    except ProfilerBusy as exc:
+        return jsonify(error=str(exc), status=profiler.status()), 409
+    if not wait:
+        return jsonify(
+            name=name, pid=os.getpid(), seconds=min(seconds, PROFILE_MAX_SECONDS),
+            url=url_for("admin_profile_file", name=name),
+        ), 202
+    profiler.wait()
+    return send_from_directory(profile_dir(), name, mimetype="text/plain", as_attachment=True)
+
+@routes.route("/admin/profiles")
+def admin_profiles():
+    if session.get("user") != "admin":
+        abort(403)
+    return jsonify(profiles=list_profiles(), status=profiler.status())
+
+@routes.route("/admin/profiles/<name>")
+def admin_profile_file(name):
+    if session.get("user") != "admin":
+        abort(403)
+    if not (name.startswith("profile-") and name.endswith(PROFILE_SUFFIX)):
+        abort(404)
+    return send_from_directory(profile_dir(), name, mimetype="text/plain", as_attachment=True)
+
+@routes.route("/admin/ban_user/<int:user_id>")
 def ban_user(user_id):
     if not session.get("user") or session.get("user") != "admin":
         flash("Acceso denegado. Solo el administrador puede realizar esta acción.", "error")
@@ -1117,21 +4949,20 @@ def ban_user(user_id):
         return redirect(url_for("admin_panel"))
     
     username = user[0]
-    
-    # Eliminar todas las respuestas del usuario
-    cur.execute("DELETE FROM replies WHERE author=?", (username,))
-    
-    # Eliminar todos los hilos del usuario
-    cur.execute("DELETE FROM threads WHERE author=?", (username,))
-    
-    # Eliminar al usuario
-    cur.execute("DELETE FROM users WHERE id=?", (user_id,))
-    
-    db.commit()
-    flash(f"El usuario '{username}' ha sido baneado y todo su contenido eliminado.", "success")
+    try:
+        job = bans.ban(user_id, username, ban_counts(cur, user_id))
+    except BanBusy as exc:
+        flash(str(exc), "error")
+        return redirect(url_for("admin_panel"))
+    if job.get("error"):
+        flash(f"No se pudo banear a '{username}': {job['error']}", "error")
+    elif job["chunked"]:
+        flash(f"Baneando a '{username}' ({job['total']} filas por borrar). El progreso aparece en el panel.", "success")
+    else:
+        flash(f"El usuario '{username}' ha sido baneado y todo su contenido eliminado.", "success")
     return redirect(url_for("admin_panel"))
 
-@app.route("/admin/delete_thread/<int:thread_id>")
+@routes.route("/admin/delete_thread/<int:thread_id>")
 def admin_delete_thread(thread_id):
     if not session.get("user") or session.get("user") != "admin":
         flash("Acceso denegado. Solo el administrador puede realizar esta acción.", "error")
@@ -1150,39 +4981,374 @@ def admin_delete_thread(thread_id):
     
     thread_title = thread[0]
     
-    # Eliminar todas las respuestas del hilo
-    cur.execute("DELETE FROM replies WHERE thread_id=?", (thread_id,))
-    
-    # Eliminar el hilo
-    cur.execute("DELETE FROM threads WHERE id=?", (thread_id,))
-    
-    db.commit()
+    # El hilo y sus respuestas (en cascada) en una sola sentencia
+    run_write(delete_threads, "id=?", (thread_id,))
+    invalidate_thread_fragments(thread_id)
     flash(f"El hilo '{thread_title}' ha sido eliminado.", "success")
     return redirect(url_for("admin_panel"))
 
+def collect_stats():
+    return {
+        "db_pool": get_pool().stats(),
+        "password_hasher": get_hasher().stats(),
+        "login_throttle": login_throttle.stats() if login_throttle else None,
+        "unknown_users": unknown_users.stats(),
+        "user_names": user_names.stats(),
+        "fragment_cache": fragment_cache.stats(),
+        "writer": get_writer().stats(),
+        "dashboard_stats": dashboard_stats.stats(),
+        "live_replies": live_replies.stats(),
+        "backups": backups.stats(),
+        "bans": bans.stats(),
+        "profiler": profiler.stats(),
+        "template_cache": (
+            current_app.jinja_env.bytecode_cache.stats() if current_app.jinja_env.bytecode_cache else None
+        ),
+        "compression": (
+            current_app.extensions["compression"].stats() if "compression" in current_app.extensions else None
+        ),
+    }
+
+@routes.route("/admin/stats")
+def admin_stats():
+    if session.get("user") != "admin":
+        abort(403)
+    return jsonify(collect_stats())
+
+@routes.route("/metrics")
+def metrics_endpoint():
+    # Admin con sesión o un scraper con Authorization: Bearer METRICS_TOKEN
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    authorized = session.get("user") == "admin" or (
+        METRICS_TOKEN and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode())
+    )
+    if not authorized:
+        abort(403)
+    body = metrics.render(stats_gauges(collect_stats()))
+    response = Response(body, mimetype="text/plain")
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+@routes.route("/healthz")
+def healthz():
+    # Readiness para el balanceador: hay conexión a la base de datos y el esquema está al día
+    try:
+        row = get_db().execute("SELECT MAX(version) FROM schema_version").fetchone()
+    except (sqlite3.Error, PoolTimeout):
+        return jsonify(status="unavailable"), 503
+    latest = MIGRATIONS[-1][0]
+    if (row[0] or 0) < latest:
+        return jsonify(status="migrating", schema=row[0], expected=latest), 503
+    return jsonify(status="ok", schema=row[0], pid=os.getpid())
+
 # --- Error handlers ---
-@app.errorhandler(404)
+@routes.errorhandler(404)
 def page_not_found(e):
     return render_template("404.html", title="404"), 404
 
-@app.errorhandler(500)
+@routes.errorhandler(500)
 def internal_server_error(e):
     return render_template("500.html", title="500"), 500
 
-# --------------- Main ---------------
-if __name__ == "__main__":
-    # Asegurar que los directorios existan
+@routes.errorhandler(503)
+def service_unavailable(e):
+    return render_template("503.html", title="503"), 503, {"Retry-After": "2"}
+
+@routes.errorhandler(WriteUnavailable)
+def write_unavailable(e):
+    return service_unavailable(e)
+
+@routes.errorhandler(PoolTimeout)
+def pool_exhausted(e):
+    # Pool saturado: es sobrecarga pasajera, no un fallo; el cliente puede reintentar
+    return service_unavailable(e)
+
+# --------------- CLI: flask --app app nebula <comando> ---------------
+nebula_cli = AppGroup("nebula", help="Tareas de mantenimiento de Nebula Vault.")
+
+@nebula_cli.command("init-db")
+@click.option("--seed/--no-seed", default=None, help="Datos de ejemplo (por defecto, solo si la base de datos es nueva).")
+def init_db_command(seed):
+    """Crea la base de datos y aplica las migraciones pendientes."""
     ensure_dirs()
-    
-    # Generar plantillas y archivos estáticos si no existen
-    if not os.path.exists(os.path.join(TEMPLATES_DIR, "base.html")):
-        print("Generando plantillas por primera vez...")
-        scaffold_assets()
-    
-    # Inicializar la base de datos solo si no existe
-    init_db(seed=not os.path.exists(DB_PATH))
-    
-    # Configurar para producción en Render
+    if seed is None:
+        seed = not os.path.exists(DB_PATH)
+    init_db(seed=seed)
+    db = connect_db()
+    try:
+        click.echo(f"Base de datos lista en {DB_PATH} (versión {schema_version(db)})")
+    finally:
+        db.close()
+
+@nebula_cli.command("scaffold")
+@click.option("--if-missing", is_flag=True, help="No hacer nada si ya existe templates/base.html.")
+def scaffold_command(if_missing):
+    """Escribe las plantillas y static/style.css definidos en app.py."""
+    if if_missing and os.path.exists(os.path.join(TEMPLATES_DIR, "base.html")):
+        click.echo("Las plantillas ya existen.")
+        return
+    scaffold_assets()
+
+@nebula_cli.command("migrate")
+@click.option("--target", type=int, default=None, help="Versión máxima a aplicar.")
+def migrate_command(target):
+    """Aplica las migraciones de esquema pendientes."""
+    db = connect_db()
+    try:
+        applied = run_migrations(db, target=target)
+        click.echo(f"Migraciones aplicadas: {applied or 'ninguna'} (versión actual {schema_version(db)})")
+    finally:
+        db.close()
+
+@nebula_cli.command("repair-counters")
+def repair_counters_command():
+    """Reconstruye reply_count y last_reply_at de todos los hilos."""
+    db = connect_db()
+    try:
+        cur = db.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        stale = stale_thread_counters(cur)
+        refresh_thread_counters(cur)
+        db.commit()
+    finally:
+        db.close()
+    click.echo(f"Contadores reconstruidos ({stale} hilos estaban desincronizados).")
+
+@nebula_cli.command("resume-bans")
+def resume_bans_command():
+    """Termina los baneos que quedaron a medias (worker caído o fallo)."""
+    jobs = bans.resume(background=False)
+    for job in jobs:
+        if job.get("error"):
+            click.echo(f"Baneo de {job['username']} fallido: {job['error']}", err=True)
+        else:
+            click.echo(f"{job['username']} baneado: {job['done']} filas.")
+    click.echo(f"{len(jobs)} baneos retomados.")
+    if any(job.get("error") for job in jobs):
+        raise SystemExit(1)
+
+@nebula_cli.command("rebuild-search")
+def rebuild_search_command():
+    """Reconstruye el índice FTS5 de búsqueda desde threads y replies."""
+    db = connect_db()
+    try:
+        cur = db.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        rebuild_search_index(cur)
+        db.commit()
+        count = db.execute("SELECT COUNT(*) FROM search_index").fetchone()[0]
+    finally:
+        db.close()
+    click.echo(f"Índice de búsqueda reconstruido: {count} documentos.")
+
+@nebula_cli.command("build-assets")
+@click.option("--no-fetch", is_flag=True, help="No descargar Alpine si no está en static/vendor.")
+def build_assets_command(no_fetch):
+    """Compila CSS y JS a static/dist con hash de contenido y variantes .gz/.br."""
+    manifest, sizes = build_assets(fetch=not no_fetch)
+    for name, hashed in sorted(manifest.items()):
+        click.echo(f"{name:<10} → dist/{hashed} ({sizes[name]} bytes)")
+    if "app.css" not in manifest:
+        click.echo(f"Tailwind CLI no encontrado ({TAILWIND_BIN}); las páginas seguirán usando la CDN.", err=True)
+
+@nebula_cli.command("precompile")
+def precompile_command():
+    """Compila todas las plantillas al caché de bytecode (TEMPLATE_CACHE_DIR)."""
+    if not TEMPLATE_CACHE_DIR:
+        raise click.ClickException("TEMPLATE_CACHE_DIR está vacío: el caché de bytecode está desactivado.")
+    names = preload_templates(current_app)
+    click.echo(f"{len(names)} plantillas compiladas en {TEMPLATE_CACHE_DIR}")
+
+@nebula_cli.command("check-plans")
+def check_plans_command():
+    """Falla si alguna consulta caliente recorre una tabla sin índice."""
+    db = connect_db()
+    try:
+        problems = check_query_plans(db)
+    finally:
+        db.close()
+    for name, detail in problems:
+        click.echo(f"✗ {name}: {detail}", err=True)
+    if problems:
+        raise SystemExit(1)
+    click.echo(f"Planes correctos para {len(HOT_QUERIES)} consultas.")
+
+@nebula_cli.command("backup")
+@click.option("--dir", "directory", type=click.Path(file_okay=False), help="Destino (por defecto BACKUP_DIR o data/backups).")
+@click.option("--keep", type=click.IntRange(1), default=BACKUP_KEEP, show_default=True, help="Copias que se conservan.")
+def backup_command(directory, keep):
+    """Copia en caliente de la base de datos: gzip + sha256, con rotación."""
+    reported = []
+
+    def report(done, total):
+        # Una línea por cada 10 %
+        percent = done * 100 // total if total else 100
+        if not reported or percent >= reported[-1] + 10:
+            reported.append(percent)
+            click.echo(f"  {percent:3d}% ({done}/{total} páginas)", err=True)
+
+    try:
+        result = create_backup(directory, keep, report)
+    except (BackupBusy, FileExistsError) as exc:
+        raise click.ClickException(str(exc))
+    ratio = result["size"] / result["database_size"] if result["database_size"] else 0
+    click.echo(
+        f"{result['name']}: {result['database_size']} → {result['size']} bytes ({ratio:.0%}) "
+        f"copia {result['copy_s']}s en {result['steps']} pasos, gzip {result['compress_s']}s"
+    )
+    click.echo(f"sha256 {result['sha256']}")
+    if result["restarts"]:
+        click.echo(f"La copia se reinició {result['restarts']} veces por escrituras concurrentes.", err=True)
+    for name in result["pruned"]:
+        click.echo(f"Eliminada {name} (más de {keep} copias)")
+
+@nebula_cli.command("generate")
+@click.option("--users", type=click.IntRange(0), default=10000, show_default=True)
+@click.option("--threads", type=click.IntRange(0), default=50000, show_default=True)
+@click.option("--replies", type=click.IntRange(0), default=1000000, show_default=True)
+@click.option("--days", type=click.IntRange(1), default=365, show_default=True, help="Antigüedad del primer mensaje.")
+@click.option("--seed", type=int, default=None, help="Semilla para repetir exactamente el mismo foro.")
+@click.option("--password", default=SYNTHETIC_PASSWORD, show_default=True, help="Contraseña de todos los usuarios generados.")
+def generate_command(users, threads, replies, days, seed, password):
+    """Llena la base de datos con un foro sintético grande (usuarios, hilos y respuestas con sesgo)."""
+    reported = {}
+
+    def report(table, done, total):
+        percent = done * 100 // total if total else 100
+        if percent >= reported.get(table, -10) + 10:
+            reported[table] = percent
+            click.echo(f"  {table}: {percent:3d}% ({done}/{total})", err=True)
+
+    db = connect_db()
+    start = time.perf_counter()
+    try:
+        result = generate_forum(db, users, threads, replies, days, seed, password=password, on_progress=report)
+    except ValueError as exc:
+        raise click.UsageError(str(exc))
+    finally:
+        db.close()
+    elapsed = time.perf_counter() - start
+    total = users + threads + replies
+    click.echo(
+        f"Generados {users} usuarios, {threads} hilos y {replies} respuestas en {elapsed:.1f}s "
+        f"({total / elapsed if elapsed else 0:.0f} filas/s); {os.path.getsize(DB_PATH) // (1024 * 1024)} MiB"
+    )
+    if users:
+        click.echo(f"Usuarios user{result['first_ids']['users']}…user{result['first_ids']['users'] + users - 1}, contraseña {password!r}")
+
+@nebula_cli.command("export")
+@click.option("-o", "--output", type=click.File("w", encoding="utf-8"), default="-", help="Fichero NDJSON (por defecto, stdout).")
+@click.option("--table", "tables", multiple=True, type=click.Choice(list(NDJSON_TABLES)), help="Solo estas tablas (repetible).")
+@click.option("--since", help="Solo filas creadas (y hilos editados) desde esta fecha: AAAA-MM-DD[ HH:MM[:SS]].")
+@click.option("--offset", type=click.IntRange(0), default=0, help="Omitir las primeras N líneas (continuar un volcado cortado con >>).")
+def export_command(output, tables, since, offset):
+    """Vuelca usuarios, hilos, respuestas y máquinas HTB como NDJSON."""
+    try:
+        since = parse_since(since) if since else None
+    except ValueError as exc:
+        raise click.BadParameter(str(exc), param_hint="--since")
+    db = connect_db()
+    start = time.perf_counter()
+    try:
+        counts = export_ndjson(db, output, [t for t in NDJSON_TABLES if t in tables] or None, since, offset)
+    finally:
+        db.close()
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    summary = ", ".join(f"{table}={count}" for table, count in counts.items())
+    click.echo(f"Exportadas {total} filas ({summary}) en {elapsed:.2f}s", err=True)
+
+@nebula_cli.command("import")
+@click.argument("source", type=click.File("r", encoding="utf-8"), default="-")
+@click.option("--offset", type=click.IntRange(0), default=0, help="Saltar las filas de las primeras N líneas (reanudar una importación).")
+@click.option("--batch-size", type=click.IntRange(1), default=IMPORT_BATCH_SIZE, show_default=True, help="Filas por executemany.")
+@click.option("--commit-every", type=click.IntRange(1), default=IMPORT_COMMIT_ROWS, show_default=True, help="Filas por transacción.")
+def import_command(source, offset, batch_size, commit_every):
+    """Importa un volcado NDJSON (upsert por id); recalcula búsqueda, contadores y versiones."""
+    db = connect_db()
+    start = time.perf_counter()
+    try:
+        counts = NdjsonImporter(db, batch_size, commit_every).run(source, offset)
+    except NdjsonImportError as exc:
+        raise click.ClickException(f"{exc}. Confirmado hasta la línea {exc.committed}: reanuda con --offset {exc.committed}")
+    finally:
+        db.close()
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    summary = ", ".join(f"{table}={count}" for table, count in counts.items())
+    click.echo(f"Importadas {total} filas ({summary}) en {elapsed:.2f}s ({total / elapsed if elapsed else 0:.0f} filas/s)")
+
+# --------------- Caché de bytecode de plantillas ---------------
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    # Jinja invalida cada entrada comparando el hash del fuente, así que una plantilla editada
+    # se recompila sola. Si el directorio no se puede escribir, la plantilla se compila igual.
+    def __init__(self, directory):
+        super().__init__(directory)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._errors = 0
+
+    def load_bytecode(self, bucket):
+        super().load_bytecode(bucket)
+        with self._lock:
+            if bucket.code is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+
+    def dump_bytecode(self, bucket):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            super().dump_bytecode(bucket)
+        except OSError:
+            logger.warning("No se pudo guardar el bytecode de %s", bucket.key, exc_info=True)
+            with self._lock:
+                self._errors += 1
+
+    def stats(self):
+        with self._lock:
+            return {"directory": self.directory, "hits": self._hits, "misses": self._misses, "errors": self._errors}
+
+# --------------- Fábrica de la aplicación ---------------
+def create_app(config=None):
+    # Crear la app no toca el disco ni la base de datos: plantillas y esquema se preparan con
+    # `flask nebula scaffold` / `flask nebula init-db`, y el pool, el escritor y el pool de
+    # hash arrancan con la primera petición que los necesita
+    app = Flask(__name__, template_folder=TEMPLATES_DIR, static_folder=STATIC_DIR)
+    app.config.update(
+        SECRET_KEY=os.environ.get("SECRET_KEY", os.urandom(32)),
+        PROXY_FIX_HOPS=PROXY_FIX_HOPS,
+        COMPRESS_RESPONSES=COMPRESS_RESPONSES,
+    )
+    if config:
+        app.config.update(config)
     app.jinja_env.globals.update(datetime=datetime)
+    if TEMPLATE_CACHE_DIR:
+        app.jinja_env.bytecode_cache = TemplateBytecodeCache(TEMPLATE_CACHE_DIR)
+    routes.init_app(app)
+    app.view_functions["static"] = static_file
+    app.cli.add_command(nebula_cli)
+    hops = app.config["PROXY_FIX_HOPS"]
+    if hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+    if app.config["COMPRESS_RESPONSES"]:
+        app.wsgi_app = app.extensions["compression"] = CompressionMiddleware(app.wsgi_app)
+    return app
+
+def preload_templates(app):
+    # Compila todas las plantillas; los servidores pre-fork lo hacen una vez en el maestro
+    # y los workers heredan el caché de Jinja. Con el caché de bytecode caliente solo se
+    # cargan los .cache ya compilados.
+    names = app.jinja_env.list_templates(extensions=["html"])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
+
+# --------------- Main ---------------
+if __name__ == "__main__":
+    # Servidor de desarrollo (un solo proceso). Antes: flask --app app nebula init-db
+    # En Render: python serve.py
     port = int(os.environ.get("PORT", 10000))
-    app.run(host="0.0.0.0", port=port)
\ No newline at end of file
+    create_app().run(host="0.0.0.0", port=port)
\ No newline at end of file
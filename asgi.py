@@ -0,0 +1,315 @@
+import asyncio
+import functools
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from itsdangerous import BadSignature
+from werkzeug.http import parse_cookie
+
+import app as nebula
+
+###############################################
+#  Punto de entrada ASGI de Nebula Vault (opcional)
+#  • uvicorn asgi:application --host 0.0.0.0 --port $PORT   (o python asgi.py; pip install uvicorn)
+#  • Las rutas de siempre pasan por un adaptador WSGI → ASGI propio y se ejecutan en un pool
+#    de ASGI_WSGI_THREADS hilos, igual que con serve.py
+#  • /thread/<id>/events es nativo: cada stream es una corrutina que espera al broker sin
+#    ocupar un hilo; SQLite y el render de fragmentos van a un pool de ASGI_DB_THREADS hilos
+#  • Con --workers > 1 hace falta SECRET_KEY fija: cada worker importa la app por su cuenta
+#  • kill -USR2 <pid> → perfil por muestreo de las peticiones WSGI de ese proceso
+#  • Esquema, plantillas y recursos se preparan igual que para wsgi.py
+###############################################
+ASGI_WSGI_THREADS = int(os.environ.get("ASGI_WSGI_THREADS", os.environ.get("WEB_THREADS", 8)))
+# Hilos para el trabajo bloqueante de los streams nativos; cada uno usa como mucho una
+# conexión del pool durante un instante
+ASGI_DB_THREADS = int(os.environ.get("ASGI_DB_THREADS", 4))
+# Un stream en espera cuesta una corrutina y una cola, no un hilo
+ASGI_MAX_SUBSCRIBERS = int(os.environ.get("ASGI_MAX_SUBSCRIBERS", 1000))
+EVENTS_PATH = re.compile(r"/thread/(\d+)/events")
+
+class AsyncSubscription(nebula.Subscription):
+    # El broker publica desde el hilo de la petición POST; la cola se llena en el event loop
+    def __init__(self, thread_id, loop):
+        self.thread_id = thread_id
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.lagged = False
+
+    def deliver(self, item):
+        # qsize() desde otro hilo es aproximado: basta para acotar la cola
+        if self.queue.qsize() >= self.QUEUE_SIZE:
+            return False
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        except RuntimeError:
+            # El event loop ya se cerró (parada del servidor)
+            return False
+        return True
+
+def wsgi_environ(scope, body):
+    # Petición HTTP de ASGI → environ WSGI (PEP 3333), como la sección de compatibilidad WSGI
+    # de la especificación ASGI
+    script_name = scope.get("root_path", "").encode("utf8").decode("latin1")
+    path_info = scope["path"].encode("utf8").decode("latin1")
+    if path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": script_name,
+        "PATH_INFO": path_info,
+        "QUERY_STRING": scope["query_string"].decode("ascii"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope["headers"]:
+        name = name.decode("latin1")
+        if name == "content-length":
+            key = "CONTENT_LENGTH"
+        elif name == "content-type":
+            key = "CONTENT_TYPE"
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+        value = value.decode("latin1")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+class PooledWsgiToAsgi:
+    # Adaptador WSGI → ASGI: cada petición toma un hilo del pool y la respuesta va al event
+    # loop a medida que la app la produce (cada envío espera al anterior: contrapresión)
+    def __init__(self, wsgi_application, threads):
+        self.wsgi_application = wsgi_application
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="nebula-wsgi")
+
+    async def __call__(self, scope, receive, send):
+        # Los cuerpos grandes pasan a disco en lugar de quedarse en memoria
+        body = tempfile.SpooledTemporaryFile(max_size=64 * 1024)
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return
+                body.write(message.get("body", b""))
+                if not message.get("more_body"):
+                    break
+            body.seek(0)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, self.run, wsgi_environ(scope, body), send, loop)
+        finally:
+            body.close()
+
+    def run(self, environ, send, loop):
+        response = {"start": None, "sent": False}
+
+        def deliver(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def send_start():
+            # Sin esto el servidor recibiría None y fallaría con un error de protocolo opaco
+            if response["start"] is None:
+                raise RuntimeError("La app WSGI no llamó a start_response antes de responder")
+            deliver(response["start"])
+            response["sent"] = True
+
+        def write(data):
+            if not response["sent"]:
+                send_start()
+            deliver({"type": "http.response.body", "body": data, "more_body": True})
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response["sent"]:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response["start"] = {
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [(name.lower().encode("latin1"), value.encode("latin1")) for name, value in headers],
+            }
+            return write
+
+        result = self.wsgi_application(environ, start_response)
+        try:
+            for data in result:
+                if data:
+                    write(data)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        if not response["sent"]:
+            send_start()
+        deliver({"type": "http.response.body", "body": b""})
+
+class NebulaASGI:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = PooledWsgiToAsgi(flask_app, ASGI_WSGI_THREADS)
+        self.db_executor = ThreadPoolExecutor(ASGI_DB_THREADS, thread_name_prefix="nebula-db")
+        self.serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] == "http" and scope["method"] == "GET":
+            match = EVENTS_PATH.fullmatch(scope["path"])
+            if match:
+                return await self.thread_events(scope, receive, send, int(match[1]))
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.wsgi.executor.shutdown(wait=True)
+                self.db_executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # --------------- Utilidades ---------------
+    def session_user(self, scope):
+        # Misma cookie firmada que lee Flask; el stream no necesita el resto de la sesión
+        header = b"; ".join(value for name, value in scope["headers"] if name == b"cookie")
+        cookie = parse_cookie(header.decode("latin-1")).get(self.flask_app.config["SESSION_COOKIE_NAME"])
+        if not cookie:
+            return None
+        max_age = int(self.flask_app.permanent_session_lifetime.total_seconds())
+        try:
+            return self.serializer.loads(cookie, max_age=max_age).get("user")
+        except BadSignature:
+            return None
+
+    def blocking(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.db_executor, functools.partial(fn, *args))
+
+    def thread_exists(self, thread_id):
+        pool = nebula.get_pool()
+        db = pool.acquire()
+        try:
+            return db.execute("SELECT 1 FROM threads WHERE id=?", (thread_id,)).fetchone() is not None
+        finally:
+            pool.release(db)
+
+    def render_events(self, thread_id, replies):
+        # _reply.html usa url_for: se renderiza dentro de un contexto de petición vacío
+        with self.flask_app.test_request_context():
+            return [(reply["id"], nebula.reply_event(thread_id, reply)) for reply in replies]
+
+    def poll_events(self, thread_id, last_seen):
+        return self.render_events(thread_id, nebula.fetch_new_replies(thread_id, last_seen))
+
+    @staticmethod
+    async def respond(send, status, headers=()):
+        await send({"type": "http.response.start", "status": status, "headers": list(headers)})
+        await send({"type": "http.response.body", "body": b""})
+
+    @staticmethod
+    async def wait_disconnect(receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    # --------------- Respuestas en vivo (SSE nativo) ---------------
+    async def thread_events(self, scope, receive, send, thread_id):
+        # Mismo contrato que la ruta thread_events de app.py
+        if not self.session_user(scope):
+            return await self.respond(send, 401)
+        if not nebula.LIVE_REPLIES or not await self.blocking(self.thread_exists, thread_id):
+            return await self.respond(send, 404)
+        headers = dict(scope["headers"])
+        query = parse_qs(scope["query_string"].decode("latin-1"))
+        try:
+            last_seen = max(0, int(headers.get(b"last-event-id") or query.get("after", [0])[0]))
+        except ValueError:
+            last_seen = 0
+        loop = asyncio.get_running_loop()
+        subscription = nebula.live_replies.subscribe(thread_id, functools.partial(AsyncSubscription, loop=loop))
+        if subscription is None:
+            return await self.respond(send, 503, [(b"retry-after", b"30")])
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", b"text/event-stream; charset=utf-8"),
+                    (b"cache-control", b"no-cache"),
+                    (b"x-accel-buffering", b"no"),
+                ],
+            })
+
+            async def emit(chunk):
+                await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+
+            await emit(f"retry: {nebula.LIVE_HEARTBEAT * 1000}\n\n")
+            started = time.monotonic()
+            next_poll = started + nebula.LIVE_POLL_INTERVAL if nebula.LIVE_POLL_INTERVAL else None
+            next_heartbeat = started + nebula.LIVE_HEARTBEAT
+            while time.monotonic() - started < nebula.LIVE_STREAM_MAX and not disconnected.done():
+                wake = min(t for t in (next_poll, next_heartbeat) if t is not None)
+                getter = asyncio.ensure_future(subscription.queue.get())
+                await asyncio.wait(
+                    {getter, disconnected}, timeout=max(0.0, wake - time.monotonic()),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if getter.done():
+                    published_at, reply = getter.result()
+                else:
+                    getter.cancel()
+                    published_at = reply = None
+                if disconnected.done():
+                    break
+                now = time.monotonic()
+                if reply is not None and reply["id"] > last_seen and not subscription.lagged:
+                    for reply_id, event in await self.blocking(self.render_events, thread_id, [reply]):
+                        await emit(event)
+                        last_seen = reply_id
+                    nebula.live_replies.record_delivery(published_at)
+                    next_heartbeat = now + nebula.LIVE_HEARTBEAT
+                elif subscription.lagged or (next_poll is not None and now >= next_poll):
+                    subscription.lagged = False
+                    for reply_id, event in await self.blocking(self.poll_events, thread_id, last_seen):
+                        await emit(event)
+                        last_seen = reply_id
+                        next_heartbeat = now + nebula.LIVE_HEARTBEAT
+                    if next_poll is not None:
+                        next_poll = now + nebula.LIVE_POLL_INTERVAL
+                if now >= next_heartbeat:
+                    await emit(": ping\n\n")
+                    next_heartbeat = now + nebula.LIVE_HEARTBEAT
+            if not disconnected.done():
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnected.cancel()
+            nebula.live_replies.unsubscribe(subscription)
+
+def create_asgi_app(config=None):
+    # Aquí los streams no ocupan hilos: el broker admite muchos más suscriptores por proceso
+    nebula.live_replies.max_subscribers = ASGI_MAX_SUBSCRIBERS
+    flask_app = nebula.create_app(config)
+    nebula.preload_templates(flask_app)
+    if threading.current_thread() is threading.main_thread():
+        nebula.install_profile_signal()
+    return NebulaASGI(flask_app)
+
+application = create_asgi_app()
+
+if __name__ == "__main__":
+    import uvicorn
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    uvicorn.run(application, host=os.environ.get("HOST", "0.0.0.0"), port=int(os.environ.get("PORT", 10000)))
@@ -0,0 +1,1126 @@
+import argparse
+import asyncio
+import http.client
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import app as nebula
+
+###############################################
+#  Benchmarks de Nebula Vault
+#  • Se ejecutan contra bases de datos temporales, nunca contra data/db.sqlite3
+#  • python bench.py wal      → latencia de lectura con escritores concurrentes
+#  • python bench.py search   → FTS5 frente a LIKE '%term%' sobre un corpus sintético
+#  • python bench.py login    → p99 de login con hash en línea frente al pool de procesos
+#  • python bench.py compress → bytes y latencia de las páginas grandes con cada codificación
+#  • python bench.py startup  → arranque en frío: import, create_app() y primera petición
+#  • python bench.py templates → primera petición de un worker nuevo con y sin caché de bytecode
+#  • python bench.py live     → latencia de reparto de respuestas SSE a N suscriptores
+#  • python bench.py concurrency → streams SSE abiertos y latencia de página en serve.py y en asgi.py
+#  • python bench.py ndjson   → filas/s de flask nebula export / import
+#  • python bench.py backup   → latencia de lecturas y escrituras mientras corre una copia en caliente
+#  • python bench.py ban      → latencia de escritura mientras se banea a un usuario con mucho contenido
+#  • python bench.py metrics  → coste de la instrumentación por petición (SQL, plantillas, histogramas)
+#  • python bench.py load     → rendimiento y p50/p95/p99 por ruta sobre un foro sintético grande,
+#    con el cliente de pruebas y por HTTP; --save-baseline / --baseline para detectar regresiones
+#  • python bench.py pages    → tamaño de la base de datos sintética y latencia de las páginas de
+#    listado renderizadas en frío (sin caché de fragmentos) y desde la caché
+###############################################
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+def summarize(values):
+    # Resumen en milisegundos de una lista de duraciones en segundos
+    ms = [v * 1000 for v in values]
+    return {
+        "n": len(ms),
+        "mean": round(statistics.fmean(ms), 3) if ms else 0.0,
+        "p50": round(percentile(ms, 50), 3),
+        "p95": round(percentile(ms, 95), 3),
+        "p99": round(percentile(ms, 99), 3),
+        "max": round(max(ms), 3) if ms else 0.0,
+    }
+
+def use_database(path, **settings):
+    # Apunta la app a otra base de datos y ajustes; descarta el pool y el escritor actuales
+    nebula.DB_PATH = path
+    for name, value in settings.items():
+        setattr(nebula, name, value)
+    nebula._pool = None
+    nebula._writer = None
+
+def fresh_database(**settings):
+    path = os.path.join(tempfile.mkdtemp(prefix="nebula-bench-"), "db.sqlite3")
+    use_database(path, **settings)
+    nebula.init_db(seed=True)
+    return path
+
+def seed_users(db, count=50):
+    # Autores user0..user<count-1> (sin contraseña válida); devuelve sus ids en ese orden
+    db.executemany("INSERT OR IGNORE INTO users(username, password) VALUES (?, '!')", ((f"user{i}",) for i in range(count)))
+    ids = dict(db.execute("SELECT username, id FROM users WHERE username GLOB 'user[0-9]*'"))
+    return [ids[f"user{i}"] for i in range(count)]
+
+def seed_forum(path, threads, replies_per_thread):
+    db = sqlite3.connect(path)
+    authors = seed_users(db)
+    db.executemany(
+        "INSERT INTO threads(title, content, author_id) VALUES (?,?,?)",
+        ((f"Hilo {i}", "contenido " * 20, authors[i % 50]) for i in range(threads)),
+    )
+    db.executemany(
+        "INSERT INTO replies(content, author_id, thread_id) VALUES (?,?,?)",
+        (("respuesta " * 10, authors[i % 50], 1 + i % threads) for i in range(threads * replies_per_thread)),
+    )
+    db.commit()
+    db.close()
+
+# --------------- wal: lecturas mientras hay escritores ---------------
+LIST_QUERY = """
+    SELECT t.*, COUNT(r.id) AS reply_count
+    FROM threads t
+    LEFT JOIN replies r ON r.thread_id = t.id
+    GROUP BY t.id
+    ORDER BY t.id DESC
+"""
+
+def legacy_write(path, thread_count):
+    # Como el código original: conexión nueva, INSERT y commit propio por escritura
+    db = sqlite3.connect(path)
+    try:
+        db.execute(
+            "INSERT INTO replies(content, author_id, thread_id) VALUES (?,?,?)",
+            ("bench", 1, 1 + int(time.time() * 1000) % thread_count),
+        )
+        db.commit()
+    finally:
+        db.close()
+
+def tuned_write(path, thread_count):
+    nebula.run_write(lambda cur: cur.execute(
+        "INSERT INTO replies(content, author_id, thread_id) VALUES (?,?,?)",
+        ("bench", 1, 1 + int(time.time() * 1000) % thread_count),
+    ))
+
+def legacy_read(path):
+    db = sqlite3.connect(path)
+    try:
+        db.execute(LIST_QUERY).fetchall()
+    finally:
+        db.close()
+
+def tuned_read(path):
+    pool = nebula.get_pool()
+    db = pool.acquire()
+    try:
+        db.execute(LIST_QUERY).fetchall()
+    finally:
+        pool.release(db)
+
+def run_wal_scenario(name, settings, write, read, args):
+    path = fresh_database(**settings)
+    seed_forum(path, args.threads, args.replies)
+    thread_count = args.threads + 2
+    stop = threading.Event()
+    latencies = []
+    counters = {"writes": 0, "locked": 0}
+    lock = threading.Lock()
+
+    def writer():
+        while not stop.is_set():
+            try:
+                write(path, thread_count)
+            except sqlite3.OperationalError:
+                with lock:
+                    counters["locked"] += 1
+            else:
+                with lock:
+                    counters["writes"] += 1
+
+    def reader():
+        local = []
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                read(path)
+            except sqlite3.OperationalError:
+                with lock:
+                    counters["locked"] += 1
+                continue
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=writer) for _ in range(args.writers)]
+    workers += [threading.Thread(target=reader) for _ in range(args.readers)]
+    for t in workers:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in workers:
+        t.join()
+    result = summarize(latencies)
+    print(
+        f"{name:>7}  reads p50={result['p50']}ms p95={result['p95']}ms p99={result['p99']}ms "
+        f"max={result['max']}ms  reads={result['n']}  writes/s={counters['writes'] / args.duration:.0f}  "
+        f"errores_lock={counters['locked']}"
+    )
+
+def bench_wal(args):
+    print(f"{args.writers} escritores, {args.readers} lectores, {args.duration}s por escenario")
+    run_wal_scenario(
+        "legacy",
+        {"SQLITE_JOURNAL_MODE": "DELETE", "SQLITE_SYNCHRONOUS": "FULL"},
+        legacy_write, legacy_read, args,
+    )
+    run_wal_scenario(
+        "wal",
+        {"SQLITE_JOURNAL_MODE": "WAL", "SQLITE_SYNCHRONOUS": "NORMAL"},
+        tuned_write, tuned_read, args,
+    )
+
+# --------------- search: FTS5 vs LIKE ---------------
+def synthetic_words(count, rng):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(4, 10))) for _ in range(count)]
+
+def synthetic_text(words, rng, length):
+    # Distribución sesgada: unas pocas palabras muy frecuentes y una cola larga de raras
+    return " ".join(words[min(len(words) - 1, int(rng.paretovariate(1.2)) - 1)] for _ in range(length))
+
+def bench_search(args):
+    rng = random.Random(args.seed)
+    words = synthetic_words(args.vocabulary, rng)
+    rng.shuffle(words)
+    path = fresh_database()
+    db = sqlite3.connect(path)
+    start = time.perf_counter()
+    db.executemany(
+        "INSERT INTO threads(title, content, author_id) VALUES (?,?,?)",
+        ((synthetic_text(words, rng, 6), synthetic_text(words, rng, 60), 1) for _ in range(args.threads)),
+    )
+    db.executemany(
+        "INSERT INTO replies(content, author_id, thread_id) VALUES (?,?,?)",
+        ((synthetic_text(words, rng, 30), 1, rng.randint(1, args.threads)) for _ in range(args.replies)),
+    )
+    db.commit()
+    db.close()
+    print(f"Corpus: {args.threads} hilos, {args.replies} respuestas, indexado en {time.perf_counter() - start:.1f}s")
+
+    # Términos frecuentes (cabeza de la distribución) y raros (cola); LIKE con LIMIT para pronto
+    # con los frecuentes, pero con los raros tiene que recorrer todas las filas
+    terms = {"frecuentes": words[:10], "raros": rng.sample(words[1000:], 20)}
+    like_sql = """
+        SELECT id FROM threads WHERE title LIKE ?1 OR content LIKE ?1
+        UNION ALL
+        SELECT thread_id FROM replies WHERE content LIKE ?1
+        LIMIT ?2
+    """
+    pool = nebula.get_pool()
+    conn = pool.acquire()
+    try:
+        cur = conn.cursor()
+        for group, group_terms in terms.items():
+            fts_times, like_times = [], []
+            for _ in range(args.rounds):
+                for term in group_terms:
+                    t0 = time.perf_counter()
+                    nebula.search_forum(cur, term, 1)
+                    fts_times.append(time.perf_counter() - t0)
+                    t0 = time.perf_counter()
+                    cur.execute(like_sql, (f"%{term}%", nebula.SEARCH_PAGE_SIZE + 1)).fetchall()
+                    like_times.append(time.perf_counter() - t0)
+            for name, values in (("fts5", fts_times), ("like", like_times)):
+                result = summarize(values)
+                print(
+                    f"{group:>10} {name:>5}  p50={result['p50']}ms p95={result['p95']}ms "
+                    f"p99={result['p99']}ms max={result['max']}ms  n={result['n']}"
+                )
+    finally:
+        pool.release(conn)
+
+# --------------- login: hash en línea vs pool de procesos ---------------
+def run_login_scenario(name, workers, password_hash, args):
+    fresh_database(HASH_WORKERS=workers, HASH_QUEUE_LIMIT=args.queue_limit or args.clients, _hasher=None)
+    db = sqlite3.connect(nebula.DB_PATH)
+    db.executemany(
+        "INSERT INTO users(username, password) VALUES (?,?)",
+        ((f"user{i}", password_hash) for i in range(args.clients)),
+    )
+    db.commit()
+    db.close()
+    nebula.get_hasher().check(password_hash, "calentar")  # arrancar los procesos fuera de la medida
+    app = nebula.create_app()
+    stop = threading.Event()
+    logins, pages, lock = [], [], threading.Lock()
+    statuses = {}
+
+    def login_client(i):
+        client = app.test_client()
+        local = []
+        while not stop.is_set():
+            start = time.perf_counter()
+            response = client.post("/login", data={"username": f"user{i}", "password": "benchmark"})
+            local.append(time.perf_counter() - start)
+            with lock:
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        with lock:
+            logins.extend(local)
+
+    def page_client():
+        # Un usuario navegando mientras tanto: mide cuánto le afectan los logins
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess["user"] = "user0"
+        local = []
+        while not stop.is_set():
+            start = time.perf_counter()
+            client.get("/htb")
+            local.append(time.perf_counter() - start)
+        with lock:
+            pages.extend(local)
+
+    threads = [threading.Thread(target=login_client, args=(i,)) for i in range(args.clients)]
+    threads.append(threading.Thread(target=page_client))
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    login_stats, page_stats = summarize(logins), summarize(pages)
+    print(
+        f"{name:>7}  login p50={login_stats['p50']}ms p99={login_stats['p99']}ms n={login_stats['n']}  "
+        f"/htb p50={page_stats['p50']}ms p99={page_stats['p99']}ms n={page_stats['n']}  estados={statuses}"
+    )
+
+def bench_login(args):
+    password_hash = nebula.generate_password_hash("benchmark", nebula.PASSWORD_HASH_METHOD)
+    print(f"{args.clients} clientes haciendo login durante {args.duration}s ({nebula.PASSWORD_HASH_METHOD})")
+    run_login_scenario("inline", 0, password_hash, args)
+    run_login_scenario("pool", args.workers, password_hash, args)
+
+# --------------- compress: tamaño y coste de la compresión ---------------
+def bench_compress(args):
+    path = fresh_database()
+    seed_forum(path, args.threads, args.replies)
+    app = nebula.create_app()
+    compression = app.extensions["compression"]
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["user"] = "admin"
+    pages = ["/threads", "/thread/1", "/admin", "/htb"]
+    print(f"Codificaciones disponibles: {', '.join(compression.encodings)}")
+    for encoding in ["identity", *compression.encodings]:
+        for page in pages:
+            times, size = [], 0
+            for _ in range(args.rounds):
+                start = time.perf_counter()
+                response = client.get(page, headers={"Accept-Encoding": encoding})
+                times.append(time.perf_counter() - start)
+                size = len(response.data)
+            result = summarize(times)
+            print(f"{encoding:>8} {page:<10} {size:>8} bytes  p50={result['p50']}ms p95={result['p95']}ms")
+    for encoding, counters in compression.stats()["encoded"].items():
+        print(
+            f"{encoding:>8} ahorro={counters['saved_ratio']:.1%}  cpu={counters['cpu_ms']}ms "
+            f"({counters['cpu_ms_per_mb']}ms/MB) en {counters['responses']} respuestas"
+        )
+
+# --------------- startup: arranque en frío ---------------
+# Se ejecuta en un intérprete nuevo en cada ronda para medir el arranque real de un worker
+STARTUP_PROBE = """
+import time
+start = time.perf_counter()
+import flask
+framework = time.perf_counter()
+import app as nebula
+imported = time.perf_counter()
+application = nebula.create_app()
+created = time.perf_counter()
+response = application.test_client().get("/healthz")
+answered = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(framework - start, imported - framework, created - imported, answered - created)
+"""
+
+def bench_startup(args):
+    env = dict(os.environ, DATABASE_PATH=fresh_database())
+    root = os.path.dirname(os.path.abspath(__file__))
+    # "import flask" es el suelo que no depende de app.py
+    phases = {"import flask": [], "import app": [], "create_app": [], "1ª petición": [], "proceso": []}
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_PROBE], cwd=root, env=env, check=True, capture_output=True, text=True
+        ).stdout
+        phases["proceso"].append(time.perf_counter() - start)
+        for name, value in zip(phases, output.split()):
+            phases[name].append(float(value))
+    for name, values in phases.items():
+        result = summarize(values)
+        print(f"{name:>12}  p50={result['p50']}ms p95={result['p95']}ms max={result['max']}ms  n={result['n']}")
+
+# --------------- templates: caché de bytecode de Jinja ---------------
+TEMPLATES_PROBE = """
+import sys, time
+import app as nebula
+application = nebula.create_app()
+client = application.test_client()
+with client.session_transaction() as sess:
+    sess["user"] = "admin"
+times = []
+for page in sys.argv[1:]:
+    start = time.perf_counter()
+    response = client.get(page)
+    times.append(time.perf_counter() - start)
+    assert response.status_code == 200, (page, response.status_code)
+print(*times)
+"""
+
+def bench_templates(args):
+    path = fresh_database()
+    seed_forum(path, 50, 5)
+    root = os.path.dirname(os.path.abspath(__file__))
+    pages = ["/threads", "/thread/1", "/admin"]
+    cache_dir = tempfile.mkdtemp(prefix="nebula-jinja-")
+    scenarios = [
+        ("sin caché", "", None),
+        ("caché frío", cache_dir, lambda: [os.remove(os.path.join(cache_dir, f)) for f in os.listdir(cache_dir)]),
+        ("caché caliente", cache_dir, None),
+    ]
+    for name, directory, before in scenarios:
+        env = dict(os.environ, DATABASE_PATH=path, TEMPLATE_CACHE_DIR=directory)
+        first = {page: [] for page in pages}
+        for _ in range(args.rounds):
+            if before:
+                before()
+            output = subprocess.run(
+                [sys.executable, "-c", TEMPLATES_PROBE, *pages],
+                cwd=root, env=env, check=True, capture_output=True, text=True,
+            ).stdout
+            for page, value in zip(pages, output.split()):
+                first[page].append(float(value))
+        for page, values in first.items():
+            result = summarize(values)
+            print(f"{name:>15} {page:<10} 1ª petición p50={result['p50']}ms p95={result['p95']}ms  n={result['n']}")
+
+# --------------- live: respuestas en vivo por SSE ---------------
+def bench_live(args):
+    path = fresh_database(LIVE_STREAM_MAX=args.duration + 2, LIVE_POLL_INTERVAL=args.poll)
+    seed_forum(path, 10, 5)
+    nebula.live_replies = nebula.ReplyBroker(args.subscribers)
+    app = nebula.create_app()
+    db = sqlite3.connect(path)
+    last_id = db.execute("SELECT MAX(id) FROM replies").fetchone()[0]
+    poster_id = db.execute("SELECT id FROM users WHERE username = 'user1'").fetchone()[0]
+    db.close()
+    posted, received, lock = {}, [], threading.Lock()
+    ready = threading.Barrier(args.subscribers + 1)
+
+    def subscriber():
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess["user"] = "user0"
+        response = client.get(f"/thread/1/events?after={last_id}", buffered=False)
+        ready.wait()
+        for chunk in response.response:
+            now = time.perf_counter()
+            for line in chunk.decode().splitlines():
+                if line.startswith("id: "):
+                    with lock:
+                        received.append(now - posted[int(line[4:])])
+        response.close()
+
+    threads = [threading.Thread(target=subscriber) for _ in range(args.subscribers)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    poster = app.test_client()
+    with poster.session_transaction() as sess:
+        sess["user"] = "user1"
+    pool_in_use = 0
+    end = time.monotonic() + args.duration
+    while time.monotonic() < end:
+        reply_id = nebula.run_write(nebula.insert_reply, 1, "en vivo", poster_id, "2026-01-01 00:00")
+        with lock:
+            posted[reply_id] = time.perf_counter()
+        nebula.live_replies.publish(1, {"id": reply_id, "content": "en vivo", "author_id": poster_id, "created_at": "2026-01-01 00:00"})
+        pool_in_use = max(pool_in_use, nebula.get_pool().stats()["in_use"])
+        time.sleep(args.interval)
+    for thread in threads:
+        thread.join()
+    result = summarize(received)
+    stats = nebula.live_replies.stats()
+    print(
+        f"{args.subscribers} suscriptores, {len(posted)} respuestas, {result['n']} entregas: "
+        f"p50={result['p50']}ms p95={result['p95']}ms p99={result['p99']}ms max={result['max']}ms"
+    )
+    print(
+        f"reparto en proceso avg={stats['fanout_avg_ms']}ms max={stats['fanout_max_ms']}ms  "
+        f"sondeos={stats['polls']} ({stats['poll_avg_ms']}ms)  conexiones del pool en uso (máx)={pool_in_use}"
+    )
+
+# --------------- concurrency: modo síncrono frente a ASGI ---------------
+def start_server(command, port, env):
+    root = os.path.dirname(os.path.abspath(__file__))
+    server = subprocess.Popen(command, cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/healthz")
+            if connection.getresponse().status == 200:
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"el servidor no arrancó: {command}")
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+def login_cookie(port):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    body = urllib.parse.urlencode({"username": "admin", "password": "m71Gts80#4j/"})
+    connection.request("POST", "/login", body, {"Content-Type": "application/x-www-form-urlencoded"})
+    response = connection.getresponse()
+    response.read()
+    return response.getheader("Set-Cookie").split(";", 1)[0]
+
+async def open_streams(port, cookie, count, timeout):
+    # Abre `count` streams a la vez y los deja abiertos; devuelve los estados (None = sin respuesta)
+    async def open_stream():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"GET /thread/1/events HTTP/1.1\r\nHost: bench\r\nCookie: {cookie}\r\n\r\n".encode())
+        try:
+            status_line = await asyncio.wait_for(reader.readline(), timeout)
+            return int(status_line.split()[1]), writer
+        except (asyncio.TimeoutError, IndexError, ValueError):
+            return None, writer
+
+    return await asyncio.gather(*(open_stream() for _ in range(count)))
+
+def probe_page(port, cookie, requests, timeout):
+    # Un usuario navegando mientras los streams siguen abiertos
+    times, failures = [], 0
+    for _ in range(requests):
+        start = time.perf_counter()
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+            connection.request("GET", "/threads", headers={"Cookie": cookie})
+            response = connection.getresponse()
+            response.read()
+            connection.close()
+        except OSError:
+            failures += 1
+            continue
+        if response.status == 200:
+            times.append(time.perf_counter() - start)
+        else:
+            failures += 1
+    return times, failures
+
+def bench_concurrency(args):
+    path = fresh_database()
+    seed_forum(path, 10, 5)
+    base_env = dict(
+        os.environ, DATABASE_PATH=path, SECRET_KEY="bench", TEMPLATE_CACHE_DIR="", GRACEFUL_TIMEOUT="1",
+        WEB_CONCURRENCY="1", WEB_THREADS=str(args.threads), ASGI_WSGI_THREADS=str(args.threads),
+    )
+    scenarios = [
+        ("sync", [sys.executable, "serve.py"], {}),
+        # Sin el límite de suscriptores los streams agotan los hilos y las páginas dejan de responder
+        ("sync sin límite", [sys.executable, "serve.py"], {"LIVE_MAX_SUBSCRIBERS": "100000"}),
+    ]
+    if importlib.util.find_spec("uvicorn"):
+        command = [sys.executable, "-m", "uvicorn", "asgi:application", "--port", str(args.port), "--log-level", "warning"]
+        scenarios.append(("asgi", command, {"ASGI_MAX_SUBSCRIBERS": "100000"}))
+    else:
+        print("asgi: omitido (pip install uvicorn)")
+    levels = [int(level) for level in args.levels.split(",")]
+    print(f"1 proceso, {args.threads} hilos; página /threads ×{args.requests} con N streams SSE abiertos")
+    for name, command, extra in scenarios:
+        env = dict(base_env, PORT=str(args.port), **extra)
+        for level in levels:
+            # Servidor nuevo por nivel: un stream síncrono no suelta su hilo hasta el siguiente latido
+            server = start_server(command, args.port, env)
+            try:
+                cookie = login_cookie(args.port)
+                loop = asyncio.new_event_loop()
+                streams = loop.run_until_complete(open_streams(args.port, cookie, level, args.timeout))
+                times, failures = probe_page(args.port, cookie, args.requests, args.timeout)
+                for _, writer in streams:
+                    writer.close()
+                loop.close()
+            finally:
+                stop_server(server)
+            statuses = [status for status, _ in streams]
+            page = summarize(times)
+            print(
+                f"{name:>15} N={level:<5} abiertos={statuses.count(200):<5} 503={statuses.count(503):<5} "
+                f"sin respuesta={statuses.count(None):<5} página p50={page['p50']}ms p99={page['p99']}ms "
+                f"fallos={failures}/{args.requests}"
+            )
+
+# --------------- ndjson: exportación e importación ---------------
+def bench_ndjson(args):
+    source = fresh_database()
+    seed_forum(source, args.threads, args.replies // args.threads)
+    dump = os.path.join(os.path.dirname(source), "dump.ndjson")
+    db = nebula.connect_db()
+    start = time.perf_counter()
+    with open(dump, "w", encoding="utf-8") as out:
+        counts = nebula.export_ndjson(db, out)
+    elapsed = time.perf_counter() - start
+    db.close()
+    total = sum(counts.values())
+    print(f"export: {total} filas en {elapsed:.2f}s ({total / elapsed:.0f} filas/s, {os.path.getsize(dump) // 1024} KiB)")
+    fresh_database()
+    for name in ("import (nuevas)", "import (upsert)"):
+        db = nebula.connect_db()
+        start = time.perf_counter()
+        with open(dump, encoding="utf-8") as lines:
+            counts = nebula.NdjsonImporter(db, args.batch_size, args.commit_every).run(lines)
+        elapsed = time.perf_counter() - start
+        total = sum(counts.values())
+        print(f"{name}: {total} filas en {elapsed:.2f}s ({total / elapsed:.0f} filas/s; respuestas {counts['replies'] / elapsed:.0f}/s)")
+        cur = db.cursor()
+        assert nebula.stale_thread_counters(cur) == 0
+        indexed = cur.execute("SELECT COUNT(*) FROM search_index").fetchone()[0]
+        expected = cur.execute("SELECT (SELECT COUNT(*) FROM threads) + (SELECT COUNT(*) FROM replies)").fetchone()[0]
+        assert indexed == expected, (indexed, expected)
+        db.close()
+
+# --------------- backup: copia en caliente con tráfico ---------------
+def measure_traffic(app, threads, stop):
+    # Lectores con el cliente de pruebas y un escritor por la cola de escritura hasta `stop`
+    reads, writes, lock = [], [], threading.Lock()
+
+    def reader(seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess["user"] = "admin"
+        while not stop.is_set():
+            page = rng.choice(("/threads", f"/thread/{rng.randint(1, threads)}"))
+            start = time.perf_counter()
+            response = client.get(page)
+            elapsed = time.perf_counter() - start
+            assert response.status_code == 200, (page, response.status_code)
+            with lock:
+                reads.append(elapsed)
+
+    def writer():
+        while not stop.is_set():
+            start = time.perf_counter()
+            nebula.run_write(nebula.insert_reply, 1, "durante la copia", 1, "2026-01-01 00:00")
+            with lock:
+                writes.append(time.perf_counter() - start)
+            time.sleep(0.005)
+
+    workers = [threading.Thread(target=reader, args=(i,)) for i in range(2)] + [threading.Thread(target=writer)]
+    for worker in workers:
+        worker.start()
+    return workers, reads, writes
+
+def bench_backup(args):
+    path = fresh_database()
+    seed_forum(path, args.threads, args.replies // args.threads)
+    app = nebula.create_app()
+    directory = tempfile.mkdtemp(prefix="nebula-backups-")
+    print(f"base de datos de {os.path.getsize(path) // (1024 * 1024)} MiB; 2 lectores + 1 escritor cada 5 ms")
+    scenarios = [
+        ("sin copia", None),
+        ("copia de un paso", {"BACKUP_STEP_PAGES": -1, "BACKUP_STEP_PAUSE": 0.0}),
+        ("copia paginada", {"BACKUP_STEP_PAGES": nebula.BACKUP_STEP_PAGES, "BACKUP_STEP_PAUSE": nebula.BACKUP_STEP_PAUSE}),
+    ]
+    # Calentamiento: plantillas, caché de fragmentos y páginas de SQLite
+    stop = threading.Event()
+    workers, _, _ = measure_traffic(app, args.threads, stop)
+    time.sleep(1)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    for name, settings in scenarios:
+        stop = threading.Event()
+        workers, reads, writes = measure_traffic(app, args.threads, stop)
+        detail = ""
+        if settings is None:
+            time.sleep(args.duration)
+        else:
+            for setting, value in settings.items():
+                setattr(nebula, setting, value)
+            result = nebula.create_backup(directory, keep=1)
+            detail = (
+                f"  copia {result['copy_s']}s/{result['steps']} pasos/{result['restarts']} reinicios, "
+                f"gzip {result['compress_s']}s, {result['size'] // 1024} KiB"
+            )
+        stop.set()
+        for worker in workers:
+            worker.join()
+        read, write = summarize(reads), summarize(writes)
+        print(
+            f"{name:>17}  lectura p50={read['p50']}ms p99={read['p99']}ms max={read['max']}ms  "
+            f"escritura p50={write['p50']}ms p99={write['p99']}ms max={write['max']}ms{detail}"
+        )
+
+# --------------- ban: baneo de un usuario con mucho contenido ---------------
+def seed_spammer(path, username, threads, replies, forum_threads):
+    # Hilos propios (con respuestas de otros) detrás de los del foro y respuestas repartidas
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA foreign_keys=ON")
+    user_id = db.execute("INSERT INTO users(username, password) VALUES (?, 'x')", (username,)).lastrowid
+    others = seed_users(db)
+    db.executemany(
+        "INSERT INTO threads(title, content, author_id) VALUES (?,?,?)",
+        ((f"spam {i}", "compra ya " * 20, user_id) for i in range(threads)),
+    )
+    first = db.execute("SELECT MIN(id) FROM threads WHERE author_id=?", (user_id,)).fetchone()[0]
+    db.executemany(
+        "INSERT INTO replies(content, author_id, thread_id) VALUES (?,?,?)",
+        (("respuesta a spam", others[i % 50], first + i % threads) for i in range(threads * 5)),
+    )
+    db.executemany(
+        "INSERT INTO replies(content, author_id, thread_id) VALUES (?,?,?)",
+        (("spam " * 10, user_id, 1 + i % forum_threads) for i in range(replies)),
+    )
+    db.commit()
+    db.close()
+    nebula.run_write(nebula.refresh_thread_counters)
+    return user_id
+
+def bench_ban(args):
+    path = fresh_database()
+    seed_forum(path, args.threads, 10)
+    app = nebula.create_app()
+    print(
+        f"spammer con {args.spam_threads} hilos (+{args.spam_threads * 5} respuestas de otros) y {args.spam_replies} "
+        f"respuestas; 2 lectores + 1 escritor cada 5 ms; tramos de {args.chunk} filas"
+    )
+    for name, chunked in (("una transacción", False), ("por tramos", True)):
+        user_id = seed_spammer(path, f"spammer{int(chunked)}", args.spam_threads, args.spam_replies, args.threads)
+        stop = threading.Event()
+        workers, reads, writes = measure_traffic(app, args.threads, stop)
+        time.sleep(0.5)
+        start = time.perf_counter()
+        if chunked:
+            removed = nebula.ban_user_content(user_id, args.chunk)
+        else:
+            removed = nebula.run_write(nebula.ban_finish, user_id)
+        elapsed = time.perf_counter() - start
+        time.sleep(0.5)
+        stop.set()
+        for worker in workers:
+            worker.join()
+        read, write = summarize(reads), summarize(writes)
+        print(
+            f"{name:>16}: {removed} filas en {elapsed:.2f}s  escritura p50={write['p50']}ms p99={write['p99']}ms "
+            f"max={write['max']}ms  lectura p99={read['p99']}ms max={read['max']}ms"
+        )
+
+# --------------- metrics: coste de la instrumentación ---------------
+def bench_metrics(args):
+    path = fresh_database()
+    seed_forum(path, args.threads, args.replies)
+    app = nebula.create_app()
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["user"] = "admin"
+    pages = ["/threads", "/thread/1", "/search?q=contenido"]
+    rng = random.Random(7)
+    for page in pages * 5:
+        client.get(page)
+    for rnd in range(args.rounds):
+        # Rondas alternas para que el ruido de la máquina afecte a las dos por igual
+        for enabled in (False, True):
+            nebula.METRICS_ENABLED = enabled
+            times = []
+            for _ in range(args.requests):
+                page = rng.choice(pages)
+                start = time.perf_counter()
+                response = client.get(page)
+                times.append(time.perf_counter() - start)
+                assert response.status_code == 200, (page, response.status_code)
+            stats = summarize(times)
+            print(f"ronda {rnd + 1} {'con' if enabled else 'sin'} métricas  p50={stats['p50']}ms p99={stats['p99']}ms mean={stats['mean']}ms")
+    with client.session_transaction() as sess:
+        sess["user"] = "admin"
+    start = time.perf_counter()
+    body = client.get("/metrics").get_data()
+    print(f"/metrics: {len(body) // 1024} KiB en {(time.perf_counter() - start) * 1000:.1f} ms")
+
+# --------------- load: carga sobre un foro sintético ---------------
+# Mezcla de peticiones de un usuario que navega: (ruta, peso). El login es poco frecuente pero
+# caro (scrypt): con más peso satura el pool de hash y devuelve 503 por diseño
+LOAD_MIX = (("dashboard", 20), ("threads", 25), ("thread", 44), ("reply", 10), ("login", 1))
+LOAD_EXPECTED = {"dashboard": 200, "threads": 200, "thread": 200, "reply": 302, "login": 302}
+
+class TestClientTransport:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, form=None):
+        return self.client.open(path, method=method, data=form).status_code
+
+class HttpTransport:
+    # Una conexión por petición (el servidor WSGI habla HTTP/1.0) y la cookie de sesión a mano
+    def __init__(self, port):
+        self.port = port
+        self.cookie = None
+
+    def request(self, method, path, form=None):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+        headers = {"Cookie": self.cookie} if self.cookie else {}
+        body = None
+        if form is not None:
+            body = urllib.parse.urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            response.read()
+        finally:
+            connection.close()
+        cookie = response.getheader("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";", 1)[0]
+        return response.status
+
+def load_targets(path, password):
+    # Hilos con probabilidad proporcional a sus respuestas (los calientes se visitan más) y
+    # usuarios generados con la contraseña conocida
+    db = sqlite3.connect(path)
+    threads = db.execute("SELECT id, reply_count + 1 FROM threads").fetchall()
+    check = db.execute("SELECT password FROM users WHERE username GLOB 'user[0-9]*' LIMIT 1").fetchone()
+    users = []
+    if check and nebula.check_password_hash(check[0], password):
+        users = [row[0] for row in db.execute(
+            "SELECT username FROM users WHERE username GLOB 'user[0-9]*' AND password = ? LIMIT 5000", check
+        )]
+    db.close()
+    if not users:
+        raise SystemExit(f"no hay usuarios generados con la contraseña {password!r}: flask nebula generate")
+    return [thread_id for thread_id, _ in threads], list(itertools.accumulate(weight for _, weight in threads)), users
+
+def run_load(make_transport, targets, args):
+    thread_ids, thread_weights, users = targets
+    routes, weights = zip(*LOAD_MIX)
+    samples, errors, lock = {route: [] for route in routes}, {route: 0 for route in routes}, threading.Lock()
+    start_at = time.monotonic() + args.warmup
+    end_at = start_at + args.duration
+
+    def user(seed):
+        rng = random.Random(seed)
+        transport = make_transport()
+        username = rng.choice(users)
+
+        def call(route):
+            if route == "login":
+                return transport.request("POST", "/login", {"username": username, "password": args.password})
+            if route == "dashboard":
+                return transport.request("GET", "/dashboard")
+            if route == "threads":
+                return transport.request("GET", "/threads")
+            thread_id = rng.choices(thread_ids, cum_weights=thread_weights)[0]
+            if route == "reply":
+                return transport.request("POST", f"/thread/{thread_id}", {"content": f"respuesta de carga {rng.random()}"})
+            return transport.request("GET", f"/thread/{thread_id}")
+
+        # Sesión iniciada antes de medir: sin ella todas las páginas serían redirecciones
+        for _ in range(100):
+            if call("login") == 302:
+                break
+            time.sleep(0.1)
+        else:
+            raise RuntimeError(f"no se pudo iniciar sesión como {username}")
+        while True:
+            route = rng.choices(routes, weights)[0]
+            started = time.perf_counter()
+            try:
+                status = call(route)
+            except OSError:
+                status = None
+            elapsed = time.perf_counter() - started
+            now = time.monotonic()
+            if now >= end_at:
+                return
+            if now >= start_at:
+                with lock:
+                    if status == LOAD_EXPECTED[route]:
+                        samples[route].append(elapsed)
+                    else:
+                        errors[route] += 1
+            if route == "login" and status == 302:
+                username = rng.choice(users)
+
+    workers = [threading.Thread(target=user, args=(args.seed * 1000 + i,)) for i in range(args.clients)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    total = sum(len(times) for times in samples.values())
+    return {
+        "throughput": round(total / args.duration, 1),
+        "errors": sum(errors.values()),
+        "routes": {
+            route: dict(summarize(times), rps=round(len(times) / args.duration, 1), errors=errors[route])
+            for route, times in samples.items()
+        },
+    }
+
+def print_load(name, result):
+    print(f"{name}: {result['throughput']} peticiones/s, {result['errors']} errores")
+    for route, stats in result["routes"].items():
+        print(
+            f"  {route:>10} {stats['rps']:>8}/s  p50={stats['p50']}ms p95={stats['p95']}ms "
+            f"p99={stats['p99']}ms  n={stats['n']} errores={stats['errors']}"
+        )
+
+def compare_load(results, baseline, tolerance):
+    # Regresión: percentil más lento o menos peticiones/s que la línea base más allá de la tolerancia
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get("results", {}).get(name)
+        if base is None:
+            continue
+        checks = [(f"{name} throughput", base["throughput"], result["throughput"], False)]
+        for route, stats in result["routes"].items():
+            base_stats = base["routes"].get(route)
+            if base_stats and base_stats["n"] and stats["n"]:
+                checks += [(f"{name} {route} {pct}", base_stats[pct], stats[pct], True) for pct in ("p50", "p95", "p99")]
+        for label, before, after, lower_is_better in checks:
+            if not before:
+                continue
+            change = (after - before) / before
+            if (change > tolerance) if lower_is_better else (change < -tolerance):
+                regressions.append(f"{label}: {before} → {after} ({change:+.0%})")
+    return regressions
+
+def bench_load(args):
+    if args.database:
+        use_database(args.database)
+        path = args.database
+    else:
+        path = fresh_database()
+        db = nebula.connect_db()
+        start = time.perf_counter()
+        nebula.generate_forum(db, args.users, args.threads, args.replies, seed=args.seed, password=args.password)
+        db.close()
+        print(
+            f"foro sintético: {args.users} usuarios, {args.threads} hilos, {args.replies} respuestas "
+            f"en {time.perf_counter() - start:.1f}s ({os.path.getsize(path) // (1024 * 1024)} MiB)"
+        )
+    targets = load_targets(path, args.password)
+    # El registro de peticiones lentas (métricas) taparía el informe
+    nebula.logger.setLevel(logging.ERROR)
+    print(f"{args.clients} clientes, {args.duration}s tras {args.warmup}s de calentamiento; mezcla {dict(LOAD_MIX)}")
+    results = {}
+    if args.transport in ("client", "both"):
+        app = nebula.create_app()
+        results["client"] = run_load(lambda: TestClientTransport(app), targets, args)
+        print_load("cliente de pruebas", results["client"])
+    if args.transport in ("http", "both"):
+        env = dict(
+            os.environ, DATABASE_PATH=path, SECRET_KEY="bench", TEMPLATE_CACHE_DIR="", GRACEFUL_TIMEOUT="1",
+            PORT=str(args.port), WEB_THREADS=str(args.clients),
+        )
+        server = start_server([sys.executable, "serve.py"], args.port, env)
+        try:
+            results["http"] = run_load(lambda: HttpTransport(args.port), targets, args)
+        finally:
+            stop_server(server)
+        print_load(f"HTTP (serve.py, {os.environ.get('WEB_CONCURRENCY') or os.cpu_count()} workers)", results["http"])
+    if args.save_baseline:
+        params = {key: getattr(args, key) for key in ("users", "threads", "replies", "clients", "duration", "seed")}
+        with open(args.save_baseline, "w", encoding="utf-8") as out:
+            json.dump({"params": params, "results": results}, out, indent=2)
+        print(f"línea base guardada en {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as source:
+            baseline = json.load(source)
+        regressions = compare_load(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESIÓN {line}")
+        if regressions:
+            return 1
+        print(f"sin regresiones frente a {args.baseline} (tolerancia {args.tolerance:.0%})")
+
+# --------------- pages: tamaño y páginas de listado ---------------
+PAGES_OBJECTS = ("threads", "replies", "users", "search_index_data")
+
+def bench_pages(args):
+    path = fresh_database()
+    db = nebula.connect_db()
+    nebula.generate_forum(db, args.users, args.threads, args.replies, seed=args.seed)
+    db.execute("VACUUM")
+    sizes = dict(db.execute(
+        "SELECT name, SUM(pgsize) FROM dbstat WHERE name NOT LIKE 'sqlite_%' GROUP BY name"
+    ).fetchall())
+    hot = db.execute("SELECT id FROM threads ORDER BY reply_count DESC LIMIT 1").fetchone()[0]
+    db.close()
+    print(
+        f"foro sintético: {args.users} usuarios, {args.threads} hilos, {args.replies} respuestas; "
+        f"{os.path.getsize(path) / (1024 * 1024):.1f} MiB tras VACUUM"
+    )
+    indexes = {name: size for name, size in sizes.items() if name.startswith("idx_")}
+    for name in (*PAGES_OBJECTS, *sorted(indexes)):
+        if name in sizes:
+            print(f"  {name:>28} {sizes[name] / (1024 * 1024):8.2f} MiB")
+    print(f"  {'índices idx_*':>28} {sum(indexes.values()) / (1024 * 1024):8.2f} MiB")
+    nebula.logger.setLevel(logging.ERROR)
+    app = nebula.create_app()
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["user"] = "admin"
+    pages = {"threads": "/threads", "thread": f"/thread/{hot}", "admin": "/admin"}
+    for page in pages.values():
+        client.get(page)
+    for name, page in pages.items():
+        for mode in ("frío", "caché"):
+            times = []
+            for _ in range(args.requests):
+                if mode == "frío":
+                    nebula.fragment_cache.clear()
+                start = time.perf_counter()
+                response = client.get(page)
+                times.append(time.perf_counter() - start)
+                assert response.status_code == 200, (page, response.status_code)
+            stats = summarize(times)
+            print(f"{name:>8} {mode:>6}  p50={stats['p50']}ms p95={stats['p95']}ms p99={stats['p99']}ms  n={stats['n']}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks de Nebula Vault")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    wal = sub.add_parser("wal", help="latencia de lectura con escritores activos (DELETE vs WAL + cola de escritura)")
+    wal.add_argument("--writers", type=int, default=4)
+    wal.add_argument("--readers", type=int, default=4)
+    wal.add_argument("--duration", type=float, default=5.0)
+    wal.add_argument("--threads", type=int, default=200)
+    wal.add_argument("--replies", type=int, default=10, help="respuestas por hilo")
+    wal.set_defaults(func=bench_wal)
+
+    search = sub.add_parser("search", help="búsqueda FTS5 frente a LIKE sobre un corpus sintético")
+    search.add_argument("--threads", type=int, default=10000)
+    search.add_argument("--replies", type=int, default=100000)
+    search.add_argument("--vocabulary", type=int, default=20000)
+    search.add_argument("--rounds", type=int, default=3)
+    search.add_argument("--seed", type=int, default=7)
+    search.set_defaults(func=bench_search)
+
+    login = sub.add_parser("login", help="p99 de login concurrente con hash en línea y en pool de procesos")
+    login.add_argument("--clients", type=int, default=16)
+    login.add_argument("--workers", type=int, default=nebula.HASH_WORKERS or 2)
+    login.add_argument("--duration", type=float, default=5.0)
+    login.add_argument("--queue-limit", type=int, default=0, help="HASH_QUEUE_LIMIT (0 = uno por cliente, sin 503)")
+    login.set_defaults(func=bench_login)
+
+    compress = sub.add_parser("compress", help="bytes y latencia de páginas grandes con gzip/br/zstd")
+    compress.add_argument("--threads", type=int, default=200)
+    compress.add_argument("--replies", type=int, default=50, help="respuestas por hilo")
+    compress.add_argument("--rounds", type=int, default=50)
+    compress.set_defaults(func=bench_compress)
+
+    startup = sub.add_parser("startup", help="arranque en frío de un proceso: import, create_app() y primera petición")
+    startup.add_argument("--rounds", type=int, default=20)
+    startup.set_defaults(func=bench_startup)
+
+    templates = sub.add_parser("templates", help="primera petición de un proceso nuevo con y sin caché de bytecode")
+    templates.add_argument("--rounds", type=int, default=10)
+    templates.set_defaults(func=bench_templates)
+
+    live = sub.add_parser("live", help="latencia de reparto SSE y conexiones del pool con N suscriptores")
+    live.add_argument("--subscribers", type=int, default=50)
+    live.add_argument("--duration", type=float, default=5.0)
+    live.add_argument("--interval", type=float, default=0.05, help="segundos entre respuestas publicadas")
+    live.add_argument("--poll", type=float, default=5.0, help="LIVE_POLL_INTERVAL")
+    live.set_defaults(func=bench_live)
+
+    concurrency = sub.add_parser("concurrency", help="streams SSE simultáneos y latencia de página: serve.py frente a asgi.py")
+    concurrency.add_argument("--levels", default="4,16,64,256", help="streams abiertos en cada ronda")
+    concurrency.add_argument("--threads", type=int, default=8, help="WEB_THREADS / ASGI_WSGI_THREADS")
+    concurrency.add_argument("--requests", type=int, default=20, help="peticiones de página por ronda")
+    concurrency.add_argument("--timeout", type=float, default=3.0)
+    concurrency.add_argument("--port", type=int, default=18093)
+    concurrency.set_defaults(func=bench_concurrency)
+
+    ndjson = sub.add_parser("ndjson", help="filas/s de la exportación y la importación NDJSON")
+    ndjson.add_argument("--threads", type=int, default=1000)
+    ndjson.add_argument("--replies", type=int, default=500000)
+    ndjson.add_argument("--batch-size", type=int, default=nebula.IMPORT_BATCH_SIZE)
+    ndjson.add_argument("--commit-every", type=int, default=nebula.IMPORT_COMMIT_ROWS)
+    ndjson.set_defaults(func=bench_ndjson)
+
+    backup = sub.add_parser("backup", help="latencia de lecturas y escrituras durante una copia en caliente")
+    backup.add_argument("--threads", type=int, default=2000)
+    backup.add_argument("--replies", type=int, default=200000)
+    backup.add_argument("--duration", type=float, default=3.0, help="segundos de la medida sin copia")
+    backup.set_defaults(func=bench_backup)
+
+    ban = sub.add_parser("ban", help="latencia de escritura durante el baneo de un usuario con mucho contenido")
+    ban.add_argument("--threads", type=int, default=500, help="hilos del foro")
+    ban.add_argument("--spam-threads", type=int, default=2000)
+    ban.add_argument("--spam-replies", type=int, default=100000)
+    ban.add_argument("--chunk", type=int, default=nebula.BAN_CHUNK_ROWS)
+    ban.set_defaults(func=bench_ban)
+
+    metrics = sub.add_parser("metrics", help="latencia de página con y sin la instrumentación de /metrics")
+    metrics.add_argument("--threads", type=int, default=200)
+    metrics.add_argument("--replies", type=int, default=50, help="respuestas por hilo")
+    metrics.add_argument("--requests", type=int, default=500, help="peticiones por ronda")
+    metrics.add_argument("--rounds", type=int, default=3)
+    metrics.set_defaults(func=bench_metrics)
+
+    load = sub.add_parser("load", help="peticiones/s y p50/p95/p99 por ruta sobre un foro sintético")
+    load.add_argument("--database", help="base de datos ya generada (recibe las respuestas de la prueba)")
+    load.add_argument("--users", type=int, default=5000)
+    load.add_argument("--threads", type=int, default=20000)
+    load.add_argument("--replies", type=int, default=200000)
+    load.add_argument("--password", default=nebula.SYNTHETIC_PASSWORD)
+    load.add_argument("--transport", choices=("client", "http", "both"), default="both")
+    load.add_argument("--clients", type=int, default=8, help="usuarios simultáneos")
+    load.add_argument("--duration", type=float, default=20.0)
+    load.add_argument("--warmup", type=float, default=3.0)
+    load.add_argument("--seed", type=int, default=1)
+    load.add_argument("--port", type=int, default=18094)
+    load.add_argument("--save-baseline", metavar="FICHERO", help="guardar los resultados como línea base JSON")
+    load.add_argument("--baseline", metavar="FICHERO", help="comparar con una línea base; sale con 1 si hay regresiones")
+    load.add_argument("--tolerance", type=float, default=0.25, help="cambio relativo admitido frente a la línea base")
+    load.set_defaults(func=bench_load)
+
+    pages = sub.add_parser("pages", help="tamaño de la base de datos y latencia de las páginas de listado")
+    pages.add_argument("--users", type=int, default=5000)
+    pages.add_argument("--threads", type=int, default=20000)
+    pages.add_argument("--replies", type=int, default=200000)
+    pages.add_argument("--requests", type=int, default=300, help="peticiones por página y modo")
+    pages.add_argument("--seed", type=int, default=1)
+    pages.set_defaults(func=bench_pages)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,323 @@
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer
+
+###############################################
+#  Servidor de producción de Nebula Vault (pre-fork)
+#  • python serve.py → WEB_CONCURRENCY workers (por defecto uno por CPU) con WEB_THREADS
+#    hilos cada uno, aceptando del mismo socket en PORT
+#  • El maestro solo abre el socket y vigila generaciones. Cada generación es un proceso
+#    nuevo (execv) que importa la app, compila las plantillas una vez y hace fork de sus
+#    workers, que las heredan. El esquema se prepara aparte: flask --app app nebula init-db && python serve.py
+#  • SIGHUP: recarga sin cortes. Arranca una generación con el código nuevo sobre el mismo
+#    socket y, cuando todos sus workers escuchan, se retira la anterior (SIGTERM). Si la nueva
+#    no llega a arrancar en RELOAD_TIMEOUT (error al importar, create_app() falla...) se
+#    descarta y la anterior sigue sirviendo
+#  • SIGTERM / SIGINT: parada ordenada, esperando hasta GRACEFUL_TIMEOUT a las peticiones en curso
+#  • SIGUSR2: perfil por muestreo de PROFILE_SECONDS en cada worker (al maestro: en todos);
+#    los ficheros .folded quedan en PROFILE_DIR
+#  • Cada worker, al arrancar, retoma los baneos a medias (a mano: flask --app app nebula resume-bans)
+#  • Readiness: GET /healthz
+#  • En el build: flask --app app nebula build-assets && flask --app app nebula precompile
+#  • Detrás del proxy de Render (o de un nginx): PROXY_FIX_HOPS=1 para ver la IP real del cliente
+###############################################
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = int(os.environ.get("PORT", 10000))
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", 0)) or os.cpu_count() or 1
+# Cada hilo ocupa como mucho una conexión del pool: no conviene superar DB_POOL_SIZE
+THREADS = int(os.environ.get("WEB_THREADS", 8))
+BACKLOG = int(os.environ.get("WEB_BACKLOG", 2048))
+GRACEFUL_TIMEOUT = float(os.environ.get("GRACEFUL_TIMEOUT", 30))
+# Tiempo máximo para que una generación nueva tenga todos sus workers escuchando
+RELOAD_TIMEOUT = float(os.environ.get("RELOAD_TIMEOUT", 60))
+# Descriptor del socket que el maestro pasa a cada generación
+LISTEN_FD_ENV = "NEBULA_LISTEN_FD"
+# Extremo de escritura del pipe por el que una generación avisa al maestro de que está lista
+READY_FD_ENV = "NEBULA_READY_FD"
+
+class PooledWSGIServer(BaseWSGIServer):
+    # Servidor de Werkzeug con un pool fijo de hilos en lugar de un hilo por conexión
+    multithread = True
+
+    def __init__(self, host, port, app, threads, fd):
+        super().__init__(host, port, app, fd=fd)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="nebula-http")
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+def log(message):
+    print(f"[serve {os.getpid()}] {message}", file=sys.stderr, flush=True)
+
+def listen_socket():
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is not None:
+        sock = socket.socket(fileno=int(fd))
+    else:
+        sock = socket.create_server((HOST, PORT), backlog=BACKLOG)
+    sock.set_inheritable(True)
+    return sock
+
+def run_worker(app, sock, ready_fd=None):
+    server = PooledWSGIServer(HOST, PORT, app, THREADS, fd=sock.fileno())
+
+    def stop(signum, frame):
+        # shutdown() espera al bucle de serve_forever: no puede llamarse desde su propio hilo
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    from app import bans, install_profile_signal
+
+    install_profile_signal(signal.SIGUSR2)
+    # Baneos que dejó a medias un worker caído; si arrancan varios, solo uno retoma cada baneo
+    try:
+        bans.resume()
+    except Exception:
+        traceback.print_exc()
+    if ready_fd is not None:
+        os.write(ready_fd, b"1")
+        os.close(ready_fd)
+    try:
+        server.serve_forever()
+    finally:
+        # Deja terminar las peticiones aceptadas; la generación mata al worker tras GRACEFUL_TIMEOUT
+        server.executor.shutdown(wait=True)
+
+def spawn(app, sock, ready_fd=None):
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            run_worker(app, sock, ready_fd)
+        except BaseException:
+            status = 1
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    return pid
+
+def stop_workers(workers, timeout=GRACEFUL_TIMEOUT):
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + timeout
+    while workers and time.monotonic() < deadline:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid:
+            workers.discard(pid)
+        else:
+            time.sleep(0.1)
+    for pid in workers:
+        log(f"proceso {pid} no terminó a tiempo; SIGKILL")
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    workers.clear()
+
+def wait_workers_ready(workers, ready_r, pending):
+    # Cada worker escribe un byte cuando su servidor ya escucha. Falla si alguno muere antes
+    # o si llega una parada mientras tanto
+    remaining = len(workers)
+    while remaining:
+        if pending:
+            return False
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+        if pid:
+            workers.discard(pid)
+            log(f"worker {pid} murió al arrancar")
+            return False
+        readable, _, _ = select.select([ready_r], [], [], 0.2)
+        if readable:
+            remaining -= len(os.read(ready_r, remaining))
+    return True
+
+def run_generation(ready_fd):
+    # Una generación: importa la app (código nuevo tras un SIGHUP), hace fork de los workers
+    # y los relanza si mueren, hasta que el maestro la retira con SIGTERM
+    # Ctrl+C llega a todo el grupo de procesos: la parada la ordena el maestro
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    sock = listen_socket()
+    from app import create_app, preload_templates
+
+    app = create_app()
+    preload_templates(app)
+    # Hasta aquí SIGTERM mata sin más (no hay workers); desde aquí la parada es ordenada
+    pending = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: pending.append(signum))
+    ready_r, ready_w = os.pipe()
+    workers = {spawn(app, sock, ready_w) for _ in range(WORKERS)}
+    os.close(ready_w)
+
+    def profile_workers(signum, frame):
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGUSR2)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGUSR2, profile_workers)
+    ready = wait_workers_ready(workers, ready_r, pending)
+    os.close(ready_r)
+    if not ready:
+        stop_workers(workers)
+        return 1
+    os.write(ready_fd, b"1")
+    os.close(ready_fd)
+    log(f"generación lista: {WORKERS} workers × {THREADS} hilos")
+    restarts = []
+    while True:
+        if pending:
+            stop_workers(workers)
+            return 0
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if not pid:
+            time.sleep(0.2)
+            continue
+        workers.discard(pid)
+        log(f"worker {pid} terminó inesperadamente (estado {status}); se relanza")
+        # Si los workers mueren en bucle (p. ej. error al arrancar) se espera antes de relanzar
+        now = time.monotonic()
+        restarts = [t for t in restarts if now - t < 10] + [now]
+        if len(restarts) > WORKERS * 3:
+            time.sleep(1)
+        workers.add(spawn(app, sock))
+
+def start_generation(sock):
+    # fork + execv: la generación lee del disco el código actual de serve.py y de la app
+    ready_r, ready_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(ready_r)
+            os.set_inheritable(ready_w, True)
+            env = dict(os.environ, **{LISTEN_FD_ENV: str(sock.fileno()), READY_FD_ENV: str(ready_w)})
+            os.execve(sys.executable, [sys.executable, os.path.abspath(__file__), *sys.argv[1:]], env)
+        finally:
+            os._exit(127)
+    os.close(ready_w)
+    return pid, ready_r
+
+def main():
+    sock = listen_socket()
+    pending = []
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, lambda signum, frame: pending.append(signum))
+    current = None
+    # Generación que arranca: (pid, pipe de aviso, plazo); como mucho una a la vez
+    starting = None
+    retiring = set()
+
+    def profile_workers(signum, frame):
+        if current is not None:
+            try:
+                os.kill(current, signal.SIGUSR2)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGUSR2, profile_workers)
+
+    def launch():
+        pid, ready_r = start_generation(sock)
+        return pid, ready_r, time.monotonic() + RELOAD_TIMEOUT
+
+    def discard(reason, exited=False):
+        # La generación nueva no arrancó: se retira y, si la había, sigue la anterior
+        pid, ready_r, _ = starting
+        os.close(ready_r)
+        log(f"la generación {pid} no arrancó ({reason})"
+            + ("; sigue sirviendo la anterior" if current is not None else ""))
+        if not exited:
+            os.kill(pid, signal.SIGTERM)
+            retiring.add(pid)
+
+    starting = launch()
+    log(f"escuchando en {HOST}:{PORT}")
+    restarts = []
+    while True:
+        if pending:
+            signum = pending.pop(0)
+            if signum == signal.SIGHUP:
+                if starting is not None:
+                    log("recarga ya en curso; se ignora SIGHUP")
+                else:
+                    log("recarga: arrancando una generación con el código actual")
+                    starting = launch()
+                continue
+            if starting is not None:
+                os.close(starting[1])
+            # Las generaciones esperan GRACEFUL_TIMEOUT a sus workers antes de salir
+            stop_workers({pid for pid in (current, starting and starting[0]) if pid} | retiring,
+                         GRACEFUL_TIMEOUT + 5)
+            log("parada completa")
+            return 0
+        if starting is not None:
+            pid, ready_r, deadline = starting
+            readable, _, _ = select.select([ready_r], [], [], 0.2)
+            if readable and os.read(ready_r, 1):
+                os.close(ready_r)
+                starting = None
+                if current is not None:
+                    log(f"generación {pid} lista; se retira la {current}")
+                    os.kill(current, signal.SIGTERM)
+                    retiring.add(current)
+                current = pid
+            elif readable or time.monotonic() > deadline:
+                discard("sin aviso de arranque" if readable else f"más de {RELOAD_TIMEOUT:g}s")
+                starting = None
+                if current is None:
+                    stop_workers(retiring)
+                    return 1
+        else:
+            time.sleep(0.2)
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            if pid in retiring:
+                retiring.discard(pid)
+            elif starting is not None and pid == starting[0]:
+                discard(f"terminó con estado {status}", exited=True)
+                starting = None
+                if current is None:
+                    return 1
+            elif pid == current:
+                # La generación en servicio cayó: se arranca otra (con pausa si cae en bucle)
+                log(f"generación {pid} terminó inesperadamente (estado {status}); se relanza")
+                current = None
+                now = time.monotonic()
+                restarts = [t for t in restarts if now - t < 60] + [now]
+                if len(restarts) > 3:
+                    time.sleep(5)
+                if starting is None:
+                    starting = launch()
+
+if __name__ == "__main__":
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    ready_fd = os.environ.pop(READY_FD_ENV, None)
+    sys.exit(run_generation(int(ready_fd)) if ready_fd is not None else main())
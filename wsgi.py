@@ -0,0 +1,11 @@
+###############################################
+#  Punto de entrada WSGI de Nebula Vault
+#  • python serve.py                       → lanzador pre-fork incluido (sin dependencias extra)
+#  • gunicorn --preload wsgi:application   → también válido
+#  • uvicorn asgi:application              → modo ASGI opcional (streams SSE sin un hilo por conexión)
+#  • Esquema y plantillas se preparan antes con flask --app app nebula init-db / scaffold
+###############################################
+from app import create_app, preload_templates
+
+application = create_app()
+preload_templates(application)